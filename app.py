@@ -1,17 +1,33 @@
 import os
+import re
+import json
+import hashlib
 import requests
+import time
 import uuid
-import pandas as pd
+import multiprocessing
+import threading
+import atexit
+from concurrent.futures import ProcessPoolExecutor
 from dotenv import load_dotenv
-from ai21 import AI21Client
-from ai21.models.chat import ChatMessage
-from pymongo import MongoClient
+from pymongo import ReturnDocument
 from datetime import datetime
-import fitz
-from docx import Document
-import gridfs
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, jsonify, render_template, Response, stream_with_context
 from werkzeug.utils import secure_filename
+from retrieval import BM25Index, chunk_text, tokenize
+from dedup import NearDuplicateFilter, sketch
+from cache import LRUCache, MemoryAnswerCache, MongoAnswerCache
+import ingest
+from pagination import page_params, fetch_page, projection_for, select_fields
+from indexes import ensure_indexes
+from prompting import pack_chunks, estimate_tokens
+from llm import LLMGateway, GatewayError, LazyClient
+from writebehind import WriteBehindBuffer
+from deletion import DeletionCollector, LIVE
+from storage import open_storage
+from search import text_search, snippet, DEFAULT_LIMIT as SEARCH_DEFAULT_LIMIT, MAX_LIMIT as SEARCH_MAX_LIMIT
+import metrics
+from metrics import phase
 
 # Load environment variables
 load_dotenv(override=True)
@@ -19,52 +35,465 @@ api_key = os.getenv("AI21_API_KEY")
 
 
 
-# Initialize AI21 client
-client = AI21Client(api_key=api_key)
+# AI21 client, made on the first model call in each process (the SDK is slow to import)
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
 
-# MongoDB setup
-mongo_client = MongoClient("mongodb://localhost:27017")
-db = mongo_client["chat_history_db"]
+def make_ai21_client():
+    from ai21 import AI21Client
+    return AI21Client(api_key=api_key, timeout_sec=LLM_TIMEOUT)
+
+client = LazyClient(make_ai21_client)
+
+# Every model call goes through the gateway: bounded concurrency, deadline, retries, coalescing
+llm = LLMGateway(
+    client,
+    model="jamba-large-1.7",
+    max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "8")),
+    queue_timeout=float(os.getenv("LLM_QUEUE_TIMEOUT", "2")),
+    deadline=LLM_TIMEOUT,
+    max_retries=int(os.getenv("LLM_MAX_RETRIES", "3"))
+)
+
+# Storage: MongoDB and GridFS, or SQLite and local files (STORAGE_BACKEND, see storage.py).
+# connect=False: no Mongo connection or monitor thread until the first query, which happens
+# in the serving process (see start_worker), never in a parent that forks workers.
+storage = open_storage(connect=False)
+db = storage.db
 chat_collection = db["btech_conversations"]
 session_collection = db["chat_sessions"]
 doc_collection = db["documents"]
-fs = gridfs.GridFS(db)
+chunk_collection = db["document_chunks"]
+page_collection = db["document_pages"]
+text_collection = db["extracted_texts"]
+upload_jobs = db["upload_jobs"]
+fs = storage.fs
+
+# Create the indexes the request paths rely on (no-op when they already exist)
+CREATE_INDEXES = os.getenv("MONGO_CREATE_INDEXES", "1") == "1"
+
+# Local mode retrieval settings
+CHUNK_CHARS = int(os.getenv("CHUNK_CHARS", "1200"))
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "6"))
+# A chunk is left out of a session's index when this share of its text is already in chunks
+# from the session's newer documents (or earlier in the same one); 0 keeps every chunk
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "1.0"))
+# Document text allowed in a Local mode prompt, and the largest share one file may take
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))
+PROMPT_DOC_QUOTA = float(os.getenv("PROMPT_DOC_QUOTA", "0.6"))
+
+# Sessions with more chunk text than this keep only the search index in memory and read
+# the text of the chunks chosen for a prompt from Mongo
+CONTEXT_TEXT_MAX = int(os.getenv("CONTEXT_TEXT_MB", "16")) * 1024 * 1024
+
+# Prepared Local mode context per (session, document-set version)
+context_cache = LRUCache(
+    max_entries=int(os.getenv("CONTEXT_CACHE_ENTRIES", "128")),
+    max_bytes=int(os.getenv("CONTEXT_CACHE_MB", "256")) * 1024 * 1024
+)
+
+# Answers to repeated questions: "memory" (per process), "mongo" (shared by workers) or "off"
+ANSWER_CACHE = os.getenv("ANSWER_CACHE", "memory").lower()
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "86400"))
+ANSWER_CACHE_ENTRIES = int(os.getenv("ANSWER_CACHE_ENTRIES", "10000"))
+if ANSWER_CACHE == "mongo":
+    answer_cache = MongoAnswerCache(db["answer_cache"], ANSWER_CACHE_ENTRIES, ANSWER_CACHE_TTL)
+elif ANSWER_CACHE == "memory":
+    answer_cache = MemoryAnswerCache(ANSWER_CACHE_ENTRIES, ANSWER_CACHE_TTL)
+else:
+    answer_cache = None
+
+# Rows read from each spreadsheet sheet; 0 means no limit
+SPREADSHEET_MAX_ROWS = int(os.getenv("SPREADSHEET_MAX_ROWS", "100000")) or None
+
+# Text extraction runs in a process pool so parsing never blocks web workers
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", str(os.cpu_count() or 1)))
+ingest_pool = None
+
+# Uploads are copied into GridFS this many bytes at a time, never read whole
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_KB", "1024")) * 1024
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", "50")) * 1024 * 1024
+
+# Chat history writes: "sync" (insert before responding), "batched" (grouped into insert_many,
+# the request waits for its batch) or "fire_and_forget" (grouped, the request does not wait)
+chat_writer = WriteBehindBuffer(
+    chat_collection,
+    mode=os.getenv("CHAT_WRITE_MODE", "sync").lower(),
+    batch_size=int(os.getenv("CHAT_WRITE_BATCH", "100")),
+    interval=int(os.getenv("CHAT_WRITE_INTERVAL_MS", "200")) / 1000,
+    on_flush=lambda records: history_written(records)
+)
+atexit.register(chat_writer.close)
+
+# Deleted sessions are removed by a background collector, DELETE_BATCH records at a time
+# with a DELETE_PAUSE_MS pause between batches
+deletion_collector = DeletionCollector(
+    db,
+    batch_size=int(os.getenv("DELETE_BATCH", "500")),
+    pause=int(os.getenv("DELETE_PAUSE_MS", "50")) / 1000,
+    delete_content=storage.delete_blob_content
+)
+atexit.register(deletion_collector.stop)
+
+# Phase timings are always recorded for /metrics; SERVER_TIMING=1 also returns them
+# to the caller in a Server-Timing header (visible in the browser's network panel)
+SERVER_TIMING = os.getenv("SERVER_TIMING", "0") == "1"
 
 # Flask app
 app = Flask(__name__)
+# Werkzeug already spools multipart files over 500 KB to a temporary file on disk;
+# this rejects oversized request bodies before they are read at all
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES
+
+metrics.Gauge("chatbot_llm_in_flight", "Model calls currently holding a gateway slot", lambda: llm.in_flight)
+metrics.Gauge("chatbot_context_cache_bytes", "Approximate size of cached Local mode indexes", lambda: context_cache.bytes)
+metrics.Gauge("chatbot_process_resident_bytes", "Resident memory of the worker serving this scrape", metrics.resident_bytes)
+metrics.Gauge("chatbot_chat_write_pending", "Chat records buffered but not yet written", lambda: chat_writer.stats()["pending"])
+
+# Route template rather than path, so /upload_status/<job_id> is one series
+def route_label(url_rule):
+    return url_rule.rule if url_rule is not None else "unmatched"
+
+@app.before_request
+def start_timing():
+    metrics.start_request(route_label(request.url_rule))
+    start_worker()
+
+# Setup that talks to Mongo or starts threads runs once per process, on its first request,
+# so nothing is connected or running when a pre-fork server imports the app and forks
+_worker_pid = None
+_worker_lock = threading.Lock()
+
+def start_worker():
+    global _worker_pid
+    if _worker_pid == os.getpid():
+        return
+    with _worker_lock:
+        if _worker_pid == os.getpid():
+            return
+        if CREATE_INDEXES:
+            threading.Thread(target=create_indexes, name="create-indexes", daemon=True).start()
+        threading.Thread(target=recover_extractions, name="recover-extractions", daemon=True).start()
+        deletion_collector.start()
+        _worker_pid = os.getpid()
+
+# In the background, as building a $text index on a large collection takes a while and must
+# not hold up the request that started the worker. `python indexes.py` builds them ahead of
+# a deploy; with MONGO_CREATE_INDEXES=0 that is the only place they are made.
+def create_indexes():
+    try:
+        ensure_indexes(db)
+        if isinstance(answer_cache, MongoAnswerCache):
+            answer_cache.create_indexes()
+    except Exception:
+        app.logger.exception("Creating indexes failed; run python indexes.py to retry")
+
+@app.after_request
+def finish_timing(response):
+    server_timing = metrics.finish_request(request.method, response.status_code)
+    if SERVER_TIMING and server_timing:
+        response.headers["Server-Timing"] = server_timing
+    return response
+
+# Prometheus text format
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    return {"error": f"Upload exceeds the {MAX_UPLOAD_BYTES // (1024 * 1024)} MB limit"}, 413
+
+def get_ingest_pool():
+    global ingest_pool
+    if ingest_pool is None:
+        # spawn, so pool processes never inherit this process's Mongo sockets or threads
+        ingest_pool = ProcessPoolExecutor(
+            max_workers=INGEST_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return ingest_pool
+
+# The handler logic below is shared with the async serving mode (asgi.py): helpers that
+# only build or interpret documents do no I/O, and the Mongo calls stay in thin wrappers.
+
+# Split a stored document into chunks for the Local mode index.
+# Used for documents that keep their text inline (older uploads and task.py).
+def chunk_records(session_id, doc):
+    return [
+        {
+            "session_id": session_id,
+            "doc_id": doc["_id"],
+            "filename": doc["filename"],
+            "filetype": doc["filetype"],
+            "ordinal": i,
+            "text": text,
+            "sketch": sketch(text)
+        }
+        for i, text in enumerate(chunk_text(doc.get("content") or "", CHUNK_CHARS))
+    ]
+
+def store_chunks(session_id, doc):
+    chunks = chunk_records(session_id, doc)
+    if chunks:
+        chunk_collection.insert_many(chunks)
+    doc_collection.update_one({"_id": doc["_id"]}, {"$set": {"chunked": True}})
+    return chunks
+
+# Extracted pages and chunks are stored once per blob hash and shared by every session.
+# The pool worker has already written them under staging_id; the first extraction of a hash
+# to finish claims it and the records become visible, any other copy is dropped.
+def store_blob_text(sha256, filetype, staging_id, summary):
+    result = text_collection.update_one(
+        {"_id": sha256},
+        {"$setOnInsert": {
+            "filetype": filetype,
+            "pages": summary["pages"],
+            "chunks": summary["chunks"],
+            "chars": summary["chars"],
+            "extracted_at": datetime.now()
+        }},
+        upsert=True
+    )
+    if result.upserted_id is None:
+        discard_staging(staging_id)
+        return
+    for collection in (page_collection, chunk_collection):
+        collection.update_many({"staging": staging_id}, {"$set": {"sha256": sha256}, "$unset": {"staging": ""}})
+
+def discard_staging(staging_id):
+    page_collection.delete_many({"staging": staging_id})
+    chunk_collection.delete_many({"staging": staging_id})
+
+# Drop one reference to a GridFS blob, deleting it (and its text) with the last one.
+# Blobs stored before reference counting have no refcount and go on their first release.
+def release_blob(blob_id):
+    blob = db.fs.files.find_one_and_update(
+        {"_id": blob_id},
+        {"$inc": {"refcount": -1}},
+        projection={"refcount": 1, "sha256": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if not blob or blob["refcount"] > 0:
+        return
+    # Re-checked: an upload of the same content may have taken a reference since
+    blob = db.fs.files.find_one_and_delete({"_id": blob_id, "refcount": {"$lte": 0}}, projection={"sha256": 1})
+    if blob is None:
+        return
+    if storage.delete_blob_content is None:
+        db.fs.chunks.delete_many({"files_id": blob_id})
+    else:
+        storage.delete_blob_content([blob_id])
+    sha256 = blob.get("sha256")
+    if sha256 and not db.fs.files.find_one({"sha256": sha256}, {"_id": 1}):
+        text_collection.delete_one({"_id": sha256})
+        page_collection.delete_many({"sha256": sha256})
+        chunk_collection.delete_many({"sha256": sha256})
+
+# Any change to a session's documents bumps its version so cached contexts go stale
+def bump_doc_version(session_id):
+    session_collection.update_one({"_id": session_id}, {"$inc": {"doc_version": 1, "changes.documents": 1}})
+    forget_session_context(session_id)
+
+def forget_session_context(session_id):
+    context_cache.invalidate(lambda key: key[0] == session_id)
+
+# Change counters behind the ETags of /sessions, /documents and /history: the sessions list
+# has one in the counters collection, each session counts changes to its documents and history
+def touch_sessions():
+    db["counters"].update_one({"_id": "sessions"}, {"$inc": {"version": 1}}, upsert=True)
+
+def touch_session(session_id, *resources):
+    session_collection.update_one({"_id": session_id}, changes_update(resources))
+
+def changes_update(resources):
+    return {"$inc": {f"changes.{r}": 1 for r in resources}}
+
+def sessions_version():
+    return (db["counters"].find_one({"_id": "sessions"}) or {}).get("version", 0)
+
+def session_changes(session_id):
+    return (session_collection.find_one({"_id": session_id}, {"changes": 1}) or {}).get("changes", {})
+
+# Buffered chat records reach the collection in batches; their sessions' history changes then
+def history_written(records):
+    session_ids = list({r["session_id"] for r in records})
+    session_collection.update_many({"_id": {"$in": session_ids}}, changes_update(["history"]))
+
+# A response's ETag: the change count of what it lists plus everything in the request that
+# shapes it (page, fields, order). Checked before the list is queried.
+def resource_etag(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()[:32]
+
+def etag_headers(etag):
+    return {"ETag": f'"{etag}"', "Cache-Control": "no-cache"}
+
+# Split a session's document references into shared blobs (by hash) and inline documents.
+# Returns (sources, legacy_ids, unchunked_ids); unchunked documents need store_chunks first.
+def index_sources(refs):
+    sources = {}
+    legacy_ids = []
+    unchunked_ids = []
+    for ref in refs:
+        if ref.get("sha256"):
+            if ref.get("status", "ready") == "ready":
+                sources.setdefault(ref["sha256"], ref)
+            continue
+        # Documents stored before chunking existed are chunked on first use
+        if not ref.get("chunked"):
+            unchunked_ids.append(ref["_id"])
+        legacy_ids.append(ref["_id"])
+    return sources, legacy_ids, unchunked_ids
+
+CHUNK_PROJECTION = {"doc_id": 1, "sha256": 1, "filename": 1, "filetype": 1, "ordinal": 1, "text": 1, "sketch": 1}
+CHUNK_SORT = [("ordinal", 1)]
+
+def chunk_query(sources, legacy_ids):
+    return {"$or": [{"sha256": {"$in": list(sources)}}, {"doc_id": {"$in": legacy_ids}}]}
+
+# One query per document, newest upload first, so text repeated across revisions is indexed
+# under the latest one (see NearDuplicateFilter)
+def index_chunk_queries(refs, sources, legacy_ids):
+    legacy_ids = set(legacy_ids)
+    queries = []
+    seen = set()
+    for ref in sorted(refs, key=lambda r: (r.get("uploaded_at") or datetime.min, str(r["_id"])), reverse=True):
+        if ref.get("sha256") in sources and ref["sha256"] not in seen:
+            seen.add(ref["sha256"])
+            queries.append({"sha256": ref["sha256"]})
+        elif ref["_id"] in legacy_ids:
+            queries.append({"doc_id": ref["_id"]})
+    return queries
+
+def load_session_index(session_id, doc_version=0):
+    key = (session_id, doc_version)
+    index = context_cache.get(key)
+    metrics.CACHE_LOOKUPS.inc(cache="context", result="miss" if index is None else "hit")
+    if index is not None:
+        return index
+
+    refs = list(doc_collection.find({"session_id": session_id}, {"content": 0}))
+    sources, legacy_ids, unchunked_ids = index_sources(refs)
+    for doc_id in unchunked_ids:
+        store_chunks(session_id, doc_collection.find_one({"_id": doc_id}))
+
+    chunks = (
+        chunk
+        for query in index_chunk_queries(refs, sources, legacy_ids)
+        for chunk in chunk_collection.find(query, CHUNK_PROJECTION).sort(CHUNK_SORT)
+    )
+    index = build_index(chunks, sources, legacy_ids)
+    context_cache.put(key, index, index.size_bytes())
+    return index
 
-def extract_text_from_pdf(pdf_file):
-    doc = fitz.open(pdf_file)
-    return "\n".join([page.get_text() for page in doc])
+# chunks may be a cursor: they are indexed as they arrive, and past CONTEXT_TEXT_MB of text
+# only the postings are kept in memory. Text repeated across the session's documents is
+# indexed once, under the first chunk that has it: chunks come newest document first.
+def build_index(chunks, sources, legacy_ids):
+    index = empty_index(sources, legacy_ids)
+    duplicates = NearDuplicateFilter(DEDUP_THRESHOLD, load_chunk_texts)
+    index.add(duplicates.unique(named_chunks(chunks, sources)))
+    finish_index(index, duplicates)
+    return index
 
-def read_excel_to_text(file):
-    df = pd.read_excel(file, engine="openpyxl")
-    return df.to_string(index=False)
+# Kept chunks name the other files their text was found in, for the prompt
+def finish_index(index, duplicates):
+    duplicates.annotate(index.chunks)
+    index.duplicates = duplicates.duplicates
 
-def extract_text_from_docx(docx_file):
-    doc = Document(docx_file)
-    return "\n".join([para.text for para in doc.paragraphs if para.text.strip()])
+def empty_index(sources, legacy_ids):
+    # Same content gives the same fingerprint, whichever session it was uploaded to
+    members = sorted(sources) + sorted(str(i) for i in legacy_ids)
+    fingerprint = hashlib.sha256("\n".join(members).encode()).hexdigest()
+    return BM25Index(fingerprint=fingerprint, text_limit=CONTEXT_TEXT_MAX)
 
-def prepare_local_docs(session_id):
-    doc_content = ""
-    for doc in doc_collection.find({"session_id": session_id}):
-        doc_content += f"[From {doc['filename']} ({doc['filetype']})]\n{doc['content']}\n\n"
-    return doc_content
+# Shared chunks take their file name from this session's reference
+def named_chunks(chunks, sources):
+    for chunk in chunks:
+        ref = sources.get(chunk.get("sha256"))
+        if ref:
+            chunk["filename"] = ref["filename"]
+            chunk["filetype"] = ref["filetype"]
+        yield chunk
 
+# Only the chunks relevant to the question go into the prompt
+def prepare_local_docs(session_id, question, doc_version=0):
+    started = time.perf_counter()
+    index = load_session_index(session_id, doc_version)
+    hits = rank_chunks(index, question)
+    missing = missing_text_ids(hits)
+    if missing:
+        hits = with_texts(hits, load_chunk_texts(missing))
+    return pack_context(index, hits, started)
+
+def rank_chunks(index, question):
+    hits = [chunk for _, chunk in index.search(question, RETRIEVAL_TOP_K)]
+    if not hits:
+        # Nothing matched (e.g. "summarize this"), fall back to the opening chunks
+        hits = index.chunks[:RETRIEVAL_TOP_K]
+    return hits
+
+# A lazy index has no chunk text; these are the chunks whose text must be read from Mongo
+def missing_text_ids(hits):
+    return [c["_id"] for c in hits if "text" not in c]
+
+def load_chunk_texts(ids):
+    return {c["_id"]: c["text"] for c in chunk_collection.find({"_id": {"$in": ids}}, {"text": 1})}
+
+def with_texts(hits, texts):
+    return [c if "text" in c else dict(c, text=texts.get(c["_id"], "")) for c in hits]
+
+# Returns (doc_content, retrieval metadata); started is when loading the index began
+def pack_context(index, hits, started):
+    # Best matches first, cut to the token budget at paragraph boundaries
+    doc_content, packing = pack_chunks(hits, PROMPT_TOKEN_BUDGET, PROMPT_DOC_QUOTA)
+    meta = {
+        "doc_fingerprint": index.fingerprint,
+        "chunks_total": len(index),
+        "chunks_duplicate": index.duplicates,
+        "chunks_used": packing["chunks_packed"],
+        "retrieval_ms": round((time.perf_counter() - started) * 1000, 2),
+        "packing": packing
+    }
+    return doc_content, meta
+
+
+# Paged list responses keep their JSON array shape; the cursor for the next page
+# (passed back as "after") is in the X-Next-Cursor header
+def page_response(items, next_cursor, etag=None):
+    response = jsonify(items)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    if etag:
+        response.headers.update(etag_headers(etag))
+    return response
+
+SESSION_FIELDS = {"session_id": "_id", "description": "description", "mode": "mode", "created_at": "created_at"}
 
 # List all sessions
 @app.route("/sessions", methods=["GET"])
 def list_sessions():
-    sessions = session_collection.find({}, {"_id": 1, "description": 1, "mode": 1, "created_at": 1})
+    try:
+        page = page_params(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    etag = resource_etag("sessions", sessions_version(), page)
+    if etag in request.if_none_match:
+        return "", 304, etag_headers(etag)
+
+    sessions, next_cursor = fetch_page(
+        session_collection, LIVE, "created_at", page, projection_for(page["fields"], SESSION_FIELDS)
+    )
     result = []
     for s in sessions:
-        result.append({
+        created_at = s.get("created_at")
+        result.append(select_fields({
             "session_id": s["_id"],
             "description": s.get("description", ""),
             "mode": "Local" if s.get("mode") == "1" else "Global",
-            "created_at": s.get("created_at").strftime("%Y-%m-%d %H:%M:%S")
-        })
-    return jsonify(result)
+            "created_at": created_at.strftime("%Y-%m-%d %H:%M:%S") if isinstance(created_at, datetime) else ""
+        }, page["fields"]))
+    return page_response(result, next_cursor, etag)
 
 # Start a new session
 @app.route("/start_session", methods=["POST"])
@@ -80,66 +509,84 @@ def start_session():
         "created_at": datetime.now(),
         "mode": mode
     })
+    touch_sessions()
 
     return jsonify({"session_id": session_id, "mode": "Local" if mode == "1" else "Global"})
 
+HISTORY_FIELDS = {"question": "question", "answer": "answer", "timestamp": "timestamp", "mode": "mode", "cached": "cached"}
+
+# Chat history, oldest first by default; "order": "desc" pages back from the newest
 @app.route("/history", methods=["POST"])
 def get_history():
-    data = request.json
+    try:
+        session_id, page, descending = history_params(request.json)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # Records still in the write buffer are included, so a chat shows up here right away
+    pending = chat_writer.pending(session_id=session_id)
+    etag = history_etag(session_id, session_changes(session_id), pending, page, descending)
+    if etag in request.if_none_match:
+        return "", 304, etag_headers(etag)
+
+    history, next_cursor = fetch_page(
+        chat_collection, {"session_id": session_id}, "timestamp", page,
+        projection_for(page["fields"], HISTORY_FIELDS), descending=descending, pending=pending
+    )
+    return page_response([history_item(h, page["fields"]) for h in history], next_cursor, etag)
+
+# This worker's buffered records count too: they are in its pages before the counter moves
+def history_etag(session_id, changes, pending, page, descending):
+    return resource_etag("history", session_id, changes.get("history", 0), [str(r["_id"]) for r in pending], page, descending)
+
+# The /history request as (session_id, page, descending); raises ValueError when invalid
+def history_params(data):
     session_id = data.get("session_id")
     if not session_id:
-        return jsonify({"error": "session_id is required"}), 400
+        raise ValueError("session_id is required")
+    return session_id, page_params(data), data.get("order") == "desc"
 
-    history = chat_collection.find({"session_id": session_id}).sort("timestamp", 1)
-    result = []
-    for h in history:
-        timestamp = h.get("timestamp")
-        result.append({
-            "question": h.get("question", ""),
-            "answer": h.get("answer", ""),
-            "timestamp": timestamp.strftime("%Y-%m-%d %H:%M:%S") if isinstance(timestamp, datetime) else "",
-            "mode": h.get("mode", "unknown")
-        })
-    return jsonify(result)
+def history_item(h, fields):
+    timestamp = h.get("timestamp")
+    return select_fields({
+        "question": h.get("question", ""),
+        "answer": h.get("answer", ""),
+        "timestamp": timestamp.strftime("%Y-%m-%d %H:%M:%S") if isinstance(timestamp, datetime) else "",
+        "mode": h.get("mode", "unknown"),
+        "cached": h.get("cached", False)
+    }, fields)
 
 
-# Chat route
-@app.route("/chat", methods=["POST"])
-def chat():
-    data = request.json
-    session_id = data.get("session_id")
-    user_input = data.get("message", "")
+# Build the system/user messages for a chat turn.
+# Returns (mode_name, messages, retrieval); messages is None when Local mode has no document text.
+def build_messages(session, session_id, user_input):
+    mode_name = session_mode(session)
 
-    # Validate session
-    session = session_collection.find_one({"_id": session_id})
-    if not session:
-        return jsonify({"error": "Invalid session_id"}), 400
+    retrieval = None
+    docs = None
+    if mode_name == "Local":
+        docs, retrieval = prepare_local_docs(session_id, user_input, session.get("doc_version", 0))
+    return mode_name, compose_messages(mode_name, user_input, docs), retrieval
 
+def session_mode(session):
     mode = str(session.get("mode", "2")).lower()
 
 # Normalize to "1"/"2"
     if mode in ["1", "local"]:
-        mode = "1"
-        mode_name = "Local"
-    else:
-        mode = "2"
-        mode_name = "Global"
-
+        return "Local"
+    return "Global"
 
-    if mode == "1":
-        docs = prepare_local_docs(session_id)
+# System and user messages for one turn; None when Local mode has no document text
+def compose_messages(mode_name, user_input, docs=None):
+    if mode_name == "Local":
         #  Check if document content is empty
         if not docs.strip():
-            return jsonify({
-                "session_id": session_id,
-                "user": user_input,
-                "bot": "Document is empty."
-            }), 200
+            return None
 
 
         system_message = (
             
-            "You are an assistant that must only answer using the following document. "
+            "You are an assistant that must only answer using the following document excerpts. "
             "Do not use any external knowledge.\n\n"
             f"{docs}\n\n"
             "Formatting rules (must follow strictly):\n"
@@ -168,49 +615,235 @@ def chat():
             "- If you don't know the answer, say 'I don't have information on that.'"
         )
 
+    from ai21.models.chat import ChatMessage
     messages = [
         ChatMessage(role="system", content=system_message),
         ChatMessage(role="user", content=user_input),
     ]
+    return messages
 
-    try:
-        response = client.chat.completions.create(
-            model="jamba-large-1.7",
-            messages=messages
-        )
-        choice = response.choices[0]
-        answer = None
-        if hasattr(choice, "message"):
-            msg = choice.message
-            if isinstance(msg, dict):
-                answer = msg.get("content")
-            else:
-                answer = getattr(msg, "content", None) or str(msg)
-        elif hasattr(choice, "content"):
-            answer = choice.content
-        elif isinstance(choice, dict) and "content" in choice:
-            answer = choice["content"]
-
-        if not answer or not str(answer).strip():
-            answer = "No response from AI."
+def extract_answer(response):
+    choice = response.choices[0]
+    answer = None
+    if hasattr(choice, "message"):
+        msg = choice.message
+        if isinstance(msg, dict):
+            answer = msg.get("content")
+        else:
+            answer = getattr(msg, "content", None) or str(msg)
+    elif hasattr(choice, "content"):
+        answer = choice.content
+    elif isinstance(choice, dict) and "content" in choice:
+        answer = choice["content"]
 
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    if not answer or not str(answer).strip():
+        answer = "No response from AI."
+    return answer
 
-    # Save chat in DB
-    chat_collection.insert_one({
+def chat_record(session_id, mode_name, user_input, answer, cached=False):
+    return {
         "session_id": session_id,
         "mode": mode_name.lower(),
         "question": user_input,
         "answer": answer,
+        "cached": cached,
         "timestamp": datetime.now()
-    })
+    }
 
-    return jsonify({
+def save_chat(session_id, mode_name, user_input, answer, cached=False):
+    chat_writer.write(chat_record(session_id, mode_name, user_input, answer, cached))
+    # Buffered writes count the change once their batch is written (history_written)
+    if chat_writer.mode == "sync":
+        touch_session(session_id, "history")
+
+def chat_result(session_id, user_input, answer, cached, retrieval):
+    result = {
         "session_id": session_id,
         "user": user_input,
-        "bot": answer
-    })
+        "bot": answer,
+        "cached": cached
+    }
+    if retrieval:
+        result["retrieval"] = retrieval
+    return result
+
+def empty_docs_result(session_id, user_input):
+    return {
+        "session_id": session_id,
+        "user": user_input,
+        "bot": "Document is empty."
+    }
+
+# Same question (ignoring case, spacing and punctuation) against the same documents
+def answer_cache_key(mode_name, user_input, retrieval):
+    question = " ".join(re.findall(r"\w+", user_input.lower()))
+    fingerprint = retrieval["doc_fingerprint"] if retrieval else ""
+    return hashlib.sha256(f"{mode_name}\n{fingerprint}\n{question}".encode()).hexdigest()
+
+def cached_answer(mode_name, user_input, retrieval):
+    if answer_cache is None:
+        return None, None
+    key = answer_cache_key(mode_name, user_input, retrieval)
+    answer = answer_cache.get(key)
+    metrics.CACHE_LOOKUPS.inc(cache="answer", result="miss" if answer is None else "hit")
+    return key, answer
+
+def count_prompt(mode_name, messages):
+    metrics.PROMPT_TOKENS.observe(sum(estimate_tokens(m.content) for m in messages), mode=mode_name)
+
+def count_llm_error(e):
+    metrics.LLM_ERRORS.inc(error=type(e).__name__)
+
+def remember_answer(key, answer):
+    if answer_cache is not None and answer != "No response from AI.":
+        answer_cache.put(key, answer)
+
+# Chat route
+@app.route("/chat", methods=["POST"])
+def chat():
+    data = request.json
+    session_id = data.get("session_id")
+    user_input = data.get("message", "")
+
+    # Validate session
+    with phase("session"):
+        session = session_collection.find_one(dict(LIVE, _id=session_id))
+    if not session:
+        return jsonify({"error": "Invalid session_id"}), 400
+
+    if data.get("stream"):
+        return stream_chat(session, session_id, user_input)
+
+    with phase("context"):
+        mode_name, messages, retrieval = build_messages(session, session_id, user_input)
+    if messages is None:
+        return jsonify(empty_docs_result(session_id, user_input)), 200
+
+    with phase("answer_cache"):
+        cache_key, answer = cached_answer(mode_name, user_input, retrieval)
+    cached = answer is not None
+    if not cached:
+        count_prompt(mode_name, messages)
+        try:
+            with phase("llm"):
+                response = llm.complete(messages)
+            answer = extract_answer(response)
+        except GatewayError as e:
+            count_llm_error(e)
+            return gateway_error_response(e)
+        except Exception as e:
+            count_llm_error(e)
+            return jsonify({"error": str(e)}), 500
+        remember_answer(cache_key, answer)
+
+    # Save chat in DB
+    with phase("save"):
+        save_chat(session_id, mode_name, user_input, answer, cached)
+    return jsonify(chat_result(session_id, user_input, answer, cached, retrieval))
+
+# Overload, rate limiting and timeouts are reported with their own status and a retry hint
+def gateway_error_response(e):
+    headers = {"Retry-After": str(e.retry_after)} if e.retry_after else {}
+    return {"error": str(e)}, e.status, headers
+
+def sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+def stream_meta(session_id, user_input, retrieval):
+    meta = {"session_id": session_id, "user": user_input}
+    if retrieval:
+        meta["retrieval"] = retrieval
+    return meta
+
+def chunk_delta(chunk):
+    return chunk.choices[0].delta.content if chunk.choices else None
+
+def streamed_answer(parts):
+    full_answer = "".join(parts)
+    return full_answer if full_answer.strip() else "No response from AI."
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+# Streaming chat: tokens are forwarded as server-sent events as the model produces them,
+# the full answer is saved once the stream completes
+def stream_chat(session, session_id, user_input):
+    with phase("context"):
+        mode_name, messages, retrieval = build_messages(session, session_id, user_input)
+    meta = stream_meta(session_id, user_input, retrieval)
+
+    cache_key, answer = None, None
+    if messages is not None:
+        with phase("answer_cache"):
+            cache_key, answer = cached_answer(mode_name, user_input, retrieval)
+
+    # The model stream is opened before responding so overload still gets a proper status
+    stream = None
+    if messages is not None and answer is None:
+        count_prompt(mode_name, messages)
+        try:
+            with phase("llm_open"):
+                stream = llm.stream(messages)
+        except GatewayError as e:
+            count_llm_error(e)
+            return gateway_error_response(e)
+        except Exception as e:
+            count_llm_error(e)
+            return jsonify({"error": str(e)}), 500
+    # The body is sent after the request hooks have run, so its timing is recorded here
+    timings = metrics.current()
+
+    def generate():
+        yield sse_event("meta", meta)
+
+        if messages is None:
+            yield sse_event("done", {"bot": "Document is empty."})
+            return
+
+        if stream is None:
+            save_chat(session_id, mode_name, user_input, answer, cached=True)
+            yield sse_event("token", {"text": answer})
+            yield sse_event("done", {"bot": answer, "cached": True})
+            return
+
+        parts = []
+        started = time.perf_counter()
+        try:
+            for chunk in stream:
+                delta = chunk_delta(chunk)
+                if delta:
+                    parts.append(delta)
+                    yield sse_event("token", {"text": delta})
+        except Exception as e:
+            count_llm_error(e)
+            yield sse_event("error", {"error": str(e)})
+            return
+        finally:
+            stream.close()
+            metrics.record_phase("llm_stream", time.perf_counter() - started, timings)
+
+        full_answer = streamed_answer(parts)
+        remember_answer(cache_key, full_answer)
+        save_chat(session_id, mode_name, user_input, full_answer)
+        yield sse_event("done", {"bot": full_answer, "cached": False})
+
+    response = Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers=SSE_HEADERS
+    )
+    # Frees the model slot even if the client goes away before the body is sent
+    if stream is not None:
+        response.call_on_close(stream.close)
+    return response
+
+@app.route("/chat/stream", methods=["POST"])
+def chat_stream():
+    data = request.json
+    session_id = data.get("session_id")
+    session = session_collection.find_one(dict(LIVE, _id=session_id))
+    if not session:
+        return jsonify({"error": "Invalid session_id"}), 400
+    return stream_chat(session, session_id, data.get("message", ""))
 
 #switch mode route
 from bson import ObjectId
@@ -237,6 +870,7 @@ def switch_mode():
 
     if result.matched_count == 0:
         return jsonify({"error": "Session not found"}), 404
+    touch_sessions()
 
     return jsonify({
         "session_id": session_id,
@@ -244,70 +878,287 @@ def switch_mode():
     }), 200
 
 
-# Upload documents
+# Upload documents: files are stored in GridFS and extracted in the background
 @app.route("/upload", methods=["POST"])
 def upload_documents():
     session_id = request.form.get("session_id")
     files = request.files.getlist("files")
     if not session_id or not files:
         return jsonify({"error": "session_id and files are required"}), 400
+    with phase("session"):
+        session = session_collection.find_one(dict(LIVE, _id=session_id), {"_id": 1})
+    if not session:
+        return jsonify({"error": "Session not found"}), 404
 
     uploaded_files = []
     skipped_files = []
+    pending = {}
 
     for file in files:
-        filename = secure_filename(file.filename)
-        existing = fs.find_one({"filename": filename, "session_id": session_id})
+        filename, filetype = upload_name(file)
+        with phase("db"):
+            existing = doc_collection.find_one({"session_id": session_id, "filename": filename}, {"_id": 1})
         if existing:
             skipped_files.append(filename)
             continue
 
-        filetype = filename.split(".")[-1].lower()
+        # Save file in GridFS, or take another reference to identical content
+        blob = store_upload(file, filename, filetype)
+        if blob is None:
+            skipped_files.append(filename)
+            continue
+        blob_id, sha256, length = blob
+        metrics.UPLOAD_BYTES.observe(length, filetype=filetype)
+
+        # Content seen before has its text already, only new content is extracted
+        with phase("db"):
+            ready = text_collection.find_one({"_id": sha256}, {"_id": 1}) is not None
+            doc = document_ref(session_id, filename, filetype, blob, ready)
+            doc_collection.insert_one(doc)
+        add_upload_entry(uploaded_files, pending, doc, ready)
+
+    job = upload_job(session_id, uploaded_files, skipped_files, pending)
+    with phase("db"):
+        if job["completed"]:
+            bump_doc_version(session_id)
+        elif uploaded_files:
+            touch_session(session_id, "documents")
+        upload_jobs.insert_one(job)
+    with phase("queue"):
+        queue_extractions(job["_id"], pending)
+    return jsonify(upload_result(job, pending)), 202
+
+def upload_name(file):
+    filename = secure_filename(file.filename)
+    return filename, filename.split(".")[-1].lower()
+
+# First pass over a spooled upload: (sha256, size), or None if it is over the size limit
+def hash_upload(file):
+    digest = hashlib.sha256()
+    size = 0
+    file.stream.seek(0)
+    while True:
+        chunk = file.stream.read(UPLOAD_CHUNK_BYTES)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > MAX_UPLOAD_BYTES:
+            return None
+        digest.update(chunk)
+    return digest.hexdigest(), size
+
+def blob_metadata(filename, filetype, sha256):
+    return {"filename": filename, "filetype": filetype, "sha256": sha256, "refcount": 1, "uploaded_at": datetime.now()}
+
+# Store an upload under the SHA-256 of its content; returns (blob_id, sha256, length),
+# or None if it is over the size limit
+def store_upload(file, filename, filetype):
+    # Hashing first means identical content is never written twice
+    with phase("hash"):
+        hashed = hash_upload(file)
+    if hashed is None:
+        return None
+    sha256, size = hashed
+
+    with phase("gridfs"):
+        existing = db.fs.files.find_one_and_update(
+            {"sha256": sha256}, {"$inc": {"refcount": 1}}, projection={"_id": 1}
+        )
+        if existing:
+            return existing["_id"], sha256, size
+
+        grid_in = fs.new_file(**blob_metadata(filename, filetype, sha256))
+        file.stream.seek(0)
+        while True:
+            chunk = file.stream.read(UPLOAD_CHUNK_BYTES)
+            if not chunk:
+                break
+            grid_in.write(chunk)
+        grid_in.close()
+    return grid_in._id, sha256, size
 
-        # Save file in GridFS
-        file.seek(0)
-        file_id = fs.put(
-            file,
-            filename=filename,
-            filetype=filetype,
-            session_id=session_id,
-            uploaded_at=datetime.now()
+# This session's reference to a stored blob
+def document_ref(session_id, filename, filetype, blob, ready):
+    blob_id, sha256, length = blob
+    return {
+        "session_id": session_id,
+        "filename": filename,
+        "filetype": filetype,
+        "gridfs_id": blob_id,
+        "sha256": sha256,
+        "length": length,
+        "status": "ready" if ready else "processing",
+        "uploaded_at": datetime.now()
+    }
+
+# Record an inserted reference in the job; blobs still to extract are grouped by hash
+def add_upload_entry(uploaded_files, pending, doc, ready):
+    entry = {
+        "file_id": str(doc["_id"]),
+        "filename": doc["filename"],
+        "filetype": doc["filetype"],
+        "status": "done" if ready else "queued"
+    }
+    uploaded_files.append(entry)
+    if not ready:
+        pending.setdefault(doc["sha256"], (str(doc["gridfs_id"]), doc["filetype"], []))[2].append(entry)
+
+def upload_job(session_id, uploaded_files, skipped_files, pending):
+    return {
+        "_id": str(uuid.uuid4()),
+        "session_id": session_id,
+        "status": "processing" if pending else "done",
+        "total": len(uploaded_files),
+        "completed": sum(1 for f in uploaded_files if f["status"] == "done"),
+        # Keyed by file id so each file's progress can be updated in place
+        "files": {f["file_id"]: f for f in uploaded_files},
+        "skipped_files": skipped_files,
+        "created_at": datetime.now()
+    }
+
+def queue_extractions(job_id, pending):
+    pool = get_ingest_pool()
+    for sha256, (blob_id, filetype, entries) in pending.items():
+        staging_id = str(uuid.uuid4())
+        future = pool.submit(ingest.extract_file, blob_id, filetype, staging_id, CHUNK_CHARS, SPREADSHEET_MAX_ROWS)
+        future.add_done_callback(
+            lambda f, sha256=sha256, filetype=filetype, entries=entries, staging_id=staging_id,
+                   queued=time.perf_counter():
+                finish_extraction(job_id, sha256, filetype, entries, f, staging_id, queued)
+        )
+
+def upload_result(job, pending):
+    uploaded_files = list(job["files"].values())
+    return {
+        "job_id": job["_id"],
+        "message": f"{len(uploaded_files)} files uploaded, {sum(len(p[2]) for p in pending.values())} queued for processing",
+        "files": [{"file_id": f["file_id"], "filename": f["filename"]} for f in uploaded_files],
+        "skipped_files": job["skipped_files"]
+    }
+
+# Called in this process when a pool worker finishes extracting one blob
+def finish_extraction(job_id, sha256, filetype, entries, future, staging_id, queued=None):
+    error = None
+    try:
+        summary = future.result()
+    except Exception as e:
+        error = f"Error extracting text: {e}"
+    if queued is not None:
+        metrics.EXTRACTION_SECONDS.observe(
+            time.perf_counter() - queued, filetype=filetype, result="error" if error else "ok"
         )
-        file.seek(0)
+    if not error:
+        metrics.EXTRACTED_CHARS.observe(summary["chars"], filetype=filetype)
 
-        content = ""
+    # A done-callback's exceptions are dropped by the pool, so a failure here is recorded
+    # on the documents and the job instead of leaving them processing
+    try:
+        # Every reference may have been deleted while the file was being parsed
+        if not error and db.fs.files.find_one({"sha256": sha256}, {"_id": 1}):
+            store_blob_text(sha256, filetype, staging_id, summary)
+        else:
+            discard_staging(staging_id)
+    except Exception as e:
+        app.logger.exception("Storing the text extracted from %s failed", sha256)
+        error = f"Error storing extracted text: {e}"
         try:
-            if filetype == "pdf":
-                pdf_bytes = file.read()
-                doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-                content = "\n".join([page.get_text() for page in doc])
-            elif filetype in ["docx", "doc"]:
-                content = extract_text_from_docx(file)
-            elif filetype in ["xls", "xlsx"]:
-                content = read_excel_to_text(file)
-            elif filetype == "txt":
-                content = file.read().decode("utf-8")
-        except Exception as e:
-            content = f"Error extracting text: {str(e)}"
+            discard_staging(staging_id)
+        except Exception:
+            pass
+    try:
+        settle_extraction(job_id, sha256, entries, error)
+    except Exception:
+        # Left processing; the next worker to start queues it again (recover_extractions)
+        app.logger.exception("Recording the extraction of %s failed", sha256)
 
-        # Store text content in documents collection
-        doc_collection.insert_one({
-            "session_id": session_id,
-            "filename": filename,
-            "filetype": filetype,
-            "content": content,
-            "uploaded_at": datetime.now(),
-            "gridfs_id": file_id
-        })
+def settle_extraction(job_id, sha256, entries, error):
+    # Other sessions may be waiting on the same content
+    waiting = {"sha256": sha256, "status": "processing"}
+    session_ids = doc_collection.distinct("session_id", waiting)
+    doc_collection.update_many(waiting, {"$set": {"status": "error" if error else "ready", "error": error}})
+    for session_id in session_ids:
+        bump_doc_version(session_id)
+    settle_upload_entries(job_id, entries, error)
+
+# Each entry is counted once, also when an extraction queued again by recover_extractions
+# finishes after the original
+def settle_upload_entries(job_id, entries, error):
+    for entry in entries:
+        key = f"files.{entry['file_id']}"
+        upload_jobs.update_one(
+            {"_id": job_id, f"{key}.status": "queued"},
+            {"$set": {f"{key}.status": "error" if error else "done", f"{key}.error": error}, "$inc": {"completed": 1}}
+        )
+    job = upload_jobs.find_one({"_id": job_id}, {"completed": 1, "total": 1})
+    if job and job["completed"] >= job["total"]:
+        upload_jobs.update_one(
+            {"_id": job_id, "status": "processing"}, {"$set": {"status": "done", "finished_at": datetime.now()}}
+        )
 
-        uploaded_files.append({"file_id": str(file_id), "filename": filename})
+# Extractions only live in the pool of the process that queued them. A worker starting up
+# queues again the files of upload jobs still processing from before it started, claiming
+# each job first so workers starting together don't all take it. A job whose worker is still
+# running is then extracted twice; the first copy stored is kept (store_blob_text).
+def recover_extractions():
+    started = datetime.now()
+    try:
+        while True:
+            job = upload_jobs.find_one_and_update(
+                {"status": "processing", "created_at": {"$lt": started},
+                 "$or": [{"recovered_at": {"$exists": False}}, {"recovered_at": {"$lt": started}}]},
+                {"$set": {"recovered_at": started}}
+            )
+            if job is None:
+                return
+            requeue_upload_job(job)
+    except Exception:
+        app.logger.exception("Queueing unfinished extractions again failed")
+
+def requeue_upload_job(job):
+    entries = [f for f in job["files"].values() if f["status"] == "queued"]
+    docs = {
+        str(doc["_id"]): doc
+        for doc in doc_collection.find(
+            {"_id": {"$in": [ObjectId(f["file_id"]) for f in entries]}},
+            {"sha256": 1, "gridfs_id": 1, "filetype": 1, "status": 1, "error": 1}
+        )
+    }
+    pending = {}
+    for entry in entries:
+        doc = docs.get(entry["file_id"])
+        if doc is None:
+            settle_upload_entries(job["_id"], [entry], "Document deleted before its text was extracted")
+        elif doc["status"] != "processing":
+            settle_upload_entries(job["_id"], [entry], doc.get("error"))
+        else:
+            pending.setdefault(doc["sha256"], (str(doc["gridfs_id"]), doc["filetype"], []))[2].append(entry)
+    if pending:
+        queue_extractions(job["_id"], pending)
+
+# Progress of a background upload job
+@app.route("/upload_status/<job_id>", methods=["GET"])
+def upload_status(job_id):
+    job = upload_jobs.find_one({"_id": job_id})
+    if not job:
+        return jsonify({"error": "Unknown job_id"}), 404
 
     return jsonify({
-        "message": f"{len(uploaded_files)} files uploaded successfully",
-        "files": uploaded_files,
-        "skipped_files": skipped_files
+        "job_id": job["_id"],
+        "session_id": job["session_id"],
+        "status": job["status"],
+        "total": job["total"],
+        "completed": job["completed"],
+        "files": [
+            {"file_id": f["file_id"], "filename": f["filename"], "status": f["status"], "error": f.get("error")}
+            for f in job["files"].values()
+        ],
+        "skipped_files": job.get("skipped_files", [])
     })
 
+DOCUMENT_FIELDS = {
+    "file_id": "_id", "filename": "filename", "length": "length", "status": "status", "upload_date": "uploaded_at"
+}
+
 # List documents for a session
 @app.route("/documents", methods=["POST"])
 def list_documents():
@@ -317,23 +1168,143 @@ def list_documents():
         return jsonify({"error": "session_id is required"}), 400
 
     try:
-        # Fetch files from GridFS for this session
-        files = fs.find({"session_id": session_id})
+        page = page_params(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    etag = resource_etag("documents", session_id, session_changes(session_id).get("documents", 0), page)
+    if etag in request.if_none_match:
+        return "", 304, etag_headers(etag)
+
+    try:
+        projection = projection_for(page["fields"], DOCUMENT_FIELDS)
+        if "length" in projection:
+            projection["gridfs_id"] = 1
+        docs, next_cursor = fetch_page(doc_collection, {"session_id": session_id}, "uploaded_at", page, projection)
+
+        # Older documents do not record their size, look it up from GridFS in one query
+        missing = []
+        if "length" in projection:
+            missing = [d["gridfs_id"] for d in docs if "length" not in d and d.get("gridfs_id")]
+        lengths = {}
+        if missing:
+            lengths = {f["_id"]: f["length"] for f in db.fs.files.find({"_id": {"$in": missing}}, {"length": 1})}
 
         result = []
-        for f in files:
-            result.append({
-                "file_id": str(f._id),
-                "filename": f.filename or "Unnamed File",
-                "length": f.length,
-                "upload_date": f.upload_date.strftime("%Y-%m-%d %H:%M:%S")
-            })
-
-        print(f"Documents for session {session_id}: {[f.filename for f in files]}")  # debug
-        return jsonify(result)
+        for d in docs:
+            uploaded_at = d.get("uploaded_at")
+            result.append(select_fields({
+                "file_id": str(d["_id"]),
+                "filename": d.get("filename") or "Unnamed File",
+                "length": d.get("length", lengths.get(d.get("gridfs_id"), 0)),
+                "status": d.get("status", "ready"),
+                "upload_date": uploaded_at.strftime("%Y-%m-%d %H:%M:%S") if isinstance(uploaded_at, datetime) else ""
+            }, page["fields"]))
+
+        return page_response(result, next_cursor, etag)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+SEARCH_TYPES = ("documents", "chats")
+
+# Full-text search over document text and chat questions and answers, best match first.
+# GET /search?q=...&session_id=...&type=documents,chats&limit=20
+@app.route("/search", methods=["GET"])
+def search():
+    terms = (request.args.get("q") or "").strip()
+    if not tokenize(terms):
+        return jsonify({"error": "q must contain at least one search term"}), 400
+    try:
+        limit = int(request.args.get("limit") or SEARCH_DEFAULT_LIMIT)
+    except ValueError:
+        return jsonify({"error": "limit must be a number"}), 400
+    limit = min(max(limit, 1), SEARCH_MAX_LIMIT)
+    session_id = request.args.get("session_id") or None
+    types = [t.strip() for t in (request.args.get("type") or ",".join(SEARCH_TYPES)).split(",")]
+    if not set(types) <= set(SEARCH_TYPES):
+        return jsonify({"error": f"type must be one or more of {', '.join(SEARCH_TYPES)}"}), 400
+
+    results = []
+    if "documents" in types:
+        with phase("documents"):
+            results += search_documents(terms, session_id, limit)
+    if "chats" in types:
+        with phase("chats"):
+            results += search_chats(terms, session_id, limit)
+    with phase("sessions"):
+        results = live_results(results)
+    results.sort(key=lambda r: r["score"], reverse=True)
+    return jsonify({"query": terms, "results": results[:limit]})
+
+# Matching chunks, one result per document reference that uses them, plus documents stored
+# inline before chunking that have not been chunked yet
+def search_documents(terms, session_id, limit):
+    chunk_filter = {}
+    legacy_filter = {"chunked": {"$ne": True}}
+    if session_id:
+        sources, legacy_ids, _ = index_sources(doc_collection.find({"session_id": session_id}, {"content": 0}))
+        chunk_filter = chunk_query(sources, legacy_ids)
+        legacy_filter["session_id"] = session_id
+    chunks = text_search(chunk_collection, terms, chunk_filter, {"sha256": 1, "doc_id": 1, "ordinal": 1, "text": 1}, limit)
+
+    # Shared chunks are stored once per content hash; the references give session and file name
+    hashes = list({c["sha256"] for c in chunks if c.get("sha256")})
+    doc_ids = [c["doc_id"] for c in chunks if c.get("doc_id")]
+    ref_query = {"$or": [{"sha256": {"$in": hashes}}, {"_id": {"$in": doc_ids}}]}
+    if session_id:
+        ref_query = {"$and": [ref_query, {"session_id": session_id}]}
+    refs_by_source = {}
+    if hashes or doc_ids:
+        for ref in doc_collection.find(ref_query, {"session_id": 1, "filename": 1, "sha256": 1}):
+            refs_by_source.setdefault(ref.get("sha256") or ref["_id"], []).append(ref)
+
+    results = []
+    for chunk in chunks:
+        for ref in refs_by_source.get(chunk.get("sha256") or chunk.get("doc_id"), []):
+            results.append(document_hit(ref, chunk["score"], snippet(chunk["text"], terms), chunk.get("ordinal")))
+
+    for doc in text_search(doc_collection, terms, legacy_filter, {"session_id": 1, "filename": 1, "content": 1}, limit):
+        results.append(document_hit(doc, doc["score"], snippet(doc.get("content", ""), terms)))
+    return results
+
+def document_hit(ref, score, text, chunk=None):
+    return {
+        "type": "document",
+        "score": round(score, 4),
+        "session_id": ref["session_id"],
+        "document_id": str(ref["_id"]),
+        "filename": ref.get("filename") or "Unnamed File",
+        "chunk": chunk,
+        "snippet": text
+    }
+
+def search_chats(terms, session_id, limit):
+    query = {"session_id": session_id} if session_id else {}
+    chats = text_search(chat_collection, terms, query, {"session_id": 1, "question": 1, "answer": 1, "timestamp": 1}, limit)
+    results = []
+    for h in chats:
+        timestamp = h.get("timestamp")
+        results.append({
+            "type": "chat",
+            "score": round(h["score"], 4),
+            "session_id": h["session_id"],
+            "chat_id": str(h["_id"]),
+            "question": h.get("question", ""),
+            "snippet": snippet(f"{h.get('question', '')}\n{h.get('answer', '')}", terms),
+            "timestamp": timestamp.strftime("%Y-%m-%d %H:%M:%S") if isinstance(timestamp, datetime) else ""
+        })
+    return results
+
+# Drop hits from sessions that have been deleted but not yet collected
+def live_results(results):
+    ids = {r["session_id"] for r in results}
+    if not ids:
+        return results
+    # Sessions created before string ids were used are stored under ObjectIds
+    candidates = list(ids) + [ObjectId(i) for i in ids if isinstance(i, str) and ObjectId.is_valid(i)]
+    live = {str(s["_id"]) for s in session_collection.find(dict(LIVE, _id={"$in": candidates}), {"_id": 1})}
+    return [r for r in results if str(r["session_id"]) in live]
+
 #delete documents
 @app.route("/delete_document/<file_id>", methods=["DELETE"])
 def delete_document(file_id):
@@ -341,33 +1312,59 @@ def delete_document(file_id):
         # Convert to ObjectId
         obj_id = ObjectId(file_id)
 
-        # Find file in GridFS
-        file = fs.get(obj_id)
-        filename = file.filename
-
-        # Delete from GridFS
-        fs.delete(obj_id)
+        # Remove this session's reference; the blob goes with its last reference
+        doc = doc_collection.find_one_and_delete({"_id": obj_id})
+        if not doc:
+            return jsonify({"error": "Document not found"}), 404
 
-        # Delete text content from documents collection
-        doc_collection.delete_one({"gridfs_id": obj_id})
+        if doc.get("gridfs_id"):
+            release_blob(doc["gridfs_id"])
+        if not doc.get("sha256"):
+            chunk_collection.delete_many({"doc_id": doc["_id"]})
+        bump_doc_version(doc["session_id"])
 
-        return jsonify({"message": f"Document '{filename}' deleted successfully"})
+        return jsonify({"message": f"Document '{doc['filename']}' deleted successfully"})
     except Exception as e:
         return jsonify({"error": str(e)}), 400
+# Context cache counters, to confirm Local mode is served from memory
+@app.route("/cache_stats", methods=["GET"])
+def cache_stats():
+    return jsonify({
+        "context": context_cache.stats(),
+        "answers": answer_cache.stats() if answer_cache is not None else None,
+        "chat_writes": chat_writer.stats()
+    })
+
 # Home route
 @app.route("/", methods=["GET"])
 def home():
     return render_template("index.html")
 
-# Delete session
+# Delete session: hidden at once, its data removed in the background (see /delete_status)
 @app.route("/delete_session/<session_id>", methods=["DELETE"])
 def delete_session(session_id):
-    chat_collection.delete_many({"session_id": session_id})
-    doc_collection.delete_many({"session_id": session_id})
-    for f in fs.find({"session_id": session_id}):
-        fs.delete(f._id)
-    session_collection.delete_one({"_id": session_id})  # keep as string
-    return jsonify({"message": "Session deleted successfully"})
+    job_id = deletion_collector.delete_session(session_id)
+    touch_sessions()
+    chat_writer.discard(session_id=session_id)
+    forget_session_context(session_id)
+    return jsonify({"message": "Session deleted successfully", "job_id": job_id}), 202
+
+@app.route("/delete_status/<job_id>", methods=["GET"])
+def delete_status(job_id):
+    job = db["deletion_jobs"].find_one({"_id": job_id})
+    if not job:
+        return jsonify({"error": "Unknown job_id"}), 404
+
+    finished_at = job.get("finished_at")
+    return jsonify({
+        "job_id": job["_id"],
+        "session_id": job["session_id"],
+        "status": job["status"],
+        "phase": job.get("phase"),
+        "removed": job.get("removed", {}),
+        "error": job.get("error"),
+        "finished_at": finished_at.strftime("%Y-%m-%d %H:%M:%S") if isinstance(finished_at, datetime) else None
+    })
 
 # Run app
 if __name__ == "__main__":
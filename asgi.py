@@ -0,0 +1,367 @@
+# Async serving mode: /chat, /chat/stream, /history and /upload run as async handlers on
+# pymongo's AsyncMongoClient and AsyncAI21Client, so one worker can hold many requests that
+# are waiting on the model or Mongo. Every other route is the Flask app, unchanged. With the
+# SQLite backend (storage.py) the database calls run in worker threads instead.
+#
+#   hypercorn asgi:app          (async mode)
+#   python app.py               (sync mode, as before)
+#
+# The handlers here only do the awaiting; building messages, records and responses is
+# the same code app.py uses.
+import asyncio
+import time
+
+from asgiref.wsgi import WsgiToAsgi
+from quart import Quart, Response, request
+
+import app as core
+import metrics
+from llm import AsyncLLMGateway, GatewayError
+from metrics import phase
+from pagination import afetch_page, projection_for
+
+ASYNC_PATHS = {"/chat", "/chat/stream", "/history", "/upload"}
+# Chunks handed to the index builder thread at a time
+INDEX_BATCH = 500
+
+quart_app = Quart(__name__)
+quart_app.config["MAX_CONTENT_LENGTH"] = core.MAX_UPLOAD_BYTES
+
+# Created once the event loop is running (see start), one set per worker process
+close_storage = None
+db = None
+fs = None
+llm = None
+
+
+@quart_app.before_serving
+async def start():
+    global close_storage, db, fs, llm
+    from ai21 import AsyncAI21Client
+    db, fs, close_storage = core.storage.open_async()
+    llm = AsyncLLMGateway(
+        AsyncAI21Client(api_key=core.api_key, timeout_sec=core.LLM_TIMEOUT),
+        model=core.llm.model,
+        max_concurrency=core.llm.max_concurrency,
+        queue_timeout=core.llm.queue_timeout,
+        deadline=core.llm.deadline,
+        max_retries=core.llm.max_retries,
+        attempt_timeout=core.llm.attempt_timeout,
+        min_attempt=core.llm.min_attempt
+    )
+    await asyncio.to_thread(core.start_worker)
+
+@quart_app.after_serving
+async def stop():
+    await asyncio.to_thread(core.chat_writer.close)
+    await close_storage()
+
+@quart_app.before_request
+async def start_timing():
+    metrics.start_request(core.route_label(request.url_rule))
+
+@quart_app.after_request
+async def finish_timing(response):
+    server_timing = metrics.finish_request(request.method, response.status_code)
+    if core.SERVER_TIMING and server_timing:
+        response.headers["Server-Timing"] = server_timing
+    return response
+
+@quart_app.errorhandler(413)
+async def upload_too_large(e):
+    return core.upload_too_large(e)
+
+
+async def bump_doc_version(session_id):
+    await db["chat_sessions"].update_one({"_id": session_id}, {"$inc": {"doc_version": 1, "changes.documents": 1}})
+    core.forget_session_context(session_id)
+
+async def load_session_index(session_id, doc_version=0):
+    key = (session_id, doc_version)
+    index = core.context_cache.get(key)
+    metrics.CACHE_LOOKUPS.inc(cache="context", result="miss" if index is None else "hit")
+    if index is not None:
+        return index
+
+    documents = db["documents"]
+    chunks = db["document_chunks"]
+    refs = await documents.find({"session_id": session_id}, {"content": 0}).to_list(None)
+    sources, legacy_ids, unchunked_ids = core.index_sources(refs)
+    for doc_id in unchunked_ids:
+        records = core.chunk_records(session_id, await documents.find_one({"_id": doc_id}))
+        if records:
+            await chunks.insert_many(records)
+        await documents.update_one({"_id": doc_id}, {"$set": {"chunked": True}})
+
+    # Indexing is CPU work and runs in a thread, one batch of chunks at a time as they arrive
+    index = core.empty_index(sources, legacy_ids)
+    # Runs in the indexing thread, so kept chunks are read back with the synchronous client
+    duplicates = core.NearDuplicateFilter(core.DEDUP_THRESHOLD, core.load_chunk_texts)
+    batch = []
+    for query in core.index_chunk_queries(refs, sources, legacy_ids):
+        async for chunk in chunks.find(query, core.CHUNK_PROJECTION).sort(core.CHUNK_SORT):
+            batch.append(chunk)
+            if len(batch) >= INDEX_BATCH:
+                await asyncio.to_thread(index.add, duplicates.unique(core.named_chunks(batch, sources)))
+                batch = []
+    await asyncio.to_thread(index.add, duplicates.unique(core.named_chunks(batch, sources)))
+    core.finish_index(index, duplicates)
+    core.context_cache.put(key, index, index.size_bytes())
+    return index
+
+async def build_messages(session, session_id, user_input):
+    mode_name = core.session_mode(session)
+
+    retrieval = None
+    docs = None
+    if mode_name == "Local":
+        started = time.perf_counter()
+        index = await load_session_index(session_id, session.get("doc_version", 0))
+        hits = core.rank_chunks(index, user_input)
+        missing = core.missing_text_ids(hits)
+        if missing:
+            found = await db["document_chunks"].find({"_id": {"$in": missing}}, {"text": 1}).to_list(None)
+            hits = core.with_texts(hits, {c["_id"]: c["text"] for c in found})
+        docs, retrieval = core.pack_context(index, hits, started)
+    return mode_name, core.compose_messages(mode_name, user_input, docs), retrieval
+
+# The Mongo answer cache is synchronous; run it in a thread rather than block the loop
+async def answer_cache_call(fn, *args):
+    if core.answer_cache is not None and core.answer_cache.backend == "mongo":
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args)
+
+# Buffered modes share app.py's write-behind buffer; a batched write is waited for in a thread
+async def save_chat(session_id, mode_name, user_input, answer, cached=False):
+    record = core.chat_record(session_id, mode_name, user_input, answer, cached)
+    if core.chat_writer.mode == "sync":
+        await db["btech_conversations"].insert_one(record)
+        await db["chat_sessions"].update_one({"_id": session_id}, core.changes_update(["history"]))
+        return
+    ticket = core.chat_writer.add(record)
+    if core.chat_writer.mode == "batched":
+        await asyncio.to_thread(ticket.wait, core.chat_writer.wait_timeout)
+
+async def find_session(data):
+    return await db["chat_sessions"].find_one(dict(core.LIVE, _id=data.get("session_id")))
+
+
+@quart_app.route("/history", methods=["POST"])
+async def get_history():
+    try:
+        session_id, page, descending = core.history_params(await request.get_json())
+    except ValueError as e:
+        return {"error": str(e)}, 400
+
+    pending = core.chat_writer.pending(session_id=session_id)
+    session = await db["chat_sessions"].find_one({"_id": session_id}, {"changes": 1})
+    etag = core.history_etag(session_id, (session or {}).get("changes", {}), pending, page, descending)
+    if etag in request.if_none_match:
+        return "", 304, core.etag_headers(etag)
+
+    history, next_cursor = await afetch_page(
+        db["btech_conversations"], {"session_id": session_id}, "timestamp", page,
+        projection_for(page["fields"], core.HISTORY_FIELDS), descending=descending, pending=pending
+    )
+    headers = core.etag_headers(etag)
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    return [core.history_item(h, page["fields"]) for h in history], 200, headers
+
+
+@quart_app.route("/chat", methods=["POST"])
+async def chat():
+    data = await request.get_json()
+    session_id = data.get("session_id")
+    user_input = data.get("message", "")
+
+    with phase("session"):
+        session = await find_session(data)
+    if not session:
+        return {"error": "Invalid session_id"}, 400
+
+    if data.get("stream"):
+        return await stream_chat(session, session_id, user_input)
+
+    with phase("context"):
+        mode_name, messages, retrieval = await build_messages(session, session_id, user_input)
+    if messages is None:
+        return core.empty_docs_result(session_id, user_input), 200
+
+    with phase("answer_cache"):
+        cache_key, answer = await answer_cache_call(core.cached_answer, mode_name, user_input, retrieval)
+    cached = answer is not None
+    if not cached:
+        core.count_prompt(mode_name, messages)
+        try:
+            with phase("llm"):
+                response = await llm.complete(messages)
+            answer = core.extract_answer(response)
+        except GatewayError as e:
+            core.count_llm_error(e)
+            return core.gateway_error_response(e)
+        except Exception as e:
+            core.count_llm_error(e)
+            return {"error": str(e)}, 500
+        await answer_cache_call(core.remember_answer, cache_key, answer)
+
+    with phase("save"):
+        await save_chat(session_id, mode_name, user_input, answer, cached)
+    return core.chat_result(session_id, user_input, answer, cached, retrieval)
+
+async def stream_chat(session, session_id, user_input):
+    with phase("context"):
+        mode_name, messages, retrieval = await build_messages(session, session_id, user_input)
+    meta = core.stream_meta(session_id, user_input, retrieval)
+
+    cache_key, answer = None, None
+    if messages is not None:
+        with phase("answer_cache"):
+            cache_key, answer = await answer_cache_call(core.cached_answer, mode_name, user_input, retrieval)
+
+    # Opened before responding so overload still gets a proper status
+    stream = None
+    if messages is not None and answer is None:
+        core.count_prompt(mode_name, messages)
+        try:
+            with phase("llm_open"):
+                stream = await llm.stream(messages)
+        except GatewayError as e:
+            core.count_llm_error(e)
+            return core.gateway_error_response(e)
+        except Exception as e:
+            core.count_llm_error(e)
+            return {"error": str(e)}, 500
+    timings = metrics.current()
+
+    async def generate():
+        yield core.sse_event("meta", meta)
+
+        if messages is None:
+            yield core.sse_event("done", {"bot": "Document is empty."})
+            return
+
+        if stream is None:
+            await save_chat(session_id, mode_name, user_input, answer, cached=True)
+            yield core.sse_event("token", {"text": answer})
+            yield core.sse_event("done", {"bot": answer, "cached": True})
+            return
+
+        parts = []
+        started = time.perf_counter()
+        try:
+            async for chunk in stream:
+                delta = core.chunk_delta(chunk)
+                if delta:
+                    parts.append(delta)
+                    yield core.sse_event("token", {"text": delta})
+        except Exception as e:
+            core.count_llm_error(e)
+            yield core.sse_event("error", {"error": str(e)})
+            return
+        finally:
+            # Also runs when the client disconnects and the generator is cancelled
+            stream.close()
+            metrics.record_phase("llm_stream", time.perf_counter() - started, timings)
+
+        full_answer = core.streamed_answer(parts)
+        await answer_cache_call(core.remember_answer, cache_key, full_answer)
+        await save_chat(session_id, mode_name, user_input, full_answer)
+        yield core.sse_event("done", {"bot": full_answer, "cached": False})
+
+    response = Response(generate(), mimetype="text/event-stream", headers=core.SSE_HEADERS)
+    response.timeout = None
+    return response
+
+@quart_app.route("/chat/stream", methods=["POST"])
+async def chat_stream():
+    data = await request.get_json()
+    session = await find_session(data)
+    if not session:
+        return {"error": "Invalid session_id"}, 400
+    return await stream_chat(session, data.get("session_id"), data.get("message", ""))
+
+
+@quart_app.route("/upload", methods=["POST"])
+async def upload_documents():
+    form = await request.form
+    session_id = form.get("session_id")
+    files = (await request.files).getlist("files")
+    if not session_id or not files:
+        return {"error": "session_id and files are required"}, 400
+    with phase("session"):
+        session = await db["chat_sessions"].find_one(dict(core.LIVE, _id=session_id), {"_id": 1})
+    if not session:
+        return {"error": "Session not found"}, 404
+
+    documents = db["documents"]
+    uploaded_files = []
+    skipped_files = []
+    pending = {}
+
+    for file in files:
+        filename, filetype = core.upload_name(file)
+        with phase("db"):
+            existing = await documents.find_one({"session_id": session_id, "filename": filename}, {"_id": 1})
+        if existing:
+            skipped_files.append(filename)
+            continue
+
+        blob = await store_upload(file, filename, filetype)
+        if blob is None:
+            skipped_files.append(filename)
+            continue
+        metrics.UPLOAD_BYTES.observe(blob[2], filetype=filetype)
+
+        with phase("db"):
+            ready = await db["extracted_texts"].find_one({"_id": blob[1]}, {"_id": 1}) is not None
+            doc = core.document_ref(session_id, filename, filetype, blob, ready)
+            await documents.insert_one(doc)
+        core.add_upload_entry(uploaded_files, pending, doc, ready)
+
+    job = core.upload_job(session_id, uploaded_files, skipped_files, pending)
+    with phase("db"):
+        if job["completed"]:
+            await bump_doc_version(session_id)
+        elif uploaded_files:
+            await db["chat_sessions"].update_one({"_id": session_id}, core.changes_update(["documents"]))
+        await db["upload_jobs"].insert_one(job)
+    # Extraction runs in app.py's process pool and reports back through the sync client
+    with phase("queue"):
+        core.queue_extractions(job["_id"], pending)
+    return core.upload_result(job, pending), 202
+
+async def store_upload(file, filename, filetype):
+    # The upload is spooled to local disk; hashing it is file I/O plus CPU, done in a thread
+    with phase("hash"):
+        hashed = await asyncio.to_thread(core.hash_upload, file)
+    if hashed is None:
+        return None
+    sha256, size = hashed
+
+    with phase("gridfs"):
+        existing = await db["fs.files"].find_one_and_update(
+            {"sha256": sha256}, {"$inc": {"refcount": 1}}, projection={"_id": 1}
+        )
+        if existing:
+            return existing["_id"], sha256, size
+
+        grid_in = fs.new_file(**core.blob_metadata(filename, filetype, sha256))
+        file.stream.seek(0)
+        while True:
+            chunk = file.stream.read(core.UPLOAD_CHUNK_BYTES)
+            if not chunk:
+                break
+            await grid_in.write(chunk)
+        await grid_in.close()
+    return grid_in._id, sha256, size
+
+
+flask_app = WsgiToAsgi(core.app)
+
+# The ASGI entry point: async routes go to Quart, everything else to the Flask app
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan" or scope.get("path") in ASYNC_PATHS:
+        await quart_app(scope, receive, send)
+    else:
+        await flask_app(scope, receive, send)
@@ -0,0 +1,352 @@
+# Offline load test for app.py: no AI21 key or Mongo server needed.
+#
+#   python bench.py                              mongomock in memory, fake model
+#   python bench.py --mongo mongodb://localhost  a local (throwaway) mongod instead
+#   python bench.py --mongo sqlite               the SQLite backend (storage.py), in a temp directory
+#   python bench.py --requests 2000 --concurrency 16 --llm-latency 300 --out bench.json
+#
+# The model is replaced by a fake AI21 client that waits --llm-latency ms before the first
+# token and then produces --llm-tokens-per-sec. Requests go through Flask's test client from
+# --concurrency threads, so the figures are server-side latency without network overhead.
+# Results (config, per-scenario and overall p50/p95/p99, requests per second) are written as JSON.
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+SAMPLE_FILES = ["sample.xlsx", "Title.docx", "doc.txt"]
+
+LOCAL_QUESTIONS = [
+    "What is the eligibility for BTech?",
+    "Which specializations are offered?",
+    "What is the fee structure?",
+    "Summarize the document",
+    "What are the admission dates?",
+    "List the subjects in the first year",
+]
+GLOBAL_QUESTIONS = [
+    "What is machine learning?",
+    "Explain how a hash table works",
+    "What is the capital of Australia?",
+    "How do vaccines work?",
+    "What is the difference between TCP and UDP?",
+]
+
+# scenario: weight in the default mix
+DEFAULT_MIX = {
+    "chat_local": 30,
+    "chat_global": 25,
+    "chat_stream": 10,
+    "history": 20,
+    "upload": 5,
+    "delete_session": 5,
+    "documents": 5,
+}
+
+
+# Stand-in for ai21.AI21Client: same response shapes, latency from the command line
+class FakeAI21Client:
+    latency = 0.2
+    tokens_per_sec = 50.0
+    answer_tokens = 40
+
+    def __init__(self, *args, **kwargs):
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self._create))
+
+    def _tokens(self, messages):
+        words = ("- from the fake model about " + messages[-1].content).split()
+        return [(words[i % len(words)] + " ") for i in range(self.answer_tokens)]
+
+    def _create(self, model, messages, stream=False, **kwargs):
+        tokens = self._tokens(messages)
+        time.sleep(self.latency)
+        if stream:
+            return self._stream(tokens)
+        time.sleep(len(tokens) / self.tokens_per_sec)
+        message = types.SimpleNamespace(content="".join(tokens))
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)])
+
+    def _stream(self, tokens):
+        for token in tokens:
+            time.sleep(1 / self.tokens_per_sec)
+            delta = types.SimpleNamespace(content=token)
+            yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=delta)])
+
+
+# app.py builds its clients from these modules (Mongo at import, AI21 on first use), so the stand-ins go in first
+def load_app(args):
+    import ai21
+    import pymongo
+
+    FakeAI21Client.latency = args.llm_latency / 1000
+    FakeAI21Client.tokens_per_sec = args.llm_tokens_per_sec
+    FakeAI21Client.answer_tokens = args.llm_answer_tokens
+    ai21.AI21Client = FakeAI21Client
+
+    if args.mongo == "mock":
+        try:
+            import mongomock
+            import mongomock.gridfs
+        except ImportError:
+            sys.exit("--mongo mock needs mongomock (pip install mongomock), or pass a local mongod URI")
+        mongomock.gridfs.enable_gridfs_integration()
+        shared = mongomock.MongoClient()
+        pymongo.MongoClient = lambda *a, **k: shared
+    elif args.mongo == "sqlite":
+        os.environ["STORAGE_BACKEND"] = "sqlite"
+        os.environ["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="bench-"), "chat_history.db")
+    else:
+        os.environ["MONGO_URI"] = args.mongo
+
+    import app as chat_app
+
+    if args.mongo == "mock":
+        # Pool processes could not see an in-memory database; extract in threads instead
+        import ingest
+        ingest._db = chat_app.db
+        ingest._fs = chat_app.fs
+        chat_app.ingest_pool = ThreadPoolExecutor(max_workers=chat_app.INGEST_WORKERS)
+    return chat_app
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    rank = max(int(round(p / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+def summarize(samples, duration):
+    latencies = sorted(ms for ms, ok in samples if ms is not None)
+    errors = sum(1 for ms, ok in samples if not ok)
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "rps": round(len(samples) / duration, 2) if duration else None,
+        "mean_ms": round(sum(latencies) / len(latencies), 2) if latencies else None,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "max_ms": latencies[-1] if latencies else None,
+    }
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+class Bench:
+    def __init__(self, chat_app, args):
+        self.app = chat_app
+        self.args = args
+        self.files = {}
+        for name in SAMPLE_FILES:
+            with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name), "rb") as f:
+                self.files[name] = f.read()
+        self.local_sessions = []
+        self.global_sessions = []
+        self.samples = {}
+        self.lock = threading.Lock()
+        self.counter = 0
+        self.local = threading.local()
+
+    @property
+    def client(self):
+        if not hasattr(self.local, "client"):
+            self.local.client = self.app.app.test_client()
+        return self.local.client
+
+    def start_session(self, mode):
+        r = self.client.post("/start_session", json={"description": "bench", "mode": mode})
+        return r.get_json()["session_id"]
+
+    def upload(self, session_id):
+        data = {
+            "session_id": session_id,
+            "files": [(io.BytesIO(content), name) for name, content in self.files.items()],
+        }
+        return self.client.post("/upload", data=data, content_type="multipart/form-data")
+
+    def wait_for_job(self, job_id, timeout=120):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.client.get(f"/upload_status/{job_id}").get_json()["status"] == "done":
+                return
+            time.sleep(0.05)
+        raise RuntimeError(f"Upload job {job_id} did not finish within {timeout}s")
+
+    # Sessions the chat and history scenarios draw from; Local ones get the sample files
+    def setup(self):
+        for _ in range(self.args.sessions):
+            session_id = self.start_session("1")
+            self.wait_for_job(self.upload(session_id).get_json()["job_id"])
+            self.local_sessions.append(session_id)
+            self.global_sessions.append(self.start_session("2"))
+        # Some history to read back
+        for session_id in self.local_sessions + self.global_sessions:
+            for question in random.sample(LOCAL_QUESTIONS, 3):
+                self.client.post("/chat", json={"session_id": session_id, "message": question})
+
+    def question(self, pool):
+        question = random.choice(pool)
+        if random.random() < self.args.unique_ratio:
+            with self.lock:
+                self.counter += 1
+                question = f"{question} (variant {self.counter})"
+        return question
+
+    # Each scenario returns (status_ok, milliseconds) for the request being measured
+    def run_scenario(self, name):
+        client = self.client
+        if name == "upload":
+            session_id = self.start_session("1")
+            started = time.perf_counter()
+            r = self.upload(session_id)
+            elapsed = time.perf_counter() - started
+            return r.status_code == 202, elapsed
+        if name == "delete_session":
+            session_id = self.start_session("2")
+            client.post("/chat", json={"session_id": session_id, "message": "hello"})
+            started = time.perf_counter()
+            r = client.delete(f"/delete_session/{session_id}")
+            return r.status_code == 202, time.perf_counter() - started
+
+        started = time.perf_counter()
+        if name == "chat_local":
+            r = client.post("/chat", json={
+                "session_id": random.choice(self.local_sessions), "message": self.question(LOCAL_QUESTIONS)
+            })
+        elif name == "chat_global":
+            r = client.post("/chat", json={
+                "session_id": random.choice(self.global_sessions), "message": self.question(GLOBAL_QUESTIONS)
+            })
+        elif name == "chat_stream":
+            r = client.post("/chat/stream", json={
+                "session_id": random.choice(self.local_sessions), "message": self.question(LOCAL_QUESTIONS)
+            })
+            # Reading the whole body is what makes the stream run
+            r.get_data()
+        elif name == "history":
+            r = client.post("/history", json={
+                "session_id": random.choice(self.local_sessions + self.global_sessions),
+                "order": "desc", "limit": 30
+            })
+        elif name == "documents":
+            r = client.post("/documents", json={"session_id": random.choice(self.local_sessions)})
+        else:
+            raise ValueError(f"Unknown scenario {name}")
+        return r.status_code == 200, time.perf_counter() - started
+
+    def record(self, name):
+        try:
+            ok, elapsed = self.run_scenario(name)
+        except Exception:
+            # Counted as an error; there is no meaningful latency to record
+            ok, elapsed = False, None
+        with self.lock:
+            self.samples.setdefault(name, []).append((round(elapsed * 1000, 2) if elapsed is not None else None, ok))
+
+    def run(self, mix):
+        names = list(mix)
+        plan = random.choices(names, weights=[mix[n] for n in names], k=self.args.requests)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as pool:
+            list(pool.map(self.record, plan))
+        return time.perf_counter() - started
+
+
+def parse_mix(text):
+    if not text:
+        return dict(DEFAULT_MIX)
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"Unknown scenario {name!r}; choose from {', '.join(DEFAULT_MIX)}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline load test for the chatbot API")
+    parser.add_argument("--requests", type=int, default=500, help="measured requests (default 500)")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent clients (default 8)")
+    parser.add_argument("--sessions", type=int, default=4, help="Local and Global sessions to set up (default 4 each)")
+    parser.add_argument("--mix", type=parse_mix, default=None,
+                        help="scenario weights, e.g. chat_local=5,history=2 (default: built-in mix)")
+    parser.add_argument("--unique-ratio", type=float, default=0.5,
+                        help="share of chat questions made unique, i.e. answer cache misses (default 0.5)")
+    parser.add_argument("--llm-latency", type=float, default=200, help="fake model time to first token, ms")
+    parser.add_argument("--llm-tokens-per-sec", type=float, default=50, help="fake model output rate")
+    parser.add_argument("--llm-answer-tokens", type=int, default=40, help="tokens per fake answer")
+    parser.add_argument("--mongo", default="mock", help="'mock' for mongomock, 'sqlite', or a local mongod URI")
+    parser.add_argument("--seed", type=int, default=None, help="random seed for a repeatable request mix")
+    parser.add_argument("--out", default=None, help="write the JSON report here (default: stdout)")
+    args = parser.parse_args(argv)
+    mix = args.mix or dict(DEFAULT_MIX)
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    chat_app = load_app(args)
+    bench = Bench(chat_app, args)
+    setup_started = time.perf_counter()
+    bench.setup()
+    setup_seconds = time.perf_counter() - setup_started
+    duration = bench.run(mix)
+
+    everything = [s for samples in bench.samples.values() for s in samples]
+    report = {
+        "generated_at": datetime.now().isoformat(timespec="seconds"),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "config": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "sessions": args.sessions,
+            "mix": mix,
+            "unique_ratio": args.unique_ratio,
+            "llm_latency_ms": args.llm_latency,
+            "llm_tokens_per_sec": args.llm_tokens_per_sec,
+            "llm_answer_tokens": args.llm_answer_tokens,
+            "mongo": {"mock": "mongomock", "sqlite": "sqlite"}.get(args.mongo, "mongod"),
+            "seed": args.seed,
+        },
+        "setup_seconds": round(setup_seconds, 2),
+        "duration_seconds": round(duration, 3),
+        "overall": summarize(everything, duration),
+        "scenarios": {name: summarize(samples, duration) for name, samples in sorted(bench.samples.items())},
+        "llm_gateway": chat_app.llm.stats(),
+        "cache": {
+            "context": chat_app.context_cache.stats(),
+            "answers": chat_app.answer_cache.stats() if chat_app.answer_cache is not None else None,
+        },
+    }
+
+    text = json.dumps(report, indent=2, default=str)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+        overall = report["overall"]
+        print(f"{overall['requests']} requests, {overall['errors']} errors, {overall['rps']} req/s, "
+              f"p50 {overall['p50_ms']} ms, p95 {overall['p95_ms']} ms, p99 {overall['p99_ms']} ms -> {args.out}")
+    else:
+        print(text)
+
+    if chat_app.ingest_pool is not None:
+        chat_app.ingest_pool.shutdown(wait=False, cancel_futures=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import asyncio
+import os
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from gridfs.errors import NoFile
+
+CHUNK_SIZE = 255 * 1024
+
+# Files kept on the local filesystem with the part of GridFS's API this app uses, for the
+# SQLite backend (storage.py). The metadata stays a document in db["fs.files"], with the
+# fields GridFS gives it (_id, length, chunkSize, uploadDate and the caller's), so queries
+# and refcounts on fs.files work as before; the content is one file, root/<xx>/<_id>.
+# A file is written to a temporary name and renamed into place before its metadata is
+# inserted, so a reader that finds the metadata always finds the whole content.
+
+
+class BlobIn:
+    def __init__(self, store, metadata):
+        self._store = store
+        self._metadata = metadata
+        self._id = metadata["_id"]
+        self._length = 0
+        self._path = store.path(self._id)
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        self._tmp = self._path + ".part"
+        self._file = open(self._tmp, "wb")
+
+    def write(self, data):
+        self._file.write(data)
+        self._length += len(data)
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._file.close()
+        os.replace(self._tmp, self._path)
+        self._store.files.insert_one(
+            {**self._metadata, "length": self._length, "uploadDate": datetime.now(timezone.utc)}
+        )
+
+    def abort(self):
+        self._file.close()
+        if os.path.exists(self._tmp):
+            os.remove(self._tmp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class BlobOut:
+    def __init__(self, path, metadata):
+        self._file = open(path, "rb")
+        self._id = metadata["_id"]
+        self.length = metadata.get("length", 0)
+        self.filename = metadata.get("filename")
+        self.metadata = metadata
+
+    def readchunk(self):
+        data = self._file.read(CHUNK_SIZE)
+        if not data:
+            self._file.close()
+        return data
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class FileBlobStore:
+    def __init__(self, db, root):
+        self.root = root
+        self.files = db["fs.files"]
+
+    def path(self, file_id):
+        name = str(file_id)
+        return os.path.join(self.root, name[-2:], name)
+
+    def new_file(self, **kwargs):
+        return BlobIn(self, {"_id": kwargs.pop("_id", None) or ObjectId(), "chunkSize": CHUNK_SIZE, **kwargs})
+
+    def put(self, data, **kwargs):
+        with self.new_file(**kwargs) as blob:
+            if hasattr(data, "read"):
+                while True:
+                    chunk = data.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    blob.write(chunk)
+            else:
+                blob.write(data)
+        return blob._id
+
+    def get(self, file_id):
+        metadata = self.files.find_one({"_id": file_id})
+        if metadata is None:
+            raise NoFile(f"no file in gridfs collection {self.files.name} with _id {file_id!r}")
+        return BlobOut(self.path(file_id), metadata)
+
+    def exists(self, file_id):
+        return self.files.find_one({"_id": file_id}, {"_id": 1}) is not None
+
+    # Metadata first, as GridFS removes the fs.files document before its chunks
+    def delete(self, file_id):
+        self.files.delete_one({"_id": file_id})
+        self.delete_content([file_id])
+
+    # Content of files whose metadata is already gone (deletion.py)
+    def delete_content(self, file_ids):
+        for file_id in file_ids:
+            try:
+                os.remove(self.path(file_id))
+            except FileNotFoundError:
+                pass
+
+
+# The same API for asyncio callers, as AsyncGridFS: new_file() is synchronous and returns
+# an object whose write() and close() are awaited
+
+class AsyncBlobIn:
+    def __init__(self, blob):
+        self._blob = blob
+        self._id = blob._id
+
+    async def write(self, data):
+        self._blob.write(data)
+
+    async def close(self):
+        await asyncio.to_thread(self._blob.close)
+
+    async def abort(self):
+        self._blob.abort()
+
+
+class AsyncBlobOut:
+    def __init__(self, blob):
+        self._blob = blob
+        self._id = blob._id
+        self.length = blob.length
+        self.filename = blob.filename
+
+    async def readchunk(self):
+        return await asyncio.to_thread(self._blob.readchunk)
+
+    async def read(self, size=-1):
+        return await asyncio.to_thread(self._blob.read, size)
+
+
+class AsyncFileBlobStore:
+    def __init__(self, store):
+        self.store = store
+
+    def new_file(self, **kwargs):
+        return AsyncBlobIn(self.store.new_file(**kwargs))
+
+    async def put(self, data, **kwargs):
+        return await asyncio.to_thread(self.store.put, data, **kwargs)
+
+    async def get(self, file_id):
+        return AsyncBlobOut(await asyncio.to_thread(self.store.get, file_id))
+
+    async def delete(self, file_id):
+        await asyncio.to_thread(self.store.delete, file_id)
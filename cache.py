@@ -0,0 +1,162 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+
+# Small thread-safe LRU cache bounded by entry count and approximate size in bytes,
+# with an optional time-to-live per entry
+class LRUCache:
+    def __init__(self, max_entries=128, max_bytes=256 * 1024 * 1024, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[2] is not None and entry[2] < time.monotonic():
+                self.bytes -= self._data.pop(key)[1]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size=0):
+        with self._lock:
+            if key in self._data:
+                self.bytes -= self._data.pop(key)[1]
+            # Values bigger than the whole budget are not worth keeping
+            if size > self.max_bytes:
+                return
+            expires = time.monotonic() + self.ttl if self.ttl else None
+            self._data[key] = (value, size, expires)
+            self.bytes += size
+            while len(self._data) > self.max_entries or self.bytes > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.bytes -= evicted[1]
+                self.evictions += 1
+
+    # Drop every entry whose key matches, e.g. all versions cached for one session
+    def invalidate(self, match):
+        with self._lock:
+            for key in [k for k in self._data if match(k)]:
+                self.bytes -= self._data.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "bytes": self.bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+
+# Answer cache in this process only
+class MemoryAnswerCache:
+    backend = "memory"
+
+    def __init__(self, max_entries=10000, ttl=86400):
+        self._cache = LRUCache(max_entries=max_entries, ttl=ttl)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def put(self, key, answer):
+        self._cache.put(key, answer, len(answer))
+
+    def stats(self):
+        return dict(self._cache.stats(), backend=self.backend)
+
+
+# Answer cache in a Mongo collection shared by every worker. Mongo's TTL monitor
+# removes expired entries; the least recently used are trimmed past max_entries.
+class MongoAnswerCache:
+    backend = "mongo"
+
+    def __init__(self, collection, max_entries=10000, ttl=86400):
+        self.collection = collection
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+
+    # Separate from the constructor so the cache can be set up before there is a connection
+    def create_indexes(self):
+        self.collection.create_index("expires_at", expireAfterSeconds=0)
+        self.collection.create_index("last_used")
+
+    def get(self, key):
+        # UTC, since that is what Mongo's TTL monitor compares against
+        now = datetime.now(timezone.utc)
+        entry = self.collection.find_one_and_update(
+            {"_id": key, "expires_at": {"$gt": now}},
+            {"$set": {"last_used": now}},
+            projection={"answer": 1}
+        )
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return entry["answer"]
+
+    def put(self, key, answer):
+        now = datetime.now(timezone.utc)
+        self.collection.update_one(
+            {"_id": key},
+            {"$set": {"answer": answer, "last_used": now, "expires_at": now + timedelta(seconds=self.ttl)}},
+            upsert=True
+        )
+        with self._lock:
+            self._puts += 1
+            check = self._puts % 100 == 0
+        # Checking the size on every write would cost a count per answer
+        if check:
+            self._trim()
+
+    def _trim(self):
+        excess = self.collection.estimated_document_count() - self.max_entries
+        if excess <= 0:
+            return
+        oldest = [d["_id"] for d in self.collection.find({}, {"_id": 1}).sort("last_used", 1).limit(excess)]
+        result = self.collection.delete_many({"_id": {"$in": oldest}})
+        with self._lock:
+            self.evictions += result.deleted_count
+
+    def stats(self):
+        entries = self.collection.estimated_document_count()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "backend": self.backend,
+                "entries": entries,
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+            }
@@ -0,0 +1,165 @@
+# Cold-start and memory report for a web worker, to size worker counts.
+#
+#   python coldstart.py                                   mongomock, 3 runs
+#   python coldstart.py --mongo mongodb://localhost --runs 5 --memory-mb 4096 --out coldstart.json
+#
+# Each run starts two fresh interpreters, a web worker and an ingestion pool process, that
+# record after every stage the seconds since they started and their resident memory (RSS):
+#   worker: import          import app: nothing is connected, no parser or AI21 SDK loaded
+#           first_request   GET /sessions: connects to Mongo, ensures indexes, starts the collector
+#           first_chat      a Global mode chat, which loads the AI21 SDK (the model is faked)
+#   ingest: import          import ingest, as a spawned pool process does
+#           extract_<type>  a small file of each type, loading that type's parser
+# The report gives the median of each stage over the runs and, with --memory-mb, how many
+# warm web workers fit in that much memory, alone and with their ingestion pools
+# (INGEST_WORKERS processes each).
+import argparse
+import csv
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+STARTED = time.perf_counter()
+
+HEAVY_MODULES = ["ai21", "fitz", "docx", "openpyxl", "pandas", "numpy"]
+SAMPLE_FILES = {"txt": "doc.txt", "docx": "Title.docx", "xlsx": "sample.xlsx"}
+
+
+def rss_mb():
+    import metrics
+    return round(metrics.resident_bytes() / (1024 * 1024), 1)
+
+def stage(name):
+    loaded = [m for m in HEAVY_MODULES if m in sys.modules]
+    print(json.dumps({"stage": name, "seconds": round(time.perf_counter() - STARTED, 3), "rss_mb": rss_mb(), "loaded": loaded}), flush=True)
+
+def sample_files(workdir):
+    files = {t: os.path.join(os.path.dirname(os.path.abspath(__file__)), name) for t, name in SAMPLE_FILES.items()}
+    path = os.path.join(workdir, "sample.csv")
+    with open(path, "w", newline="") as f:
+        csv.writer(f).writerows([["name", "qty"]] + [[f"item {i}", i] for i in range(100)])
+    files["csv"] = path
+    return files
+
+# The measured web worker, in a child interpreter
+def worker_child(mongo):
+    if mongo == "mock":
+        import mongomock
+        import mongomock.gridfs
+        import pymongo
+        mongomock.gridfs.enable_gridfs_integration()
+        shared = mongomock.MongoClient()
+        pymongo.MongoClient = lambda *a, **k: shared
+    else:
+        os.environ["MONGO_URI"] = mongo
+
+    import app
+    stage("import")
+
+    client = app.app.test_client()
+    client.get("/sessions")
+    stage("first_request")
+
+    import ai21
+    from bench import FakeAI21Client
+    FakeAI21Client.latency = 0
+    FakeAI21Client.tokens_per_sec = 1e9
+    ai21.AI21Client = FakeAI21Client
+    session_id = client.post("/start_session", json={"description": "coldstart", "mode": "2"}).get_json()["session_id"]
+    client.post("/chat", json={"session_id": session_id, "message": "hello"})
+    client.delete(f"/delete_session/{session_id}")
+    stage("first_chat")
+
+# The measured ingestion pool process, in a child interpreter
+def ingest_child():
+    import ingest
+    stage("import")
+
+    import extractors
+    with tempfile.TemporaryDirectory() as workdir:
+        files = sample_files(workdir)
+        for filetype in ["txt", "csv", "docx", "xlsx", "pdf"]:
+            if filetype == "pdf":
+                # Written with the parser that then reads it, so no other stage loads it
+                import fitz
+                pdf = fitz.open()
+                pdf.new_page().insert_text((72, 72), "Cold start sample page.")
+                files["pdf"] = os.path.join(workdir, "sample.pdf")
+                pdf.save(files["pdf"])
+            extractors.extract_text(filetype, files[filetype])
+            stage(f"extract_{filetype}")
+
+# Returns (stages, wall-clock seconds); the wall clock also covers interpreter start-up
+def run_once(kind, mongo):
+    started = time.perf_counter()
+    out = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", kind, "--mongo", mongo],
+        capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))
+    ).stdout
+    stages = [json.loads(line) for line in out.splitlines() if line.startswith("{")]
+    return stages, time.perf_counter() - started
+
+def summarize(runs):
+    names = [s["stage"] for s in runs[0]]
+    summary = {}
+    for i, name in enumerate(names):
+        summary[name] = {
+            "seconds": round(statistics.median(r[i]["seconds"] for r in runs), 3),
+            "rss_mb": round(statistics.median(r[i]["rss_mb"] for r in runs), 1),
+            "loaded": runs[0][i]["loaded"],
+        }
+    return summary
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cold-start time and per-worker memory report")
+    parser.add_argument("--runs", type=int, default=3, help="fresh interpreters to measure (default 3)")
+    parser.add_argument("--mongo", default="mock", help="'mock' for mongomock, or a mongod URI")
+    parser.add_argument("--memory-mb", type=float, default=None, help="memory to fit workers into")
+    parser.add_argument("--out", default=None, help="write the JSON report here (default: stdout)")
+    parser.add_argument("--child", choices=["worker", "ingest"], help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child == "worker":
+        worker_child(args.mongo)
+        return
+    if args.child == "ingest":
+        ingest_child()
+        return
+
+    report = {"runs": args.runs, "mongo": "mongomock" if args.mongo == "mock" else "mongod"}
+    for kind in ("worker", "ingest"):
+        results = [run_once(kind, args.mongo) for _ in range(args.runs)]
+        report[kind] = {
+            "process_seconds": round(statistics.median(wall for _, wall in results), 3),
+            "stages": summarize([stages for stages, _ in results]),
+        }
+    worker_mb = report["worker"]["stages"]["first_chat"]["rss_mb"]
+    ingest_mb = report["ingest"]["stages"]["extract_pdf"]["rss_mb"]
+    ingest_workers = int(os.getenv("INGEST_WORKERS", str(os.cpu_count() or 1)))
+    report["per_worker_rss_mb"] = {
+        "web_worker": worker_mb,
+        "ingest_process": ingest_mb,
+        "ingest_workers": ingest_workers,
+        "web_worker_with_ingest_pool": round(worker_mb + ingest_workers * ingest_mb, 1),
+    }
+    if args.memory_mb:
+        report["fits_in_memory"] = {
+            "memory_mb": args.memory_mb,
+            "web_workers": int(args.memory_mb // worker_mb),
+            "web_workers_with_ingest_pools": int(args.memory_mb // (worker_mb + ingest_workers * ingest_mb)),
+        }
+
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import hashlib
+import struct
+from collections import OrderedDict
+
+from retrieval import tokenize
+
+SHINGLE_WORDS = 5
+# One shingle hash in SAMPLE_MOD is kept; chunks with fewer than MIN_SAMPLES kept are only
+# matched when their whole text repeats
+SAMPLE_MOD = 8
+MIN_SAMPLES = 4
+DEFAULT_THRESHOLD = 1.0
+# Kept chunk texts read back from the store that are held for the next comparisons
+RECENT_TEXTS = 32
+
+
+def _hash(text):
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), "little")
+
+# A chunk's sketch, stored with it at ingestion: a hash of its whole (normalized) text, then
+# the hashes of its five-word shingles that fall in the 1/SAMPLE_MOD sample, as 8 bytes each.
+# Sampling by hash value picks the same shingles in every document, so the share of a chunk's
+# sample found elsewhere estimates how much of its text is found elsewhere. None when the
+# text has no words.
+def sketch(text):
+    words = tokenize(text)
+    if not words:
+        return None
+    shingles = {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(max(len(words) - SHINGLE_WORDS + 1, 1))}
+    sample = sorted(h for h in map(_hash, shingles) if h % SAMPLE_MOD == 0)
+    return struct.pack(f"<{1 + len(sample)}Q", _hash(" ".join(words)), *sample)
+
+def _unpack(data):
+    values = struct.unpack(f"<{len(data) // 8}Q", data)
+    return values[0], values[1:]
+
+def _shingles(words):
+    return {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(max(len(words) - SHINGLE_WORDS + 1, 1))}
+
+
+# Drops chunks whose text is all in chunks kept before them: the same text, or every one of
+# their five-word shingles (threshold of them, when lowered) found in the kept chunks that
+# hold their sampled shingles. Containment rather than pairwise similarity, because the same
+# document exported twice (DOCX and PDF, or two revisions) is cut into chunks at different
+# places; a chunk that adds any text of its own is kept. The sample only picks the chunks to
+# compare with. Only sketches and ids are kept here; the text of those chunks is read back
+# with load_texts ({_id: text} for a list of ids), so a session past CONTEXT_TEXT_MB holds
+# no more chunk text while its index is built than once it is. Chunks pass through unique()
+# in index order, newest document first, in one or several batches, so repeated text stays
+# under the latest revision and remembers the other files it was found in; annotate() then
+# adds that provenance to the indexed chunks.
+class NearDuplicateFilter:
+    def __init__(self, threshold=DEFAULT_THRESHOLD, load_texts=None):
+        self.threshold = threshold
+        self.load_texts = load_texts
+        self.duplicates = 0
+        self._kept = 0
+        self._texts = {}
+        self._shingles = {}
+        self._ids = {}
+        self._recent = OrderedDict()
+        self._files = {}
+        self._also_in = {}
+
+    # Positions of the kept chunks that hold this chunk's text, or None when it is new
+    def _covering(self, text_hash, sample, text):
+        if text_hash in self._texts:
+            return [self._texts[text_hash]]
+        if len(sample) < MIN_SAMPLES:
+            return None
+        hits = [self._shingles[h] for h in sample if h in self._shingles]
+        if len(hits) < self.threshold * len(sample):
+            return None
+        found = sorted(set(hits))
+        # Neighbouring chunks are read as one text, for the shingles that span their boundary
+        first, last = found[0], found[-1]
+        positions = range(first, last + 1) if last - first < 2 * len(found) else found
+        seen = _shingles(tokenize(" ".join(self._kept_texts(positions))))
+        shingles = _shingles(tokenize(text))
+        if sum(1 for s in shingles if s in seen) < self.threshold * len(shingles):
+            return None
+        return found
+
+    # Text of the kept chunks at these positions. Neighbouring chunks are usually compared
+    # with the same few, so the latest RECENT_TEXTS read are held.
+    def _kept_texts(self, positions):
+        ids = [self._ids.get(p) for p in positions]
+        missing = [i for i in ids if i is not None and i not in self._recent]
+        if missing and self.load_texts is not None:
+            self._recent.update(self.load_texts(missing))
+        texts = []
+        for i in ids:
+            if i in self._recent:
+                self._recent.move_to_end(i)
+                texts.append(self._recent[i])
+        while len(self._recent) > RECENT_TEXTS:
+            self._recent.popitem(last=False)
+        return texts
+
+    # Chunks carry their stored "sketch", or one is made from their text
+    def unique(self, chunks):
+        for chunk in chunks:
+            data = chunk.pop("sketch", None) or sketch(chunk.get("text", ""))
+            if data is not None and self.threshold:
+                text_hash, sample = _unpack(data)
+                covering = self._covering(text_hash, sample, chunk.get("text", ""))
+                if covering is not None:
+                    self.duplicates += 1
+                    source = {"filename": chunk["filename"], "filetype": chunk["filetype"]}
+                    for position in covering:
+                        also_in = self._also_in.setdefault(position, [])
+                        if source["filename"] != self._files[position] and source not in also_in:
+                            also_in.append(source)
+                    continue
+                self._texts.setdefault(text_hash, self._kept)
+                for h in sample:
+                    self._shingles.setdefault(h, self._kept)
+                self._ids[self._kept] = chunk.get("_id")
+            self._files[self._kept] = chunk["filename"]
+            self._kept += 1
+            yield chunk
+
+    # indexed: the chunks as indexed, in the order unique() yielded them
+    def annotate(self, indexed):
+        for position, also_in in self._also_in.items():
+            if also_in:
+                indexed[position]["also_in"] = also_in
@@ -0,0 +1,220 @@
+import logging
+import threading
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument, UpdateOne
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+DELETED_RECORDS = metrics.Counter(
+    "chatbot_deleted_records_total", "Records removed by the background deletion collector", labels=("kind",)
+)
+
+# Sessions that have not been deleted; every session lookup on a request path uses this
+LIVE = {"deleted_at": {"$exists": False}}
+
+
+# Deleting a session only marks it (deleted_at) and queues a job in deletion_jobs; this
+# collector then removes its chats, document references, unreferenced blobs and their
+# extracted text in batches of batch_size, pausing between batches so a large session
+# does not saturate Mongo. Jobs are claimed with a lease, so any worker's collector can
+# pick up a job left behind by a worker that stopped part way. Repeating a step never removes
+# data that is still in use; at worst an interrupted step leaves an unreferenced blob behind.
+# Blob content is in fs.chunks (GridFS), or wherever delete_content(blob_ids) removes it from
+# when the store keeps it elsewhere (storage.py).
+class DeletionCollector:
+    def __init__(self, db, batch_size=500, pause=0.05, poll=5.0, lease=60.0, max_attempts=5, delete_content=None):
+        self.db = db
+        self.delete_content = delete_content
+        self.jobs = db["deletion_jobs"]
+        self.batch_size = batch_size
+        self.pause = pause
+        self.poll = poll
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    # Started from the first request, so the thread belongs to the serving process
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="deletion-collector", daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    # Tombstone a session and queue its deletion. Returns the job id; deleting a session
+    # twice returns the job already queued for it.
+    def delete_session(self, session_id):
+        now = datetime.now()
+        job_id = uuid.uuid4().hex
+        marked = self.db["chat_sessions"].find_one_and_update(
+            dict(LIVE, _id=session_id), {"$set": {"deleted_at": now, "deletion_job": job_id}}, projection={"_id": 1}
+        )
+        if marked is None:
+            existing = self.db["chat_sessions"].find_one({"_id": session_id}, {"deletion_job": 1})
+            if existing is not None:
+                return existing["deletion_job"]
+            # No session record, but its chats or documents may still be around
+        self.jobs.insert_one({
+            "_id": job_id,
+            "session_id": session_id,
+            "status": "queued",
+            "phase": None,
+            "removed": {},
+            "attempts": 0,
+            "created_at": now
+        })
+        self._wake.set()
+        return job_id
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                job = self._claim()
+                if job is not None:
+                    self._collect(job)
+                    continue
+            except Exception:
+                log.exception("Deletion collector failed; retrying in %.0f s", self.poll)
+            self._wake.wait(self.poll)
+            self._wake.clear()
+
+    def _claim(self):
+        now = datetime.now()
+        return self.jobs.find_one_and_update(
+            {"$or": [{"status": "queued"}, {"status": "running", "lease_until": {"$lt": now}}]},
+            {"$set": {"status": "running", "lease_until": now + timedelta(seconds=self.lease)}, "$inc": {"attempts": 1}},
+            sort=[("created_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    def _collect(self, job):
+        session_id = job["session_id"]
+        try:
+            for phase, step in (
+                ("chats", self._delete_chats),
+                ("documents", self._delete_documents),
+                ("legacy_chunks", self._delete_legacy_chunks),
+                ("legacy_files", self._delete_legacy_files),
+            ):
+                if self._stop.is_set():
+                    return  # the lease runs out and the job is picked up again
+                self._progress(job, phase=phase)
+                step(job, session_id)
+            self.db["chat_sessions"].delete_one({"_id": session_id, "deleted_at": {"$exists": True}})
+            self._progress(job, status="done", phase=None, finished_at=datetime.now())
+        except Exception as e:
+            # Queued again from where it stopped, unless it keeps failing
+            log.exception("Deleting session %s failed (attempt %d)", session_id, job.get("attempts", 1))
+            if job.get("attempts", 1) >= self.max_attempts:
+                self._progress(job, status="error", error=str(e), finished_at=datetime.now())
+            else:
+                self._progress(job, status="queued", error=str(e))
+
+    # Record progress and extend the lease; removed counts are added to the job's totals
+    def _progress(self, job, removed=None, **fields):
+        update = {"$set": dict(fields, lease_until=datetime.now() + timedelta(seconds=self.lease))}
+        if removed:
+            update["$inc"] = {f"removed.{kind}": n for kind, n in removed.items() if n}
+            for kind, n in removed.items():
+                DELETED_RECORDS.inc(n, kind=kind)
+        self.jobs.update_one({"_id": job["_id"]}, update)
+
+    def _throttle(self):
+        if self.pause:
+            self._stop.wait(self.pause)
+
+    # Delete everything matching query, batch_size records at a time
+    def _drain(self, job, collection, query, kind):
+        while True:
+            ids = [d["_id"] for d in collection.find(query, {"_id": 1}).limit(self.batch_size)]
+            if not ids:
+                return
+            deleted = collection.delete_many({"_id": {"$in": ids}}).deleted_count
+            self._progress(job, {kind: deleted})
+            self._throttle()
+
+    def _delete_chats(self, job, session_id):
+        self._drain(job, self.db["btech_conversations"], {"session_id": session_id}, "chats")
+
+    # Document references go first, then the blobs they held the last reference to.
+    # A reference is deleted before its blob's refcount is lowered: if the collector stops
+    # in between, the blob is kept (and leaks) rather than freed while another session uses it.
+    def _delete_documents(self, job, session_id):
+        documents = self.db["documents"]
+        files = self.db["fs.files"]
+        while True:
+            refs = list(documents.find({"session_id": session_id}, {"gridfs_id": 1}).limit(self.batch_size))
+            if not refs:
+                return
+            deleted = documents.delete_many({"_id": {"$in": [r["_id"] for r in refs]}}).deleted_count
+            counts = Counter(r["gridfs_id"] for r in refs if r.get("gridfs_id"))
+            if counts:
+                files.bulk_write(
+                    [UpdateOne({"_id": blob_id}, {"$inc": {"refcount": -n}}) for blob_id, n in counts.items()],
+                    ordered=False
+                )
+                unreferenced = files.find({"_id": {"$in": list(counts)}, "refcount": {"$lte": 0}}, {"_id": 1})
+                self._delete_blobs(job, [f["_id"] for f in unreferenced])
+            self._progress(job, {"documents": deleted})
+            self._throttle()
+
+    def _delete_blobs(self, job, blob_ids):
+        files = self.db["fs.files"]
+        gone = []
+        hashes = set()
+        for blob_id in blob_ids:
+            # Re-checked per blob: an upload of the same content may have taken a reference since
+            blob = files.find_one_and_delete({"_id": blob_id, "refcount": {"$lte": 0}}, projection={"sha256": 1})
+            if blob is not None:
+                gone.append(blob_id)
+                if blob.get("sha256"):
+                    hashes.add(blob["sha256"])
+        if not gone:
+            return
+        self._delete_content(job, gone)
+        self._progress(job, {"blobs": len(gone)})
+
+        # Extracted text is shared by hash and goes once no blob with that hash is left
+        orphaned = [h for h in hashes if files.find_one({"sha256": h}, {"_id": 1}) is None]
+        if orphaned:
+            texts = self.db["extracted_texts"].delete_many({"_id": {"$in": orphaned}}).deleted_count
+            self._progress(job, {"texts": texts})
+            self._drain(job, self.db["document_pages"], {"sha256": {"$in": orphaned}}, "pages")
+            self._drain(job, self.db["document_chunks"], {"sha256": {"$in": orphaned}}, "chunks")
+
+    def _delete_content(self, job, blob_ids):
+        if self.delete_content is None:
+            self._drain(job, self.db["fs.chunks"], {"files_id": {"$in": blob_ids}}, "blob_chunks")
+        else:
+            self.delete_content(blob_ids)
+
+    # Chunks of documents stored inline before blobs were shared
+    def _delete_legacy_chunks(self, job, session_id):
+        self._drain(job, self.db["document_chunks"], {"session_id": session_id}, "chunks")
+
+    # Files stored per session before content addressing
+    def _delete_legacy_files(self, job, session_id):
+        files = self.db["fs.files"]
+        while True:
+            ids = [f["_id"] for f in files.find({"session_id": session_id}, {"_id": 1}).limit(self.batch_size)]
+            if not ids:
+                return
+            self._delete_content(job, ids)
+            deleted = files.delete_many({"_id": {"$in": ids}}).deleted_count
+            self._progress(job, {"blobs": deleted})
+            self._throttle()
@@ -0,0 +1,904 @@
+import asyncio
+import base64
+import itertools
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from pymongo import DeleteMany, DeleteOne, InsertOne, ReturnDocument, TEXT, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, WriteError
+from pymongo.results import BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+
+from retrieval import tokenize
+
+DUPLICATE_KEY = 11000
+# Rows read from SQLite at a time while a cursor is iterated
+FETCH_ROWS = 256
+
+# Embedded document store on SQLite with the part of pymongo's Database/Collection API this
+# app uses, so the same handlers run against MongoDB or a single SQLite file (see storage.py).
+#
+# Each collection is a table of (seq, id, doc): doc is the document as JSON, id its _id.
+# JSON has no ObjectId, datetime or bytes, so those are stored as strings with a \x01 type
+# tag ("\x01o<hex>", "\x01d<ISO time>", "\x01b<base64>"); tagged values of one type sort
+# like the originals, so comparisons and ORDER BY work on the stored form. Datetimes are kept
+# to the millisecond in UTC and come back naive, as pymongo returns them.
+#
+# Filters are turned into SQL on json_extract() where they can be ($and, $or, equality, $in,
+# $ne, $exists and range operators on scalar values); anything else is checked in Python on
+# the rows SQL returns. create_index() makes an index on the same json_extract() expressions,
+# so indexed queries are index lookups. A text index is an FTS5 table kept in step with the
+# collection; $text matches any of the search words (stemmed, stop words dropped) and
+# textScore is FTS5's BM25 rank, so it is on a different scale from Mongo's and words found in
+# most of a small collection score near zero. Each write is one SQLite transaction; WAL mode
+# lets readers run alongside the single writer, in any number of threads and processes.
+#
+# Not supported: aggregation, array update operators, TTL expiry (expireAfterSeconds is
+# ignored; the answer cache checks expires_at itself), $text phrases or negation, and
+# equality on array fields, which compares the whole array rather than each element.
+
+TAG = "\x01"
+
+
+def encode(value):
+    if isinstance(value, dict):
+        return {k: encode(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [encode(v) for v in value]
+    if isinstance(value, str):
+        return TAG + "s" + value if value.startswith(TAG) else value
+    if isinstance(value, ObjectId):
+        return TAG + "o" + str(value)
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return TAG + "d" + value.isoformat(timespec="milliseconds")
+    if isinstance(value, (bytes, bytearray)):
+        return TAG + "b" + base64.b64encode(value).decode()
+    return value
+
+def decode(value):
+    if isinstance(value, str):
+        if not value.startswith(TAG):
+            return value
+        kind, rest = value[1], value[2:]
+        if kind == "o":
+            return ObjectId(rest)
+        if kind == "d":
+            return datetime.fromisoformat(rest)
+        if kind == "b":
+            return base64.b64decode(rest)
+        return rest
+    if isinstance(value, dict):
+        return {k: decode(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [decode(v) for v in value]
+    return value
+
+def _dumps(raw):
+    return json.dumps(raw, separators=(",", ":"), ensure_ascii=False)
+
+
+# Documents are handled in their stored (encoded) form until they are returned
+
+_MISSING = object()
+
+def _get(doc, field):
+    value = doc
+    for part in field.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+def _set(doc, field, value):
+    *parents, last = field.split(".")
+    for part in parents:
+        doc = doc.setdefault(part, {})
+    doc[last] = value
+
+def _unset(doc, field):
+    *parents, last = field.split(".")
+    for part in parents:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(last, None)
+
+# Values of different kinds never compare, as in Mongo
+def _kind(value):
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, (int, float)):
+        return "number"
+    if isinstance(value, str):
+        return value[:2] if value.startswith(TAG) else "string"
+    return type(value).__name__
+
+def _equal(value, target):
+    if target is None:
+        return value is _MISSING or value is None
+    if isinstance(value, list) and not isinstance(target, list):
+        return any(_equal(v, target) for v in value)
+    return value is not _MISSING and _kind(value) == _kind(target) and value == target
+
+_COMPARE = {
+    "$gt": lambda a, b: a > b,
+    "$gte": lambda a, b: a >= b,
+    "$lt": lambda a, b: a < b,
+    "$lte": lambda a, b: a <= b,
+}
+
+def _is_operators(cond):
+    return isinstance(cond, dict) and bool(cond) and all(k.startswith("$") for k in cond)
+
+def _match_op(value, op, arg):
+    if op == "$eq":
+        return _equal(value, encode(arg))
+    if op == "$ne":
+        return not _equal(value, encode(arg))
+    if op == "$in":
+        return any(_equal(value, encode(a)) for a in arg)
+    if op == "$nin":
+        return not any(_equal(value, encode(a)) for a in arg)
+    if op == "$exists":
+        return (value is not _MISSING) == bool(arg)
+    if op in _COMPARE:
+        target = encode(arg)
+        values = value if isinstance(value, list) else [value]
+        return any(v is not _MISSING and _kind(v) == _kind(target) and _COMPARE[op](v, target) for v in values)
+    raise OperationFailure(f"Unsupported query operator {op}")
+
+def _matches(doc, query):
+    for key, cond in query.items():
+        if key == "$and":
+            if not all(_matches(doc, part) for part in cond):
+                return False
+        elif key == "$or":
+            if not any(_matches(doc, part) for part in cond):
+                return False
+        elif key == "$nor":
+            if any(_matches(doc, part) for part in cond):
+                return False
+        elif key.startswith("$"):
+            raise OperationFailure(f"Unsupported query operator {key}")
+        elif _is_operators(cond):
+            value = _get(doc, key)
+            if not all(_match_op(value, op, arg) for op, arg in cond.items()):
+                return False
+        elif not _equal(_get(doc, key), encode(cond)):
+            return False
+    return True
+
+
+# Filters as SQL
+
+class _Unsupported(Exception):
+    pass
+
+def _json_path(field):
+    if "'" in field or '"' in field:
+        raise ValueError(f"Unsupported field name {field!r}")
+    return "$" + "".join(f'."{part}"' for part in field.split("."))
+
+# The SQL for a field's value; indexes are built on the unqualified form
+def _expr(field, table="d."):
+    if field == "_id":
+        return f"{table}id"
+    return f"json_extract({table}doc, '{_json_path(field)}')"
+
+def _json_type(field):
+    return f"json_type(d.doc, '{_json_path(field)}')"
+
+def _sql_equal(field, value, params):
+    if value is None:
+        return f"{_expr(field)} IS NULL"
+    if isinstance(value, bool):
+        return f"{_json_type(field)} = '{'true' if value else 'false'}'"
+    if isinstance(value, (dict, list, tuple)):
+        raise _Unsupported
+    params.append(encode(value))
+    return f"{_expr(field)} = ?"
+
+# Range comparisons only match values of the same kind
+def _sql_kind(field, value, params):
+    expr = _expr(field)
+    encoded = encode(value)
+    if isinstance(value, (int, float)):
+        return f"typeof({expr}) IN ('integer', 'real')"
+    if isinstance(encoded, str) and encoded.startswith(TAG):
+        params.append(encoded[:2])
+        return f"substr({expr}, 1, 2) = ?"
+    return f"typeof({expr}) = 'text' AND substr({expr}, 1, 1) != char(1)"
+
+_SQL_COMPARE = {"$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+
+def _sql_operator(field, op, value, params):
+    expr = _expr(field)
+    if op == "$eq":
+        return _sql_equal(field, value, params)
+    if op == "$ne":
+        if value is None:
+            return f"{expr} IS NOT NULL"
+        if isinstance(value, bool):
+            return f"{_json_type(field)} IS NOT '{'true' if value else 'false'}'"
+        if isinstance(value, (dict, list, tuple)):
+            raise _Unsupported
+        params.append(encode(value))
+        return f"({expr} IS NULL OR {expr} != ?)"
+    if op == "$in":
+        values = list(value)
+        if any(isinstance(v, (bool, dict, list, tuple)) for v in values):
+            raise _Unsupported
+        scalars = [encode(v) for v in values if v is not None]
+        parts = []
+        if scalars:
+            params.extend(scalars)
+            parts.append(f"{expr} IN ({', '.join('?' * len(scalars))})")
+        if len(scalars) < len(values):
+            parts.append(f"{expr} IS NULL")
+        return "(" + " OR ".join(parts) + ")" if parts else "0"
+    if op == "$exists":
+        if field == "_id":
+            return "1" if value else "0"
+        return f"{_json_type(field)} IS {'NOT ' if value else ''}NULL"
+    if op in _SQL_COMPARE:
+        if value is None or isinstance(value, (bool, dict, list, tuple)):
+            raise _Unsupported
+        params.append(encode(value))
+        comparison = f"{expr} {_SQL_COMPARE[op]} ?"
+        return f"{comparison} AND {_sql_kind(field, value, params)}"
+    raise _Unsupported
+
+def _sql_condition(field, cond, params):
+    if field.startswith("$"):
+        raise _Unsupported
+    if _is_operators(cond):
+        return " AND ".join(_sql_operator(field, op, value, params) for op, value in cond.items())
+    return _sql_equal(field, cond, params)
+
+# The whole filter as SQL, or _Unsupported
+def _sql_filter(query, params):
+    parts = []
+    for key, cond in query.items():
+        if key == "$and":
+            parts.extend(f"({_sql_filter(part, params)})" for part in cond)
+        elif key == "$or":
+            parts.append("(" + " OR ".join(f"({_sql_filter(part, params)})" for part in cond) + ")")
+        else:
+            parts.append(_sql_condition(key, cond, params))
+    return " AND ".join(parts) or "1"
+
+# Split a filter into SQL for the parts that translate and a filter for the rest, which is
+# checked in Python. Returns (where clauses, params, rest or None).
+def _split_filter(query):
+    where, params, rest = [], [], []
+
+    def visit(part):
+        for key, cond in part.items():
+            if key == "$text":
+                continue
+            if key == "$and":
+                for sub in cond:
+                    visit(sub)
+                continue
+            sub_params = []
+            try:
+                if key == "$or":
+                    sql = _sql_filter({key: cond}, sub_params)
+                else:
+                    sql = _sql_condition(key, cond, sub_params)
+            except _Unsupported:
+                rest.append({key: cond})
+                continue
+            where.append(sql)
+            params.extend(sub_params)
+
+    visit(query)
+    return where, params, {"$and": rest} if rest else None
+
+def _sort_spec(key_or_list, direction=None):
+    if key_or_list is None:
+        return []
+    if isinstance(key_or_list, str):
+        return [(key_or_list, 1 if direction is None else direction)]
+    if isinstance(key_or_list, dict):
+        return list(key_or_list.items())
+    return [(k, d) for k, d in key_or_list]
+
+def _is_score(spec):
+    return isinstance(spec, dict) and spec.get("$meta") == "textScore"
+
+def _projection_spec(projection):
+    if projection is None:
+        return None
+    if not isinstance(projection, dict):
+        return {field: 1 for field in projection}
+    return projection
+
+def _project(doc, projection, score=None):
+    if not projection:
+        return doc
+    meta = [k for k, v in projection.items() if _is_score(v)]
+    fields = {k: v for k, v in projection.items() if k not in meta and k != "_id"}
+    include_id = projection.get("_id", 1)
+    if any(fields.values()):
+        out = {"_id": doc["_id"]} if include_id and "_id" in doc else {}
+        for field in fields:
+            value = _get(doc, field)
+            if value is not _MISSING:
+                _set(out, field, value)
+    else:
+        out = json.loads(_dumps(doc)) if any("." in f for f in fields) else dict(doc)
+        for field in fields:
+            _unset(out, field)
+        if not include_id:
+            out.pop("_id", None)
+    for key in meta:
+        out[key] = score
+    return out
+
+# Fields of an upserted document taken from the filter's equality conditions
+def _seed(query):
+    doc = {}
+    for key, cond in query.items():
+        if key == "$and":
+            for part in cond:
+                doc.update(_seed(part))
+        elif key.startswith("$"):
+            continue
+        elif _is_operators(cond):
+            if "$eq" in cond:
+                _set(doc, key, encode(cond["$eq"]))
+        else:
+            _set(doc, key, encode(cond))
+    return doc
+
+def _apply_update(doc, update, inserting=False):
+    for op, fields in update.items():
+        if op == "$set" or (op == "$setOnInsert" and inserting):
+            for field, value in fields.items():
+                _set(doc, field, encode(value))
+        elif op == "$setOnInsert":
+            continue
+        elif op == "$unset":
+            for field in fields:
+                _unset(doc, field)
+        elif op == "$inc":
+            for field, amount in fields.items():
+                current = _get(doc, field)
+                if current is _MISSING or current is None:
+                    current = 0
+                elif _kind(current) != "number":
+                    raise WriteError(f"Cannot apply $inc to a value of non-numeric type ({field})", 14)
+                _set(doc, field, current + amount)
+        else:
+            raise OperationFailure(f"Unsupported update operator {op}")
+
+# FTS5 query for a $search string: any of its words
+def _fts_query(search):
+    words = tokenize(search)
+    return " OR ".join(f'"{w}"' for w in words) if words else None
+
+
+class Database:
+    def __init__(self, path, timeout=30.0):
+        self.path = path
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        # SQLite has one writer at a time; threads of a process take turns here rather than
+        # in SQLite's busy handler, which polls with sleeps of up to 100 ms
+        self._write_lock = threading.Lock()
+        self._pid = None
+        self._local = None
+        self._tables = set()
+        self._schema_version = None
+        self._text_specs = {}
+
+    def __getitem__(self, name):
+        return Collection(self, name)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def _connect(self, check_same_thread=True):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                               check_same_thread=check_same_thread)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # With WAL, NORMAL only syncs at checkpoints: a power cut can lose the last commits,
+        # never corrupt the file
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS _text_indexes (collection TEXT PRIMARY KEY, fields TEXT NOT NULL)")
+        return conn
+
+    # One connection per thread, made again in a forked child
+    def _conn(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._local = threading.local()
+                    self._write_lock = threading.Lock()
+                    self._tables = set()
+                    self._schema_version = None
+                    self._pid = pid
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    # Text index fields of a collection as [(field, weight)], reloaded when any process
+    # changes the schema
+    def _text_spec(self, conn, name):
+        version = conn.execute("PRAGMA schema_version").fetchone()[0]
+        if version != self._schema_version:
+            self._text_specs = {c: json.loads(f) for c, f in conn.execute("SELECT collection, fields FROM _text_indexes")}
+            self._schema_version = version
+        return self._text_specs.get(name)
+
+    def close(self):
+        conn = getattr(self._local, "conn", None) if self._pid == os.getpid() else None
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class Collection:
+    def __init__(self, database, name):
+        if '"' in name:
+            raise ValueError(f"Unsupported collection name {name!r}")
+        self.database = database
+        self.name = name
+        self._table = f'"{name}"'
+        self._fts = f'"{name}__text"'
+
+    def __getitem__(self, name):
+        return Collection(self.database, f"{self.name}.{name}")
+
+    # db.fs.files, as in pymongo
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def _conn(self):
+        conn = self.database._conn()
+        if self.name not in self.database._tables:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {self._table} "
+                         "(seq INTEGER PRIMARY KEY, id UNIQUE NOT NULL, doc TEXT NOT NULL)")
+            self.database._tables.add(self.name)
+        return conn
+
+    @contextmanager
+    def _write(self):
+        conn = self._conn()
+        with self.database._write_lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    # SELECT for a find. Returns (sql, params, rest): rest is the part of the filter left
+    # for Python, in which case limit and skip are applied by the caller.
+    def _select(self, conn, query, projection=None, sort=None, limit=0, skip=0, columns=None):
+        query = query or {}
+        where, params, rest = _split_filter(query)
+        source = f"{self._table} AS d"
+        score = "NULL"
+        text = query.get("$text")
+        if text is not None:
+            spec = self.database._text_spec(conn, self.name)
+            if not spec:
+                raise OperationFailure("text index required for $text query", 27)
+            match = _fts_query(text.get("$search", ""))
+            source += f" JOIN {self._fts} ON {self._fts}.rowid = d.seq"
+            weights = ", ".join(str(float(weight)) for _, weight in spec)
+            score = f"-bm25({self._fts}, {weights})"
+            where.insert(0, f"{self._fts} MATCH ?" if match else "0")
+            if match:
+                params.insert(0, match)
+
+        doc = "d.doc"
+        excluded = [f for f, v in (projection or {}).items() if not v and f != "_id"]
+        if excluded and not rest and not any(projection[f] for f in projection if f not in excluded and f != "_id"):
+            # Large excluded fields (e.g. a document's text) are not even read out of SQLite
+            doc = "json_remove(d.doc, " + ", ".join(f"'{_json_path(f)}'" for f in excluded) + ")"
+
+        sql = f"SELECT {columns or f'd.seq, {doc}, {score}'} FROM {source}"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        order = [f"{score} DESC" if _is_score(direction) else f"{_expr(field)} {'DESC' if direction == -1 else 'ASC'}"
+                 for field, direction in sort or []]
+        if order:
+            sql += " ORDER BY " + ", ".join(order)
+        if rest is None and (limit or skip):
+            sql += " LIMIT ? OFFSET ?"
+            params += [limit or -1, skip]
+        return sql, params, rest
+
+    # (seq, stored document, score) of matching rows, in order
+    def _rows(self, conn, query, projection=None, sort=None, limit=0, skip=0):
+        sql, params, rest = self._select(conn, query, projection, sort, limit, skip)
+        rows = conn.execute(sql, params)
+        try:
+            returned = skipped = 0
+            while True:
+                batch = rows.fetchmany(FETCH_ROWS)
+                if not batch:
+                    return
+                for seq, doc, score in batch:
+                    raw = json.loads(doc)
+                    if rest is not None:
+                        if not _matches(raw, rest):
+                            continue
+                        if skipped < skip:
+                            skipped += 1
+                            continue
+                    yield seq, raw, score
+                    returned += 1
+                    if rest is not None and limit and returned >= limit:
+                        return
+        finally:
+            rows.close()
+
+    def _insert_raw(self, conn, raw, spec):
+        try:
+            seq = conn.execute(f"INSERT INTO {self._table} (id, doc) VALUES (?, ?)", (raw["_id"], _dumps(raw))).lastrowid
+        except sqlite3.IntegrityError as e:
+            raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} ({e})", DUPLICATE_KEY)
+        if spec:
+            self._index_text(conn, seq, raw, spec)
+
+    def _replace_raw(self, conn, seq, raw, spec):
+        try:
+            conn.execute(f"UPDATE {self._table} SET id = ?, doc = ? WHERE seq = ?", (raw["_id"], _dumps(raw), seq))
+        except sqlite3.IntegrityError as e:
+            raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} ({e})", DUPLICATE_KEY)
+        if spec:
+            conn.execute(f"DELETE FROM {self._fts} WHERE rowid = ?", (seq,))
+            self._index_text(conn, seq, raw, spec)
+
+    def _delete_seqs(self, conn, seqs, spec):
+        for i in range(0, len(seqs), 500):
+            batch = seqs[i:i + 500]
+            marks = ", ".join("?" * len(batch))
+            if spec:
+                conn.execute(f"DELETE FROM {self._fts} WHERE rowid IN ({marks})", batch)
+            conn.execute(f"DELETE FROM {self._table} WHERE seq IN ({marks})", batch)
+
+    def _index_text(self, conn, seq, raw, spec):
+        values = [_get(raw, field) for field, _ in spec]
+        values = [decode(v) if isinstance(v, str) else "" for v in values]
+        columns = ", ".join(f'"{field}"' for field, _ in spec)
+        conn.execute(f"INSERT INTO {self._fts} (rowid, {columns}) VALUES (?, {', '.join('?' * len(spec))})", [seq] + values)
+
+    def _new_raw(self, document):
+        # pymongo adds the _id to the caller's document
+        if "_id" not in document:
+            document["_id"] = ObjectId()
+        raw = encode(document)
+        if isinstance(raw["_id"], (dict, list)):
+            raise WriteError("_id must be a scalar value", 2)
+        return raw
+
+    # Reads
+
+    def find(self, filter=None, projection=None, sort=None, limit=0, skip=0, **kwargs):
+        return Cursor(self, filter, projection, sort, limit, skip)
+
+    def find_one(self, filter=None, projection=None, sort=None, **kwargs):
+        if filter is not None and not isinstance(filter, dict):
+            filter = {"_id": filter}
+        return next(iter(self.find(filter, projection, sort, limit=1)), None)
+
+    def count_documents(self, filter, **kwargs):
+        conn = self._conn()
+        sql, params, rest = self._select(conn, filter, columns="COUNT(*)")
+        if rest is None:
+            return conn.execute(sql, params).fetchone()[0]
+        return sum(1 for _ in self._rows(conn, filter))
+
+    def estimated_document_count(self, **kwargs):
+        return self._conn().execute(f"SELECT COUNT(*) FROM {self._table}").fetchone()[0]
+
+    def distinct(self, key, filter=None, **kwargs):
+        seen = {}
+        for _, raw, _ in self._rows(self._conn(), filter):
+            value = _get(raw, key)
+            for v in (value if isinstance(value, list) else [value]):
+                if v is not _MISSING:
+                    seen.setdefault(_dumps(v), v)
+        return [decode(v) for v in seen.values()]
+
+    # Writes
+
+    def insert_one(self, document, **kwargs):
+        raw = self._new_raw(document)
+        with self._write() as conn:
+            self._insert_raw(conn, raw, self.database._text_spec(conn, self.name))
+        return InsertOneResult(document["_id"], True)
+
+    def insert_many(self, documents, ordered=True, **kwargs):
+        documents = list(documents)
+        inserted, errors = [], []
+        with self._write() as conn:
+            spec = self.database._text_spec(conn, self.name)
+            for i, document in enumerate(documents):
+                raw = self._new_raw(document)
+                try:
+                    self._insert_raw(conn, raw, spec)
+                except DuplicateKeyError as e:
+                    errors.append({"index": i, "code": DUPLICATE_KEY, "errmsg": str(e), "op": document})
+                    if ordered:
+                        break
+                    continue
+                inserted.append(document["_id"])
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "writeConcernErrors": [], "nInserted": len(inserted),
+                                  "nUpserted": 0, "nMatched": 0, "nModified": 0, "nRemoved": 0, "upserted": []})
+        return InsertManyResult(inserted, True)
+
+    # Apply update to the first (or every) matching document, inserting one on upsert.
+    # Returns (matched, modified, upserted_id, before, after) with the last matched document.
+    def _update(self, filter, update, upsert=False, multi=False, sort=None):
+        if not update or not all(op.startswith("$") for op in update):
+            raise ValueError("update only works with $ operators")
+        with self._write() as conn:
+            spec = self.database._text_spec(conn, self.name)
+            found = [(seq, raw) for seq, raw, _ in self._rows(conn, filter, sort=_sort_spec(sort), limit=0 if multi else 1)]
+            before = after = None
+            modified = 0
+            for seq, raw in found:
+                before = json.loads(_dumps(raw))
+                _apply_update(raw, update)
+                after = raw
+                if raw != before:
+                    self._replace_raw(conn, seq, raw, spec)
+                    modified += 1
+            upserted = None
+            if not found and upsert:
+                raw = _seed(filter or {})
+                _apply_update(raw, update, inserting=True)
+                if "_id" not in raw:
+                    raw["_id"] = encode(ObjectId())
+                self._insert_raw(conn, raw, spec)
+                after = raw
+                upserted = decode(raw["_id"])
+        return len(found), modified, upserted, before, after
+
+    def _update_result(self, matched, modified, upserted):
+        raw = {"n": matched or (1 if upserted is not None else 0), "nModified": modified}
+        if upserted is not None:
+            raw["upserted"] = upserted
+        return UpdateResult(raw, True)
+
+    def update_one(self, filter, update, upsert=False, **kwargs):
+        matched, modified, upserted, _, _ = self._update(filter, update, upsert)
+        return self._update_result(matched, modified, upserted)
+
+    def update_many(self, filter, update, upsert=False, **kwargs):
+        matched, modified, upserted, _, _ = self._update(filter, update, upsert, multi=True)
+        return self._update_result(matched, modified, upserted)
+
+    def find_one_and_update(self, filter, update, projection=None, sort=None, upsert=False,
+                            return_document=ReturnDocument.BEFORE, **kwargs):
+        _, _, _, before, after = self._update(filter, update, upsert, sort=sort)
+        doc = after if return_document == ReturnDocument.AFTER else before
+        return decode(_project(doc, _projection_spec(projection))) if doc is not None else None
+
+    def _delete(self, filter, multi):
+        with self._write() as conn:
+            spec = self.database._text_spec(conn, self.name)
+            seqs = [seq for seq, _, _ in self._rows(conn, filter, limit=0 if multi else 1)]
+            self._delete_seqs(conn, seqs, spec)
+        return DeleteResult({"n": len(seqs)}, True)
+
+    def delete_one(self, filter, **kwargs):
+        return self._delete(filter, multi=False)
+
+    def delete_many(self, filter, **kwargs):
+        return self._delete(filter, multi=True)
+
+    def find_one_and_delete(self, filter, projection=None, sort=None, **kwargs):
+        with self._write() as conn:
+            spec = self.database._text_spec(conn, self.name)
+            rows = self._rows(conn, filter, sort=_sort_spec(sort), limit=1)
+            found = next(rows, None)
+            rows.close()
+            if found is None:
+                return None
+            self._delete_seqs(conn, [found[0]], spec)
+        return decode(_project(found[1], _projection_spec(projection)))
+
+    # InsertOne, UpdateOne/UpdateMany and DeleteOne/DeleteMany requests, one after another
+    def bulk_write(self, requests, ordered=True, **kwargs):
+        result = {"nInserted": 0, "nUpserted": 0, "nMatched": 0, "nModified": 0, "nRemoved": 0, "upserted": []}
+        for i, request in enumerate(requests):
+            if isinstance(request, InsertOne):
+                self.insert_one(request._doc)
+                result["nInserted"] += 1
+            elif isinstance(request, (UpdateOne, UpdateMany)):
+                matched, modified, upserted, _, _ = self._update(
+                    request._filter, request._doc, bool(request._upsert), multi=isinstance(request, UpdateMany)
+                )
+                result["nMatched"] += matched
+                result["nModified"] += modified
+                if upserted is not None:
+                    result["nUpserted"] += 1
+                    result["upserted"].append({"index": i, "_id": upserted})
+            elif isinstance(request, (DeleteOne, DeleteMany)):
+                result["nRemoved"] += self._delete(request._filter, multi=isinstance(request, DeleteMany)).deleted_count
+            else:
+                raise OperationFailure(f"Unsupported bulk write request {type(request).__name__}")
+        return BulkWriteResult(result, True)
+
+    # Indexes
+
+    def create_index(self, keys, **kwargs):
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        keys = list(keys.items()) if isinstance(keys, dict) else list(keys)
+        text_fields = [field for field, direction in keys if direction == TEXT]
+        if text_fields:
+            return self._create_text_index(text_fields, kwargs.get("weights") or {})
+        name = kwargs.get("name") or "_".join(f"{field}_{direction}" for field, direction in keys)
+        columns = ", ".join(f"{_expr(field, table='')} {'DESC' if direction == -1 else 'ASC'}" for field, direction in keys)
+        unique = "UNIQUE " if kwargs.get("unique") else ""
+        try:
+            self._conn().execute(f'CREATE {unique}INDEX IF NOT EXISTS "{self.name}__{name}" ON {self._table} ({columns})')
+        except sqlite3.IntegrityError as e:
+            raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} ({e})", DUPLICATE_KEY)
+        return name
+
+    def _create_text_index(self, fields, weights):
+        spec = [(field, weights.get(field, 1)) for field in fields]
+        with self._write() as conn:
+            existing = self.database._text_spec(conn, self.name)
+            if existing is not None:
+                if [tuple(s) for s in existing] != spec:
+                    raise OperationFailure(f"{self.name} already has a different text index", 85)
+                return "_".join(f"{field}_text" for field in fields)
+            columns = ", ".join(f'"{field}"' for field in fields)
+            conn.execute(f"CREATE VIRTUAL TABLE {self._fts} USING fts5({columns}, tokenize='porter unicode61')")
+            conn.execute("INSERT INTO _text_indexes (collection, fields) VALUES (?, ?)", (self.name, json.dumps(spec)))
+            # Index what is already there
+            for seq, doc in conn.execute(f"SELECT seq, doc FROM {self._table}").fetchall():
+                self._index_text(conn, seq, json.loads(doc), spec)
+        self.database._schema_version = None
+        return "_".join(f"{field}_text" for field in fields)
+
+
+class Cursor:
+    def __init__(self, collection, filter=None, projection=None, sort=None, limit=0, skip=0):
+        self.collection = collection
+        self._filter = filter or {}
+        self._projection = _projection_spec(projection)
+        self._sort = _sort_spec(sort)
+        self._limit = limit
+        self._skip = skip
+        self._connection = None
+
+    def sort(self, key_or_list, direction=None):
+        self._sort = _sort_spec(key_or_list, direction)
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def __iter__(self):
+        conn = self.collection._conn()
+        if self._connection is not None:
+            conn = self._connection
+        for _, raw, score in self.collection._rows(conn, self._filter, self._projection, self._sort, self._limit, self._skip):
+            yield decode(_project(raw, self._projection, score))
+
+    # SQLite's query plan in the shape of Mongo's explain(): a full table scan is COLLSCAN
+    def explain(self):
+        conn = self.collection._conn()
+        sql, params, _ = self.collection._select(conn, self._filter, self._projection, self._sort, self._limit, self._skip)
+        plan = None
+        for row in reversed(conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()):
+            detail = row[-1]
+            if "VIRTUAL TABLE" in detail:
+                stage = "TEXT"
+            elif detail.startswith(("SEARCH", "SCAN")) and ("INDEX" in detail or "PRIMARY KEY" in detail):
+                stage = "IXSCAN"
+            elif detail.startswith("SCAN"):
+                stage = "COLLSCAN"
+            elif "TEMP B-TREE" in detail:
+                stage = "SORT"
+            else:
+                continue
+            plan = {"stage": stage, "detail": detail, **({"inputStage": plan} if plan else {})}
+        return {"queryPlanner": {"winningPlan": plan or {}}}
+
+
+# The same API for asyncio callers: every call runs in a worker thread
+
+class AsyncCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def sort(self, key_or_list, direction=None):
+        self._cursor.sort(key_or_list, direction)
+        return self
+
+    def limit(self, limit):
+        self._cursor.limit(limit)
+        return self
+
+    def skip(self, skip):
+        self._cursor.skip(skip)
+        return self
+
+    async def to_list(self, length=None):
+        if length:
+            self._cursor.limit(length)
+        return await asyncio.to_thread(list, self._cursor)
+
+    # Read FETCH_ROWS at a time, each batch in whichever worker thread is free, on a
+    # connection of the cursor's own
+    async def __aiter__(self):
+        conn = self._cursor.collection.database._connect(check_same_thread=False)
+        self._cursor._connection = conn
+        documents = iter(self._cursor)
+        try:
+            while True:
+                batch = await asyncio.to_thread(lambda: list(itertools.islice(documents, FETCH_ROWS)))
+                if not batch:
+                    return
+                for document in batch:
+                    yield document
+        finally:
+            await asyncio.to_thread(lambda: (documents.close(), conn.close()))
+
+
+class AsyncCollection:
+    def __init__(self, collection):
+        self.collection = collection
+
+    def find(self, *args, **kwargs):
+        return AsyncCursor(self.collection.find(*args, **kwargs))
+
+    def __getitem__(self, name):
+        return AsyncCollection(self.collection[name])
+
+    def __getattr__(self, name):
+        attr = getattr(self.collection, name)
+        if isinstance(attr, Collection):
+            return AsyncCollection(attr)
+        if not callable(attr):
+            return attr
+
+        async def call(*args, **kwargs):
+            return await asyncio.to_thread(attr, *args, **kwargs)
+        return call
+
+
+class AsyncDatabase:
+    def __init__(self, database):
+        self.database = database
+
+    def __getitem__(self, name):
+        return AsyncCollection(self.database[name])
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
@@ -0,0 +1,175 @@
+import csv
+from datetime import datetime, time
+
+# Parsers (PyMuPDF, python-docx, openpyxl, pandas) are imported by the extractor that needs
+# them on its first call, so importing this module costs nothing and a process only loads
+# the parsers for the file types it actually handles.
+
+# DOCX paragraphs and plain-text lines are grouped into blocks of about this many characters
+BLOCK_CHARS = 8000
+SPREADSHEET_TYPES = ["xls", "xlsx", "xlsm", "csv"]
+
+# file type -> extractor(filetype, path, sheet_chars, max_rows), yielding (kind, text) like iter_blocks
+EXTRACTORS = {}
+
+# Decorator adding an extractor for one or more file types (replacing any already registered)
+def register(*filetypes):
+    def add(extractor):
+        for filetype in filetypes:
+            EXTRACTORS[filetype] = extractor
+        return extractor
+    return add
+
+
+# Compact cell text for prompts: no padding, dates without a midnight time, floats without
+# a trailing ".0", and no characters that would break the row format
+def format_cell(value):
+    if value is None or (isinstance(value, float) and value != value):
+        return ""
+    if isinstance(value, datetime):
+        return value.date().isoformat() if value.time() == time() else value.isoformat(sep=" ")
+    if isinstance(value, float):
+        return str(int(value)) if value.is_integer() else repr(round(value, 6))
+    return " ".join(str(value).split()).replace("|", "/")
+
+# Turn one sheet's rows into self-contained blocks of at most about block_chars: each starts
+# with the sheet name and column header, then one " | " delimited line per row.
+# The header is the first row with two or more filled cells; up to TITLE_ROWS single-cell rows
+# above it (titles) are kept as context. A sheet with more single-cell rows than that before
+# any header has one column, and all its rows are data. Rows past max_rows are left out, with
+# a note saying so.
+TITLE_ROWS = 3
+
+def iter_sheet_blocks(rows, sheet_name=None, block_chars=BLOCK_CHARS, max_rows=None):
+    sheet = [f"Sheet: {sheet_name}"] if sheet_name else []
+    titles = []
+    header = None
+    offset = 0
+    block = []
+    size = 0
+    count = 0
+    limited = False
+
+    def text(lines):
+        return "\n".join(([header] if header else []) + lines)
+
+    for row in rows:
+        cells = [format_cell(v) for v in row]
+        while cells and not cells[-1]:
+            cells.pop()
+        if not any(cells):
+            continue
+        data = [cells]
+        if header is None:
+            filled = [c for c in cells if c]
+            if len(filled) < 2 and len(titles) < TITLE_ROWS:
+                titles.append(" ".join(filled))
+                continue
+            if len(filled) < 2:
+                # One column: the rows taken for titles were data too
+                header = "\n".join(sheet)
+                data = [[t] for t in titles] + [filled]
+                titles = []
+            else:
+                # Leading empty columns are dropped from every row
+                offset = next(i for i, c in enumerate(cells) if c)
+                lines = sheet + (["Title: " + " / ".join(titles)] if titles else [])
+                lines.append("Columns: " + " | ".join(c or f"Column {i + 1}" for i, c in enumerate(cells[offset:])))
+                header = "\n".join(lines)
+                continue
+        for cells in data:
+            if max_rows is not None and count >= max_rows:
+                block.append(f"[Row limit of {max_rows} reached; remaining rows omitted]")
+                limited = True
+                break
+            if not any(cells[:offset]):
+                cells = cells[offset:]
+            line = " | ".join(cells)
+            if block and len(header) + size + len(line) + 1 > block_chars:
+                yield text(block)
+                block, size = [], 0
+            block.append(line)
+            size += len(line) + 1
+            count += 1
+        if limited:
+            break
+
+    if header is None:
+        # No tabular part, only a few loose cells
+        if titles:
+            yield "\n".join(sheet + titles)
+    elif block or (count == 0 and header):
+        yield text(block)
+
+# Every sheet of a workbook, streamed. openpyxl's read-only mode parses rows as they are
+# iterated, so memory stays flat however large the workbook is.
+def iter_spreadsheet_blocks(filetype, path, block_chars=BLOCK_CHARS, max_rows=None):
+    if filetype == "csv":
+        with open(path, "r", encoding="utf-8-sig", newline="") as f:
+            yield from iter_sheet_blocks(csv.reader(f), None, block_chars, max_rows)
+    elif filetype == "xls":
+        # The old binary format has no streaming reader; pandas loads one sheet at a time
+        import pandas as pd
+        with pd.ExcelFile(path) as workbook:
+            for name in workbook.sheet_names:
+                df = workbook.parse(name, header=None)
+                yield from iter_sheet_blocks(df.itertuples(index=False, name=None), name, block_chars, max_rows)
+    else:
+        from openpyxl import load_workbook
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        try:
+            for sheet in workbook.worksheets:
+                yield from iter_sheet_blocks(sheet.iter_rows(values_only=True), sheet.title, block_chars, max_rows)
+        finally:
+            workbook.close()
+
+def group_blocks(lines, block_chars=BLOCK_CHARS):
+    block = []
+    size = 0
+    for line in lines:
+        if size + len(line) > block_chars and block:
+            yield "\n".join(block)
+            block, size = [], 0
+        block.append(line)
+        size += len(line) + 1
+    if block:
+        yield "\n".join(block)
+
+@register("pdf")
+def pdf_blocks(filetype, path, sheet_chars, max_rows):
+    import fitz
+    # fitz reads a file-backed document lazily, so only one page is decoded at a time
+    with fitz.open(path) as doc:
+        for page in doc:
+            yield "page", page.get_text()
+
+@register("docx", "doc")
+def docx_blocks(filetype, path, sheet_chars, max_rows):
+    from docx import Document
+    paragraphs = (para.text for para in Document(path).paragraphs if para.text.strip())
+    for block in group_blocks(paragraphs):
+        yield "block", block
+
+@register(*SPREADSHEET_TYPES)
+def spreadsheet_blocks(filetype, path, sheet_chars, max_rows):
+    for block in iter_spreadsheet_blocks(filetype, path, sheet_chars, max_rows):
+        yield "rows", block
+
+@register("txt")
+def text_blocks(filetype, path, sheet_chars, max_rows):
+    with open(path, "r", encoding="utf-8") as f:
+        for block in group_blocks(line.rstrip("\n") for line in f):
+            yield "block", block
+
+# Yield a file's text one unit at a time as (kind, text): "page" for PDFs, "rows" for
+# spreadsheets, "block" otherwise, so a long document is never held in memory as one string.
+# Spreadsheet blocks are at most about sheet_chars and each carries its sheet's header.
+# File types without a registered extractor yield nothing.
+def iter_blocks(filetype, path, sheet_chars=BLOCK_CHARS, max_rows=None):
+    extractor = EXTRACTORS.get(filetype)
+    if extractor is not None:
+        yield from extractor(filetype, path, sheet_chars, max_rows)
+
+# Extract plain text from a file on disk based on its extension
+def extract_text(filetype, path):
+    return "\n".join(text for _, text in iter_blocks(filetype, path))
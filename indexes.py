@@ -0,0 +1,106 @@
+import sys
+from bson import ObjectId
+from pymongo import ASCENDING, TEXT
+from storage import open_storage
+
+# Compound indexes backing every query app.py runs on a request path: (collection, keys[, options])
+INDEXES = [
+    ("btech_conversations", [("session_id", ASCENDING), ("timestamp", ASCENDING), ("_id", ASCENDING)]),
+    ("chat_sessions", [("created_at", ASCENDING), ("_id", ASCENDING)]),
+    ("documents", [("session_id", ASCENDING), ("uploaded_at", ASCENDING), ("_id", ASCENDING)]),
+    ("documents", [("session_id", ASCENDING), ("filename", ASCENDING)]),
+    ("documents", [("sha256", ASCENDING), ("status", ASCENDING)]),
+    ("document_chunks", [("sha256", ASCENDING), ("ordinal", ASCENDING)]),
+    ("document_chunks", [("doc_id", ASCENDING), ("ordinal", ASCENDING)]),
+    ("document_chunks", [("session_id", ASCENDING)]),
+    ("document_chunks", [("staging", ASCENDING)], {"sparse": True}),
+    ("document_pages", [("sha256", ASCENDING), ("ordinal", ASCENDING)]),
+    ("document_pages", [("staging", ASCENDING)], {"sparse": True}),
+    ("fs.files", [("sha256", ASCENDING)]),
+    ("deletion_jobs", [("status", ASCENDING), ("created_at", ASCENDING)]),
+    ("fs.files", [("session_id", ASCENDING), ("filename", ASCENDING)]),
+    # Text indexes for /search; Mongo allows one per collection
+    ("btech_conversations", [("question", TEXT), ("answer", TEXT)], {"weights": {"question": 2}}),
+    ("document_chunks", [("text", TEXT)]),
+    ("documents", [("content", TEXT)]),
+    # GridFS creates this one on first write; declared with the same options so a fresh
+    # database passes the check before anything is uploaded
+    ("fs.chunks", [("files_id", ASCENDING), ("n", ASCENDING)], {"unique": True}),
+]
+
+# (description, collection, filter, sort) for each hot query, checked with explain()
+HOT_QUERIES = [
+    ("history page", "btech_conversations", {"session_id": "s"}, [("timestamp", 1), ("_id", 1)]),
+    ("history page, newest first", "btech_conversations", {"session_id": "s"}, [("timestamp", -1), ("_id", -1)]),
+    ("delete session chats", "btech_conversations", {"session_id": "s"}, None),
+    ("session lookup", "chat_sessions", {"_id": "s", "deleted_at": {"$exists": False}}, None),
+    ("sessions page", "chat_sessions", {"deleted_at": {"$exists": False}}, [("created_at", 1), ("_id", 1)]),
+    ("documents page", "documents", {"session_id": "s"}, [("uploaded_at", 1), ("_id", 1)]),
+    ("document refs for index", "documents", {"session_id": "s"}, None),
+    ("duplicate filename check", "documents", {"session_id": "s", "filename": "f"}, None),
+    ("refs waiting on extraction", "documents", {"sha256": "h", "status": "processing"}, None),
+    ("document by id", "documents", {"_id": ObjectId()}, None),
+    ("shared chunks for session index", "document_chunks", {"sha256": "h"}, [("ordinal", 1)]),
+    ("inline chunks for session index", "document_chunks", {"doc_id": ObjectId()}, [("ordinal", 1)]),
+    ("delete shared chunks", "document_chunks", {"sha256": "h"}, None),
+    ("delete legacy chunks", "document_chunks", {"session_id": "s"}, None),
+    ("chunk texts for a lazy index", "document_chunks", {"_id": {"$in": [ObjectId()]}}, None),
+    ("promote or discard staged chunks", "document_chunks", {"staging": "x"}, None),
+    ("pages of a blob", "document_pages", {"sha256": "h"}, [("ordinal", 1)]),
+    ("promote or discard staged pages", "document_pages", {"staging": "x"}, None),
+    ("extracted text by hash", "extracted_texts", {"_id": "h"}, None),
+    ("blob by hash", "fs.files", {"sha256": "h"}, None),
+    ("legacy blobs by session", "fs.files", {"session_id": "s"}, None),
+    ("blob chunks", "fs.chunks", {"files_id": ObjectId()}, [("n", 1)]),
+    ("upload job", "upload_jobs", {"_id": "j"}, None),
+    ("search chats", "btech_conversations", {"$text": {"$search": "t"}, "session_id": "s"}, None),
+    ("search chunks", "document_chunks", {"$text": {"$search": "t"}}, None),
+    ("search inline documents", "documents", {"$text": {"$search": "t"}, "chunked": {"$ne": True}}, None),
+    ("claim deletion job", "deletion_jobs", {"status": "queued"}, [("created_at", 1)]),
+    ("blob chunks to delete", "fs.chunks", {"files_id": {"$in": [ObjectId()]}}, None),
+]
+
+
+def ensure_indexes(db):
+    for collection, keys, *options in INDEXES:
+        db[collection].create_index(keys, **(options[0] if options else {}))
+
+# Every stage name in a winning plan, covering both classic and slot-based explain output
+def plan_stages(plan):
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for key in ("inputStage", "queryPlan", "winningPlan"):
+            stages.extend(plan_stages(plan.get(key)))
+        for child in plan.get("inputStages", []):
+            stages.extend(plan_stages(child))
+    return stages
+
+# Returns a list of (description, stages) for queries that fall back to a collection scan
+def check_query_plans(db):
+    failures = []
+    for description, collection, query, sort in HOT_QUERIES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        stages = plan_stages(cursor.explain().get("queryPlanner", {}).get("winningPlan"))
+        if "COLLSCAN" in stages:
+            failures.append((description, stages))
+    return failures
+
+
+# python indexes.py          create the indexes
+# python indexes.py --check  also explain() every hot query and exit 1 on any COLLSCAN
+if __name__ == "__main__":
+    db = open_storage().db
+    ensure_indexes(db)
+    print(f"Ensured {len(INDEXES)} indexes.")
+
+    if "--check" in sys.argv:
+        failures = check_query_plans(db)
+        for description, stages in failures:
+            print(f"COLLSCAN: {description} ({' > '.join(stages)})")
+        if failures:
+            sys.exit(1)
+        print(f"All {len(HOT_QUERIES)} hot queries use an index.")
@@ -0,0 +1,87 @@
+import os
+import tempfile
+from bson import ObjectId
+from storage import open_storage
+from extractors import iter_blocks, SPREADSHEET_TYPES
+from retrieval import stream_chunks
+from dedup import sketch
+
+# Runs inside the ingestion process pool. Each pool process opens its own
+# storage connection on first use instead of inheriting the web worker's.
+_db = None
+_fs = None
+
+# Pages and chunks are written this many records at a time
+WRITE_BATCH = 100
+
+def get_db():
+    global _db, _fs
+    if _db is None:
+        storage = open_storage()
+        _db = storage.db
+        if _fs is None:
+            _fs = storage.fs
+    return _db
+
+def get_fs():
+    get_db()
+    return _fs
+
+class _BatchWriter:
+    def __init__(self, collection):
+        self.collection = collection
+        self.pending = []
+
+    def add(self, record):
+        self.pending.append(record)
+        if len(self.pending) >= WRITE_BATCH:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.collection.insert_many(self.pending)
+            self.pending = []
+
+# Copy the blob to a temporary file one GridFS chunk at a time, then extract it page by page
+# (PDF) or block by block, writing pages and retrieval chunks as they are produced.
+# Records are tagged with staging_id rather than the content hash; the web process makes
+# them visible once it knows this extraction is the one to keep.
+# Spreadsheet blocks are already chunk-sized, each with its sheet's header, and are used as
+# chunks unchanged; max_rows caps the rows read per sheet. Each chunk carries its sketch
+# (dedup.py), so finding near-duplicates across a session's documents needs no re-tokenizing.
+# Returns a summary: {"pages": ..., "chunks": ..., "chars": ...}.
+def extract_file(file_id, filetype, staging_id, chunk_chars=1200, max_rows=None):
+    grid_out = get_fs().get(ObjectId(file_id))
+    fd, path = tempfile.mkstemp(suffix="." + filetype)
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            while True:
+                chunk = grid_out.readchunk()
+                if not chunk:
+                    break
+                tmp.write(chunk)
+
+        db = get_db()
+        pages = _BatchWriter(db["document_pages"])
+        chunks = _BatchWriter(db["document_chunks"])
+        summary = {"pages": 0, "chunks": 0, "chars": 0}
+
+        def page_texts():
+            for kind, text in iter_blocks(filetype, path, chunk_chars, max_rows):
+                pages.add({"staging": staging_id, "ordinal": summary["pages"], "kind": kind, "text": text})
+                summary["pages"] += 1
+                summary["chars"] += len(text)
+                yield text
+
+        if filetype in SPREADSHEET_TYPES:
+            texts = page_texts()
+        else:
+            texts = stream_chunks(page_texts(), chunk_chars)
+        for text in texts:
+            chunks.add({"staging": staging_id, "ordinal": summary["chunks"], "text": text, "sketch": sketch(text)})
+            summary["chunks"] += 1
+        pages.flush()
+        chunks.flush()
+        return summary
+    finally:
+        os.remove(path)
@@ -0,0 +1,391 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+# Provider statuses worth retrying: rate limited, timed out, or temporarily down
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+class GatewayError(Exception):
+    status = 502
+    retry_after = None
+
+# No free slot within the queue timeout; the caller should back off
+class GatewayOverloaded(GatewayError):
+    status = 503
+    retry_after = 2
+
+# The provider kept rate limiting us until retries ran out
+class GatewayRateLimited(GatewayError):
+    status = 429
+    retry_after = 5
+
+class GatewayTimeout(GatewayError):
+    status = 504
+
+
+def is_retryable(error):
+    if isinstance(error, (httpx.TransportError, ConnectionError, TimeoutError)):
+        return True
+    return getattr(error, "status_code", None) in RETRY_STATUSES
+
+
+# Identical prompts that are in flight at the same time share one provider call
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+# Done-callback for an attempt given up on: a stream it opens afterwards is closed unread
+def _close_late_result(future):
+    if not future.cancelled() and future.exception() is None:
+        close = getattr(future.result(), "close", None)
+        if close is not None:
+            close()
+
+
+# Iterator over a provider stream that gives back its concurrency slot exactly once,
+# when exhausted or closed
+class SlotStream:
+    def __init__(self, chunks, release):
+        self._chunks = iter(chunks)
+        self._release = release
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._chunks)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._release()
+
+
+# Stands in for a model client that is only made when first used, once per process: importing
+# the app connects nothing, and workers forked from a preloaded app each make their own
+# instead of sharing the parent's connection pool.
+class LazyClient:
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._client = self._factory()
+                    self._pid = os.getpid()
+        return self._client
+
+    @property
+    def chat(self):
+        return self.get().chat
+
+
+# Wraps client.chat.completions.create with a concurrency limit, an overall deadline,
+# jittered exponential backoff and single-flight deduplication.
+# Each attempt is cut off at attempt_timeout (default: no limit of its own) or when the
+# deadline passes, whichever is first, and none is started with under min_attempt seconds
+# left. The SDK's timeout can't be set per call, so attempts run on a thread pool here and
+# one that is cut off keeps its thread until the client's timeout_sec ends it.
+class LLMGateway:
+    def __init__(self, client, model, max_concurrency=8, queue_timeout=2.0, deadline=60.0,
+                 max_retries=3, backoff_base=0.5, backoff_max=8.0, attempt_timeout=None, min_attempt=1.0):
+        self.client = client
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.min_attempt = min_attempt
+        self._attempts = None
+        self._attempts_pid = None
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.calls = 0
+        self.coalesced = 0
+        self.retries = 0
+        self.rejected = 0
+        self.failures = 0
+
+    def _key(self, messages, kwargs):
+        payload = [[m.role, m.content] for m in messages]
+        raw = json.dumps([self.model, payload, kwargs], sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def _acquire(self):
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            with self._lock:
+                self.rejected += 1
+            raise GatewayOverloaded("Too many requests to the language model right now, please retry shortly")
+        with self._lock:
+            self.in_flight += 1
+
+    def _release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    # How long a coalesced caller waits for the leader; no limit when slots are waited for
+    # without one (queue_timeout=None, as task.py's batch mode does)
+    def _follow_timeout(self):
+        return None if self.queue_timeout is None else self.deadline + self.queue_timeout
+
+    def _backoff(self, attempt):
+        # Full jitter: a random wait up to the exponential cap spreads out synchronized retries
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    # Seconds the next attempt may take, or None when too little of the deadline is left
+    def _attempt_budget(self, started):
+        remaining = self.deadline - (time.monotonic() - started)
+        if remaining < self.min_attempt:
+            return None
+        return remaining if self.attempt_timeout is None else min(self.attempt_timeout, remaining)
+
+    def _out_of_time(self):
+        with self._lock:
+            self.failures += 1
+        return GatewayTimeout("The language model did not answer in time")
+
+    # After a failed attempt: None to retry, otherwise the exception to raise
+    def _give_up(self, error, attempt, started, wait):
+        out_of_time = time.monotonic() - started + wait + self.min_attempt > self.deadline
+        if is_retryable(error) and attempt < self.max_retries and not out_of_time:
+            with self._lock:
+                self.retries += 1
+            return None
+        with self._lock:
+            self.failures += 1
+        if getattr(error, "status_code", None) == 429:
+            return GatewayRateLimited("The language model provider is rate limiting requests")
+        if is_retryable(error) and out_of_time:
+            return GatewayTimeout("The language model did not answer in time")
+        return error
+
+    # Threads that run the attempts, one pool per process as a fork does not copy them
+    def _attempt_pool(self):
+        if self._attempts_pid != os.getpid():
+            with self._lock:
+                if self._attempts_pid != os.getpid():
+                    self._attempts = ThreadPoolExecutor(self.max_concurrency, thread_name_prefix="llm-attempt")
+                    self._attempts_pid = os.getpid()
+        return self._attempts
+
+    def _attempt(self, timeout, **kwargs):
+        future = self._attempt_pool().submit(self.client.chat.completions.create, model=self.model, **kwargs)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            if not future.cancel():
+                future.add_done_callback(_close_late_result)
+            raise TimeoutError(f"No answer within {timeout:.1f}s") from None
+
+    # Call with retries until success, a non-retryable error, or the deadline
+    def _call(self, started, **kwargs):
+        attempt = 0
+        while True:
+            timeout = self._attempt_budget(started)
+            if timeout is None:
+                raise self._out_of_time()
+            try:
+                with self._lock:
+                    self.calls += 1
+                return self._attempt(timeout, **kwargs)
+            except Exception as e:
+                wait = self._backoff(attempt)
+                error = self._give_up(e, attempt, started, wait)
+                if error is e:
+                    raise
+                if error is not None:
+                    raise error from e
+                time.sleep(wait)
+                attempt += 1
+
+    def complete(self, messages, **kwargs):
+        key = self._key(messages, kwargs)
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            if not flight.done.wait(self._follow_timeout()):
+                raise GatewayTimeout("The language model did not answer in time")
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            started = time.monotonic()
+            self._acquire()
+            try:
+                flight.result = self._call(started, messages=messages, **kwargs)
+            finally:
+                self._release()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+        return flight.result
+
+    # Streaming holds a slot until the stream is closed; retries only happen before the first
+    # chunk. The slot is taken here, not lazily, so overload is reported before any output.
+    def stream(self, messages, **kwargs):
+        started = time.monotonic()
+        self._acquire()
+        try:
+            chunks = self._call(started, messages=messages, stream=True, **kwargs)
+        except Exception:
+            self._release()
+            raise
+        return SlotStream(chunks, self._release)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_concurrency": self.max_concurrency,
+                "in_flight": self.in_flight,
+                "calls": self.calls,
+                "coalesced": self.coalesced,
+                "retries": self.retries,
+                "rejected": self.rejected,
+                "failures": self.failures
+            }
+
+
+# Async iterator counterpart of SlotStream for an AsyncAI21Client stream
+class AsyncSlotStream:
+    def __init__(self, chunks, release):
+        self._chunks = chunks.__aiter__()
+        self._release = release
+        self._closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self._chunks.__anext__()
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._release()
+
+
+# The same gateway for the async serving mode: the client is an AsyncAI21Client, waiting
+# happens on the event loop, and coalesced callers share one asyncio future.
+# Limits and counters apply per event loop, like the sync gateway's apply per process.
+class AsyncLLMGateway(LLMGateway):
+    def __init__(self, client, model, max_concurrency=8, **kwargs):
+        super().__init__(client, model, max_concurrency, **kwargs)
+        self._slots = asyncio.Semaphore(max_concurrency)
+
+    async def _acquire(self):
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self.rejected += 1
+            raise GatewayOverloaded("Too many requests to the language model right now, please retry shortly")
+        with self._lock:
+            self.in_flight += 1
+
+    async def _attempt(self, timeout, **kwargs):
+        try:
+            return await asyncio.wait_for(self.client.chat.completions.create(model=self.model, **kwargs), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"No answer within {timeout:.1f}s") from None
+
+    async def _call(self, started, **kwargs):
+        attempt = 0
+        while True:
+            timeout = self._attempt_budget(started)
+            if timeout is None:
+                raise self._out_of_time()
+            try:
+                with self._lock:
+                    self.calls += 1
+                return await self._attempt(timeout, **kwargs)
+            except Exception as e:
+                wait = self._backoff(attempt)
+                error = self._give_up(e, attempt, started, wait)
+                if error is e:
+                    raise
+                if error is not None:
+                    raise error from e
+                await asyncio.sleep(wait)
+                attempt += 1
+
+    async def complete(self, messages, **kwargs):
+        key = self._key(messages, kwargs)
+        flight = self._flights.get(key)
+        if flight is not None:
+            with self._lock:
+                self.coalesced += 1
+            try:
+                # shield: one follower timing out must not cancel the leader's call
+                return await asyncio.wait_for(asyncio.shield(flight), self._follow_timeout())
+            except asyncio.TimeoutError:
+                raise GatewayTimeout("The language model did not answer in time")
+
+        flight = self._flights[key] = asyncio.get_running_loop().create_future()
+        try:
+            started = time.monotonic()
+            await self._acquire()
+            try:
+                result = await self._call(started, messages=messages, **kwargs)
+            finally:
+                self._release()
+        except BaseException as e:
+            if not flight.done():
+                flight.set_exception(e if isinstance(e, Exception) else GatewayError("Request cancelled"))
+                # Mark retrieved, so a flight nobody else joined does not log a warning
+                flight.exception()
+            raise
+        finally:
+            self._flights.pop(key, None)
+        flight.set_result(result)
+        return result
+
+    async def stream(self, messages, **kwargs):
+        started = time.monotonic()
+        await self._acquire()
+        try:
+            chunks = await self._call(started, messages=messages, stream=True, **kwargs)
+        except BaseException:
+            self._release()
+            raise
+        return AsyncSlotStream(chunks, self._release)
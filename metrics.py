@@ -0,0 +1,204 @@
+import bisect
+import contextvars
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from sub-millisecond Mongo lookups to slow model answers
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _label_text(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+def _number(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(n, "") for n in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_label_text(self.labels, key)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.labels = tuple(labels)
+        # label values -> [per-bucket counts (+Inf last), sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(n, "") for n in self.labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.labels + ("le",)
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += n
+                    le = "+Inf" if bound == float("inf") else _number(bound)
+                    lines.append(f"{self.name}_bucket{_label_text(names, key + (le,))} {cumulative}")
+                lines.append(f"{self.name}_sum{_label_text(self.labels, key)} {_number(round(total, 6))}")
+                lines.append(f"{self.name}_count{_label_text(self.labels, key)} {count}")
+        return lines
+
+
+# A value read when /metrics is scraped, e.g. a cache size that is already tracked elsewhere
+class Gauge:
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+        _registry.append(self)
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {_number(self.read())}"]
+
+
+# Current resident set size of this process; peak RSS where /proc is not available
+def resident_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # Unix only, so imported here rather than by every importer of this module
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+REQUEST_SECONDS = Histogram(
+    "chatbot_request_seconds", "Request duration by route", labels=("route", "method", "status")
+)
+PHASE_SECONDS = Histogram(
+    "chatbot_phase_seconds", "Time spent in each phase of a request", labels=("route", "phase")
+)
+REQUEST_ERRORS = Counter(
+    "chatbot_request_errors_total", "Responses with a 5xx status", labels=("route", "status")
+)
+LLM_ERRORS = Counter(
+    "chatbot_llm_errors_total", "Failed language model calls by error type", labels=("error",)
+)
+CACHE_LOOKUPS = Counter(
+    "chatbot_cache_lookups_total", "Context and answer cache lookups", labels=("cache", "result")
+)
+PROMPT_TOKENS = Histogram(
+    "chatbot_prompt_tokens", "Estimated tokens sent to the model per request",
+    buckets=(100, 250, 500, 1000, 2000, 3000, 4000, 6000, 8000, 16000), labels=("mode",)
+)
+UPLOAD_BYTES = Histogram(
+    "chatbot_upload_bytes", "Size of each uploaded document",
+    buckets=(1e3, 1e4, 1e5, 5e5, 1e6, 5e6, 1e7, 2.5e7, 5e7, 1e8), labels=("filetype",)
+)
+EXTRACTED_CHARS = Histogram(
+    "chatbot_extracted_text_chars", "Length of the text extracted from each new blob",
+    buckets=(1e3, 1e4, 1e5, 5e5, 1e6, 5e6, 1e7), labels=("filetype",)
+)
+EXTRACTION_SECONDS = Histogram(
+    "chatbot_extraction_seconds", "Queue wait plus text extraction time per blob",
+    labels=("filetype", "result")
+)
+
+
+# Phase timings for the request being handled. A context variable, so the same helpers
+# work for Flask's threads and the async handlers' tasks.
+_timings = contextvars.ContextVar("request_timings", default=None)
+
+class RequestTimings:
+    def __init__(self, route):
+        self.route = route
+        self.started = time.perf_counter()
+        self.phases = {}
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    # Server-Timing header value, durations in milliseconds
+    def header(self, total):
+        parts = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.phases.items()]
+        parts.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(parts)
+
+def start_request(route):
+    timings = RequestTimings(route)
+    _timings.set(timings)
+    return timings
+
+# Record the request; returns the Server-Timing value for it
+def finish_request(method, status):
+    timings = _timings.get()
+    if timings is None:
+        return None
+    _timings.set(None)
+    total = time.perf_counter() - timings.started
+    REQUEST_SECONDS.observe(total, route=timings.route, method=method, status=status)
+    if status >= 500:
+        REQUEST_ERRORS.inc(route=timings.route, status=status)
+    return timings.header(total)
+
+def current():
+    return _timings.get()
+
+# Time one phase of the current request; outside a request only the histogram is updated
+@contextmanager
+def phase(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(name, time.perf_counter() - started)
+
+# timings: for work that outlives the request's hooks, like a streamed response body
+def record_phase(name, seconds, timings=None):
+    timings = timings or _timings.get()
+    route = timings.route if timings is not None else "background"
+    if timings is not None:
+        timings.add(name, seconds)
+    PHASE_SECONDS.observe(seconds, route=route, phase=name)
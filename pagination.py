@@ -0,0 +1,117 @@
+import base64
+import json
+from datetime import datetime
+from bson import ObjectId
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+
+
+# Cursors are opaque to clients: the sort value and _id of the last item returned
+def encode_cursor(value, last_id):
+    payload = {
+        "v": value.isoformat() if isinstance(value, datetime) else value,
+        "d": isinstance(value, datetime),
+        "i": str(last_id),
+        "o": isinstance(last_id, ObjectId)
+    }
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        value = datetime.fromisoformat(payload["v"]) if payload["d"] else payload["v"]
+        last_id = ObjectId(payload["i"]) if payload["o"] else payload["i"]
+        return value, last_id
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+# limit, after and fields from a query string or JSON body
+def page_params(params, default_limit=DEFAULT_LIMIT):
+    try:
+        limit = int(params.get("limit") or default_limit)
+    except (TypeError, ValueError):
+        raise ValueError("limit must be a number")
+    fields = params.get("fields")
+    if isinstance(fields, str):
+        fields = [f.strip() for f in fields.split(",") if f.strip()]
+    return {
+        "limit": min(max(limit, 1), MAX_LIMIT),
+        "after": decode_cursor(params.get("after")),
+        "fields": fields or None
+    }
+
+# Keyset pagination on (sort_field, _id): the find arguments for one page.
+# Returns (query, projection, sort, limit); one extra item is fetched to see if more follow.
+def page_query(query, sort_field, page, projection=None, descending=False):
+    direction = -1 if descending else 1
+    if projection is not None:
+        projection = dict(projection, **{sort_field: 1})
+    if page["after"] is not None:
+        value, last_id = page["after"]
+        op = "$lt" if descending else "$gt"
+        query = {"$and": [query, {"$or": [
+            {sort_field: {op: value}},
+            {sort_field: value, "_id": {op: last_id}}
+        ]}]}
+    return query, projection, [(sort_field, direction), ("_id", direction)], page["limit"] + 1
+
+# Trim the extra item and make the cursor for the next page. Returns (docs, next_cursor).
+def finish_page(docs, sort_field, page):
+    next_cursor = None
+    if len(docs) > page["limit"]:
+        docs = docs[:page["limit"]]
+        next_cursor = encode_cursor(docs[-1].get(sort_field), docs[-1]["_id"])
+    return docs, next_cursor
+
+# Position of a (sort value, _id) pair as Mongo orders them: a missing or null value before
+# any other, so records without one compare instead of raising TypeError
+def sort_position(value, doc_id):
+    return value is not None, value, doc_id
+
+# Fold records that are not in the collection yet (e.g. a write-behind buffer) into a fetched
+# page: keep those past the cursor, drop any already fetched, and re-sort. pending must
+# already match the page's query.
+def merge_pending(docs, pending, sort_field, page, descending=False):
+    def key(d):
+        return sort_position(d.get(sort_field), d["_id"])
+
+    if page["after"] is not None:
+        after = sort_position(*page["after"])
+        if descending:
+            pending = [d for d in pending if key(d) < after]
+        else:
+            pending = [d for d in pending if key(d) > after]
+    seen = {d["_id"] for d in docs}
+    docs = docs + [d for d in pending if d["_id"] not in seen]
+    docs.sort(key=key, reverse=descending)
+    return docs[:page["limit"] + 1]
+
+def fetch_page(collection, query, sort_field, page, projection=None, descending=False, pending=()):
+    query, projection, sort, limit = page_query(query, sort_field, page, projection, descending)
+    docs = list(collection.find(query, projection).sort(sort).limit(limit))
+    if pending:
+        docs = merge_pending(docs, pending, sort_field, page, descending)
+    return finish_page(docs, sort_field, page)
+
+# The same with pymongo's AsyncMongoClient
+async def afetch_page(collection, query, sort_field, page, projection=None, descending=False, pending=()):
+    query, projection, sort, limit = page_query(query, sort_field, page, projection, descending)
+    docs = await collection.find(query, projection).sort(sort).limit(limit).to_list(limit)
+    if pending:
+        docs = merge_pending(docs, pending, sort_field, page, descending)
+    return finish_page(docs, sort_field, page)
+
+# Mongo projection for the requested output fields; field_map maps output names to stored fields
+def projection_for(fields, field_map):
+    names = fields or list(field_map)
+    projection = {field_map[name]: 1 for name in names if field_map.get(name)}
+    projection.setdefault("_id", 1)
+    return projection
+
+def select_fields(item, fields):
+    if not fields:
+        return item
+    return {k: v for k, v in item.items() if k in fields}
@@ -0,0 +1,87 @@
+import math
+import re
+
+WORD_RE = re.compile(r"\S+")
+
+
+# Local token estimate, no tokenizer download or API call. English prose averages
+# about 4 characters or 0.75 words per token; taking the larger of the two keeps
+# number-heavy spreadsheet text from being undercounted.
+def estimate_tokens(text):
+    if not text:
+        return 0
+    return max(math.ceil(len(text) / 4), math.ceil(len(WORD_RE.findall(text)) * 4 / 3))
+
+# Cut text to fit a token budget at the last paragraph, line or sentence boundary that fits
+def truncate_to_tokens(text, budget):
+    if estimate_tokens(text) <= budget:
+        return text
+    if budget <= 0:
+        return ""
+    # Characters are a safe upper bound to start from, then walk back to a boundary
+    limit = min(len(text), budget * 4)
+    while limit > 0 and estimate_tokens(text[:limit]) > budget:
+        limit = int(limit * 0.9)
+    head = text[:limit]
+    for boundary in ("\n\n", "\n", ". ", "? ", "! "):
+        cut = head.rfind(boundary)
+        if cut >= limit // 2:
+            return head[:cut + (1 if boundary[0] in ".?!" else 0)].rstrip()
+    cut = head.rfind(" ")
+    return head[:cut].rstrip() if cut > 0 else head
+
+# A chunk whose text was also found in other files (see dedup.py) names them too
+def format_chunk(chunk, text=None):
+    label = f"{chunk['filename']} ({chunk['filetype']})"
+    if chunk.get("also_in"):
+        label += ", also in " + ", ".join(f"{s['filename']} ({s['filetype']})" for s in chunk["also_in"])
+    return f"[From {label}]\n{chunk['text'] if text is None else text}\n\n"
+
+# Pack chunks (highest priority first) into a token budget. No single document may take more
+# than doc_quota of the budget while others are waiting; leftover room is filled afterwards.
+# Returns (packed_text, report).
+def pack_chunks(chunks, budget, doc_quota=0.6, min_piece=40):
+    filenames = {c["filename"] for c in chunks}
+    quota = budget if len(filenames) <= 1 else max(int(budget * doc_quota), min_piece)
+
+    selected = {}
+    used = 0
+    per_doc = {}
+    truncated = 0
+
+    def place(i, chunk, allowance):
+        nonlocal used, truncated
+        cost = estimate_tokens(format_chunk(chunk))
+        if cost <= allowance:
+            selected[i] = chunk["text"]
+        else:
+            header = estimate_tokens(format_chunk(chunk, ""))
+            text = truncate_to_tokens(chunk["text"], allowance - header)
+            if estimate_tokens(text) < min_piece:
+                return
+            selected[i] = text
+            truncated += 1
+            cost = estimate_tokens(format_chunk(chunk, text))
+        used += cost
+        per_doc[chunk["filename"]] = per_doc.get(chunk["filename"], 0) + cost
+
+    for i, chunk in enumerate(chunks):
+        room = min(budget - used, quota - per_doc.get(chunk["filename"], 0))
+        if room > 0:
+            place(i, chunk, room)
+    # Second pass: hand any budget left over to chunks held back by their document's quota
+    for i, chunk in enumerate(chunks):
+        if i not in selected and budget - used > min_piece:
+            place(i, chunk, budget - used)
+
+    packed = "".join(format_chunk(chunks[i], selected[i]) for i in sorted(selected))
+    total = sum(estimate_tokens(format_chunk(c)) for c in chunks)
+    report = {
+        "budget_tokens": budget,
+        "context_tokens": used,
+        "chunks_packed": len(selected),
+        "chunks_truncated": truncated,
+        "chunks_dropped": len(chunks) - len(selected),
+        "tokens_dropped": max(total - used, 0)
+    }
+    return packed, report
@@ -0,0 +1,130 @@
+import math
+import re
+from collections import Counter
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+# Very common words carry no signal for BM25 and only bloat the postings
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for",
+    "from", "how", "i", "in", "is", "it", "me", "of", "on", "or", "that", "the",
+    "this", "to", "was", "what", "when", "where", "which", "who", "why", "with",
+    "you", "your",
+}
+
+
+def tokenize(text):
+    return [t for t in TOKEN_RE.findall(text.lower()) if t not in STOPWORDS]
+
+
+# Split text into chunks of roughly max_chars, keeping paragraphs together
+def chunk_text(text, max_chars=1200, overlap=150):
+    paragraphs = [p.strip() for p in re.split(r"\n\s*\n|\n", text) if p.strip()]
+    chunks = []
+    current = []
+    size = 0
+    for para in paragraphs:
+        # A single paragraph longer than a chunk is cut on word boundaries
+        while len(para) > max_chars:
+            cut = para.rfind(" ", 0, max_chars)
+            if cut <= 0:
+                cut = max_chars
+            if current:
+                chunks.append("\n".join(current))
+                current, size = [], 0
+            chunks.append(para[:cut].strip())
+            step = cut - overlap if cut > 2 * overlap else cut
+            para = para[step:].strip()
+        if size + len(para) > max_chars and current:
+            chunks.append("\n".join(current))
+            # Carry the last paragraph over so answers spanning a boundary survive
+            tail = current[-1] if overlap and len(current[-1]) <= overlap else None
+            current = [tail] if tail else []
+            size = len(tail) if tail else 0
+        current.append(para)
+        size += len(para) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+# chunk_text over a stream of pages or blocks: only a few chunks' worth of text is buffered,
+# and chunks may still span a page boundary
+def stream_chunks(blocks, max_chars=1200, overlap=150):
+    buffer = ""
+    for block in blocks:
+        buffer = f"{buffer}\n{block}" if buffer else block
+        if len(buffer) >= max_chars * 4:
+            chunks = chunk_text(buffer, max_chars, overlap)
+            # The last chunk may continue on the next page, so it goes back in the buffer
+            yield from chunks[:-1]
+            buffer = chunks[-1] if chunks else ""
+    if buffer:
+        yield from chunk_text(buffer, max_chars, overlap)
+
+
+class BM25Index:
+    def __init__(self, chunks=(), k1=1.5, b=0.75, fingerprint=None, text_limit=None):
+        # chunks: iterable of dicts with at least a "text" key; more can be added later
+        # fingerprint: identifies the document set the chunks came from
+        # text_limit: past this many characters of text the index keeps only postings and
+        # chunk metadata (lazy), and callers load the text of the chunks they pick
+        self.chunks = []
+        self.fingerprint = fingerprint
+        self.k1 = k1
+        self.b = b
+        self.postings = {}
+        self.lengths = []
+        self.avg_length = 0.0
+        self.text_limit = text_limit
+        self.lazy = False
+        # Chunks left out as near-duplicates of indexed ones (set by whoever filtered them)
+        self.duplicates = 0
+        self._chars = 0
+        self._total_length = 0
+        self.add(chunks)
+
+    def add(self, chunks):
+        for chunk in chunks:
+            i = len(self.chunks)
+            counts = Counter(tokenize(chunk["text"]))
+            self.lengths.append(sum(counts.values()))
+            self._total_length += self.lengths[-1]
+            for term, tf in counts.items():
+                self.postings.setdefault(term, []).append((i, tf))
+            self._chars += len(chunk["text"])
+            if self.text_limit is not None and self._chars > self.text_limit and not self.lazy:
+                self.lazy = True
+                for kept in self.chunks:
+                    kept.pop("text", None)
+            if self.lazy:
+                chunk = {k: v for k, v in chunk.items() if k != "text"}
+            self.chunks.append(chunk)
+        self.avg_length = (self._total_length / len(self.lengths)) if self.lengths else 0.0
+
+    def __len__(self):
+        return len(self.chunks)
+
+    # Rough memory footprint, used by the context cache for size-based eviction
+    def size_bytes(self):
+        text = sum(len(c.get("text", "")) for c in self.chunks)
+        postings = sum(len(p) for p in self.postings.values())
+        return text + 64 * postings + 48 * len(self.postings)
+
+    def idf(self, term):
+        df = len(self.postings.get(term, ()))
+        n = len(self.chunks)
+        return math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+    def search(self, query, top_k=5):
+        scores = {}
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = self.idf(term)
+            for i, tf in postings:
+                norm = 1 - self.b + self.b * self.lengths[i] / (self.avg_length or 1)
+                scores[i] = scores.get(i, 0.0) + idf * tf * (self.k1 + 1) / (tf + self.k1 * norm)
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:top_k]
+        return [(score, self.chunks[i]) for i, score in ranked]
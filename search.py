@@ -0,0 +1,36 @@
+import re
+from retrieval import tokenize
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 50
+SNIPPET_CHARS = 200
+
+
+# Mongo $text query, best match first. Each result carries Mongo's relevance as "score";
+# the text indexes behind it (see indexes.py) are kept up to date by Mongo on every write.
+def text_search(collection, terms, query, projection, limit):
+    projection = dict(projection, score={"$meta": "textScore"})
+    cursor = collection.find(dict(query, **{"$text": {"$search": terms}}), projection)
+    return list(cursor.sort([("score", {"$meta": "textScore"})]).limit(limit))
+
+# Mongo matches word stems, so a term is looked for by its first few letters
+def _term_pattern(terms):
+    stems = sorted({t if len(t) <= 4 else t[:max(4, len(t) - 3)] for t in tokenize(terms)}, key=len, reverse=True)
+    if not stems:
+        return None
+    return re.compile(r"\b(?:" + "|".join(re.escape(s) for s in stems) + ")", re.IGNORECASE)
+
+# About width characters of text around the first matching term, cut at word boundaries
+def snippet(text, terms, width=SNIPPET_CHARS):
+    text = " ".join(text.split())
+    pattern = _term_pattern(terms)
+    match = pattern.search(text) if pattern else None
+    start = max(0, match.start() - width // 3) if match else 0
+    end = min(len(text), start + width)
+    if start > 0:
+        space = text.find(" ", start)
+        start = space + 1 if 0 <= space < (match.start() if match else end) else start
+    if end < len(text):
+        space = text.rfind(" ", start, end)
+        end = space if space > start else end
+    return ("…" if start > 0 else "") + text[start:end] + ("…" if end < len(text) else "")
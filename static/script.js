@@ -1,11 +1,45 @@
 let currentChat = null; 
 
-// Load all sessions
-async function loadSessions() {
-    const res = await fetch("/sessions");
-    const chats = await res.json();
+// Lists are paged; the server sends the cursor for the next page in X-Next-Cursor
+let sessionsCursor = null;
+let docsCursor = null;
+let historyCursor = null;
+let loadingMore = false;
+
+// Last response to each list request. Its ETag goes back as If-None-Match; a 304 means the
+// list is unchanged and the stored items are reused (and not redrawn if already on screen).
+// The items returned for a 200 are the stored array, so callers must not change them in place.
+const listResponses = new Map();
+const renderedLists = {};
+
+async function fetchList(url, options = {}) {
+    const key = url + (options.body || "");
+    const cached = listResponses.get(key);
+    const headers = { ...(options.headers || {}) };
+    if (cached) headers["If-None-Match"] = cached.etag;
+    const res = await fetch(url, { ...options, headers });
+    if (res.status === 304 && cached) return { ...cached, items: [...cached.items], key, unchanged: true };
+
+    const entry = { etag: res.headers.get("ETag"), cursor: res.headers.get("X-Next-Cursor"), items: await res.json() };
+    if (res.ok && entry.etag) listResponses.set(key, entry);
+    return { ...entry, key, unchanged: false };
+}
+
+// Load all sessions (more = append the next page)
+async function loadSessions(more = false) {
+    if (more && (!sessionsCursor || loadingMore)) return;
+    loadingMore = true;
+    const url = more ? `/sessions?after=${encodeURIComponent(sessionsCursor)}` : "/sessions";
+    const { items: chats, cursor, key, unchanged } = await fetchList(url);
+    // Already on screen, including any pages loaded after it
+    if (!more && unchanged && renderedLists.sessions === key) {
+        loadingMore = false;
+        return;
+    }
+    sessionsCursor = cursor;
+    if (!more) renderedLists.sessions = key;
     const list = document.getElementById("session-list");
-    list.innerHTML = "";
+    if (!more) list.innerHTML = "";
 
     chats.forEach(c => {
         const li = document.createElement("li");
@@ -30,23 +64,28 @@ async function loadSessions() {
         li.appendChild(btn);
         list.appendChild(li);
     });
+    loadingMore = false;
 }
 
-// Load uploaded documents
-async function loadDocuments(sessionId) {
+// Load uploaded documents (more = append the next page)
+async function loadDocuments(sessionId, more = false) {
     if (!sessionId) return;
 
-    const res = await fetch("/documents", {
+    const { items: docs, cursor, key, unchanged } = await fetchList("/documents", {
         method: "POST",
         headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({ session_id: sessionId })
+        body: JSON.stringify({ session_id: sessionId, after: more ? docsCursor : null })
     });
-    const docs = await res.json();
+    if (!more && unchanged && renderedLists.documents === key) return;
+    docsCursor = cursor;
+    if (!more) renderedLists.documents = key;
     const docSection = document.getElementById("document-list");
     const docList = document.getElementById("docs");
-    docList.innerHTML = "";
+    if (!more) docList.innerHTML = "";
+    const oldMore = document.getElementById("docs-more");
+    if (oldMore) oldMore.remove();
 
-    if (docs.length > 0) {
+    if (docs.length > 0 || more) {
         docSection.style.display = "block";
         docs.forEach(d => {
             const li = document.createElement("li");
@@ -56,7 +95,7 @@ async function loadDocuments(sessionId) {
             li.style.padding = "3px 0";
 
             const fileSpan = document.createElement("span");
-            fileSpan.innerText = d.filename;
+            fileSpan.innerText = d.status === "processing" ? `${d.filename} (processing...)` : d.filename;
 
             const delBtn = document.createElement("button");
             delBtn.className = "delete-btn";
@@ -71,6 +110,16 @@ async function loadDocuments(sessionId) {
             li.appendChild(delBtn);
             docList.appendChild(li);
         });
+
+        if (docsCursor) {
+            const moreLi = document.createElement("li");
+            moreLi.id = "docs-more";
+            const moreBtn = document.createElement("button");
+            moreBtn.innerText = "Load more";
+            moreBtn.onclick = () => loadDocuments(sessionId, true);
+            moreLi.appendChild(moreBtn);
+            docList.appendChild(moreLi);
+        }
     } else {
         docList.innerHTML = "<li>No documents uploaded yet.</li>";
     }
@@ -87,16 +136,40 @@ document.getElementById("upload-btn").onclick = async () => {
 
     const res = await fetch("/upload", { method: "POST", body: formData });
     const data = await res.json();
+    const status = document.getElementById("upload-status");
+    const sessionId = currentChat;
 
-    document.getElementById("upload-status").innerText =
-        data.files && data.files.length > 0
-            ? "✅ Uploaded: " + data.files.map(f => f.filename).join(", ")
-            : "No files uploaded.";
-
-    await loadDocuments(currentChat);
     document.getElementById("file-input").value = "";
+    if (!data.files || data.files.length === 0) {
+        status.innerText = "No files uploaded.";
+        return;
+    }
+
+    // Text extraction runs in the background, poll until every file is processed
+    status.innerText = "⏳ Processing: " + data.files.map(f => f.filename).join(", ");
+    await loadDocuments(sessionId);
+    await waitForUpload(data.job_id, status);
+    if (currentChat === sessionId) await loadDocuments(sessionId);
 };
 
+async function waitForUpload(jobId, status) {
+    while (true) {
+        const res = await fetch(`/upload_status/${jobId}`);
+        if (!res.ok) return;
+        const job = await res.json();
+
+        if (job.status === "done") {
+            const failed = job.files.filter(f => f.status === "error").map(f => f.filename);
+            const done = job.files.filter(f => f.status === "done").map(f => f.filename);
+            status.innerText = (done.length ? "✅ Uploaded: " + done.join(", ") : "")
+                + (failed.length ? " ⚠️ Failed: " + failed.join(", ") : "");
+            return;
+        }
+        status.innerText = `⏳ Processing ${job.completed}/${job.total} files...`;
+        await new Promise(resolve => setTimeout(resolve, 1000));
+    }
+}
+
 // Start new chat
 async function startChat() {
     const description = prompt("Enter chat description:");
@@ -125,16 +198,12 @@ async function selectChat(id) {
 
     document.getElementById("upload-section").scrollIntoView({ behavior: "smooth" });
 
-    // Load history
+    // Load the most recent history, older pages load when scrolling up
     const chatWindow = document.getElementById("chat-window");
     chatWindow.innerHTML = "";
-    const res = await fetch("/history", {
-        method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({ session_id: id })
-    });
-    const history = await res.json();
-    history.forEach(h => {
+    historyCursor = null;
+    const history = await fetchHistory(id);
+    [...history].reverse().forEach(h => {
         appendMessage(h.question, "user");
         appendMessage(h.answer, "bot");
     });
@@ -146,6 +215,35 @@ async function selectChat(id) {
     await loadDocuments(id);
 }
 
+// One page of history, newest first
+async function fetchHistory(id) {
+    const { items, cursor } = await fetchList("/history", {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({ session_id: id, order: "desc", limit: 30, after: historyCursor })
+    });
+    historyCursor = cursor;
+    return items;
+}
+
+async function loadOlderHistory() {
+    if (!currentChat || !historyCursor || loadingMore) return;
+    loadingMore = true;
+    const id = currentChat;
+    const history = await fetchHistory(id);
+    if (id === currentChat) {
+        const chatWindow = document.getElementById("chat-window");
+        const previousHeight = chatWindow.scrollHeight;
+        history.forEach(h => {
+            chatWindow.prepend(createMessage(h.answer, "bot"));
+            chatWindow.prepend(createMessage(h.question, "user"));
+        });
+        // Keep the messages the user was reading in place
+        chatWindow.scrollTop += chatWindow.scrollHeight - previousHeight;
+    }
+    loadingMore = false;
+}
+
 // Send message
 async function sendMessage() {
     const input = document.getElementById("message");
@@ -157,25 +255,69 @@ async function sendMessage() {
     input.value = "";
     sendBtn.style.display = "none";
 
-    const res = await fetch("/chat", {
+    const res = await fetch("/chat/stream", {
         method: "POST",
         headers: { "Content-Type": "application/json" },
         body: JSON.stringify({ session_id: currentChat, message: text })
     });
-    const data = await res.json();
-    appendMessage(data.bot, "bot");
-}
 
-// Append messages to chat window
-function appendMessage(message, sender = "bot") {
+    // Errors (e.g. invalid session) still come back as plain JSON
+    if (!(res.headers.get("Content-Type") || "").startsWith("text/event-stream")) {
+        const data = await res.json();
+        appendMessage(data.bot || data.error, "bot");
+        return;
+    }
+
+    // Render tokens into one bot bubble as they arrive
+    const botDiv = appendMessage("", "bot");
     const chatWindow = document.getElementById("chat-window");
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        let sep;
+        while ((sep = buffer.indexOf("\n\n")) !== -1) {
+            const raw = buffer.slice(0, sep);
+            buffer = buffer.slice(sep + 2);
+
+            let event = "message";
+            let data = "";
+            raw.split("\n").forEach(line => {
+                if (line.startsWith("event:")) event = line.slice(6).trim();
+                else if (line.startsWith("data:")) data += line.slice(5).trim();
+            });
+            if (!data) continue;
+            const payload = JSON.parse(data);
+
+            if (event === "token") botDiv.textContent += payload.text;
+            else if (event === "done") botDiv.textContent = payload.bot;
+            else if (event === "error") botDiv.textContent = payload.error;
+            chatWindow.scrollTop = chatWindow.scrollHeight;
+        }
+    }
+}
+
+function createMessage(message, sender = "bot") {
     const msgDiv = document.createElement("div");
     msgDiv.classList.add("chat-message");
     if (sender === "user") msgDiv.classList.add("user-message-bubble");
     else msgDiv.classList.add("bot-message-bubble");
     msgDiv.textContent = message;
+    return msgDiv;
+}
+
+// Append messages to chat window
+function appendMessage(message, sender = "bot") {
+    const chatWindow = document.getElementById("chat-window");
+    const msgDiv = createMessage(message, sender);
     chatWindow.appendChild(msgDiv);
     chatWindow.scrollTop = chatWindow.scrollHeight;
+    return msgDiv;
 }
 
 // Delete chat
@@ -269,5 +411,14 @@ input.addEventListener("keydown", function (e) {
     }
 });
 
+// Load more sessions at the bottom of the sidebar, older history at the top of the chat
+document.getElementById("sidebar").addEventListener("scroll", e => {
+    const el = e.target;
+    if (el.scrollTop + el.clientHeight >= el.scrollHeight - 40) loadSessions(true);
+});
+document.getElementById("chat-window").addEventListener("scroll", e => {
+    if (e.target.scrollTop < 40) loadOlderHistory();
+});
+
 // Initialize
-window.onload = loadSessions;
+window.onload = () => loadSessions();
@@ -0,0 +1,67 @@
+import os
+
+import gridfs
+from pymongo import MongoClient
+
+# Where sessions, chats, documents and uploaded files are kept, chosen by STORAGE_BACKEND:
+#   mongo   (default) MongoDB at MONGO_URI, files in GridFS
+#   sqlite  one SQLite file at SQLITE_PATH (docstore.py) and files under BLOB_DIR
+#           (blobstore.py): a single machine with no database server to run
+# Both give the same objects: .db behaves as a pymongo Database and .fs as GridFS for the
+# calls this app makes, so handlers, ingestion and the deletion collector don't know which
+# one they use. Every process opens its own (app.py, ingest.py pool processes, task.py).
+DATABASE_NAME = "chat_history_db"
+
+
+class MongoStorage:
+    # GridFS removes file content with the fs.files document; see deletion.py
+    delete_blob_content = None
+
+    def __init__(self, uri=None, connect=True):
+        self.uri = uri or os.getenv("MONGO_URI", "mongodb://localhost:27017")
+        self.client = MongoClient(self.uri, connect=connect)
+        self.db = self.client[DATABASE_NAME]
+        self.fs = gridfs.GridFS(self.db)
+
+    # (db, fs, close) for asyncio code, with a client of its own (asgi.py)
+    def open_async(self):
+        from gridfs import AsyncGridFS
+        from pymongo import AsyncMongoClient
+        client = AsyncMongoClient(self.uri)
+        db = client[DATABASE_NAME]
+        return db, AsyncGridFS(db), client.close
+
+    def close(self):
+        self.client.close()
+
+
+class SQLiteStorage:
+    def __init__(self, path=None, blob_dir=None):
+        from blobstore import FileBlobStore
+        from docstore import Database
+        self.path = path or os.getenv("SQLITE_PATH", "data/chat_history.db")
+        self.blob_dir = blob_dir or os.getenv("BLOB_DIR", os.path.join(os.path.dirname(self.path) or ".", "blobs"))
+        self.db = Database(self.path)
+        self.fs = FileBlobStore(self.db, self.blob_dir)
+        self.delete_blob_content = self.fs.delete_content
+
+    def open_async(self):
+        from blobstore import AsyncFileBlobStore
+        from docstore import AsyncDatabase
+
+        async def close():
+            pass
+        return AsyncDatabase(self.db), AsyncFileBlobStore(self.fs), close
+
+    def close(self):
+        self.db.close()
+
+
+# connect=False: for MongoDB, no connection until the first query (see app.py)
+def open_storage(backend=None, connect=True):
+    backend = backend or os.getenv("STORAGE_BACKEND", "mongo")
+    if backend == "mongo":
+        return MongoStorage(connect=connect)
+    if backend == "sqlite":
+        return SQLiteStorage()
+    raise ValueError(f"Unknown STORAGE_BACKEND {backend!r} (expected 'mongo' or 'sqlite')")
@@ -1,31 +1,271 @@
+# Interactive:  python task.py
+# Batch:        python task.py --batch questions.jsonl --out answers.jsonl --workers 8 --rate 4
+#               (--batch - reads stdin; see run_batch for the line format)
 import os
+import sys
+import json
+import time
 import uuid
-import pandas as pd
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from ai21 import AI21Client
-from ai21.models.chat import ChatMessage
-from pymongo import MongoClient
 from datetime import datetime
-import fitz
-from docx import Document
-import gridfs
+from extractors import extract_text
+from llm import LLMGateway, LazyClient
+from storage import open_storage
+
+MODEL = "jamba-large-1.7"
 
 load_dotenv()
 api_key = os.getenv("AI21_API_KEY")
-client = AI21Client(api_key=api_key)
 
-mongo_client = MongoClient("mongodb://localhost:27017")
-db = mongo_client["chat_history_db"]
+# AI21 client, made on the first model call (the SDK is slow to import)
+def make_ai21_client():
+    from ai21 import AI21Client
+    return AI21Client(api_key=api_key)
+
+client = LazyClient(make_ai21_client)
+
+storage = open_storage()
+db = storage.db
 chat_collection = db["btech_conversations"]
 session_collection = db["chat_sessions"]
 doc_collection = db["documents"]
-fs = gridfs.GridFS(db)
+text_collection = db["extracted_texts"]
+page_collection = db["document_pages"]
+fs = storage.fs
+
+
+def mode_name_of(mode):
+    return "Local" if mode == "1" else "Global"
+
+# "1"/"local" or "2"/"global"; None for anything else
+def parse_mode(value):
+    value = str(value).strip().lower()
+    return {"1": "1", "local": "1", "2": "2", "global": "2"}.get(value)
+
+def create_session(description, mode):
+    session_id = str(uuid.uuid4())
+    session_collection.insert_one({
+        "_id": session_id,
+        "description": description,
+        "created_at": datetime.now(),
+        "mode": mode
+    })
+    # Lets the web app's session list see the change (its ETag follows this counter)
+    db["counters"].update_one({"_id": "sessions"}, {"$inc": {"version": 1}}, upsert=True)
+    return session_id
+
+def find_session(session_id):
+    return session_collection.find_one({"_id": session_id, "deleted_at": {"$exists": False}})
+
+# Text of every document in the session, each under its file name
+def load_doc_content(session_id):
+    doc_content = ""
+    docs_found = False
+    for doc in doc_collection.find({"session_id": session_id}):  # ← filter by session
+        docs_found = True
+        content = doc.get("content")
+        if content is None and doc.get("sha256"):
+            # Web uploads share their extracted text by content hash, stored page by page
+            pages = page_collection.find({"sha256": doc["sha256"]}, {"_id": 0, "text": 1}).sort("ordinal", 1)
+            content = "\n".join(page["text"] for page in pages)
+            if not content:
+                # Extracted before page storage
+                content = (text_collection.find_one({"_id": doc["sha256"]}) or {}).get("content", "")
+        doc_content += f"[From {doc['filename']} ({doc['filetype']})]\n{content}\n\n"
+    return doc_content, docs_found
+
+def system_message(mode, doc_content):
+    if mode == "1":
+        return (
+            "You are an assistant that must only answer using the following document. "
+            "Do not use any external knowledge.\n\n"
+            f"{doc_content}\n\n"
+            "Instructions:\n"
+            "- If the answer is found, respond with '(From local source)' followed by the answer.\n"
+            "- If the answer is not found in the document, respond with exactly: 'Not available in the document.'\n"
+            "- Do not guess or add any extra information beyond the document.\n"
+            "- Format the answer in bullet points if possible."
+        )
+    return (
+        "You are an AI assistant that answers questions using general world knowledge. "
+        "Important: start your answer with '(From Global source)'.\n"
+        "Then, answer using concise bullet points only. Avoid long paragraphs or headings."
+    )
+
+def answer_question(llm, mode, doc_content, question):
+    from ai21.models.chat import ChatMessage
+    messages = [
+        ChatMessage(role="system", content=system_message(mode, doc_content)),
+        ChatMessage(role="user", content=question),
+    ]
+    chat_completions = llm.complete(messages, temperature=0.2, maxTokens=500)
+    return chat_completions.choices[0].message.content
+
+def save_chat(session_id, mode, question, answer):
+    chat_collection.insert_one({
+        "session_id": session_id,
+        "mode": "local" if mode == "1" else "global",
+        "question": question,
+        "answer": answer,
+        "timestamp": datetime.now()
+    })
+    # Lets the web app's history view see the new record (its ETag follows this counter)
+    session_collection.update_one({"_id": session_id}, {"$inc": {"changes.history": 1}})
+
+
+# Spaces calls at least 1/rate seconds apart across all threads; rate 0 means no limit
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        time.sleep(start - now)
+
+
+# Answers every question in a JSONL file (or stdin), one object per line:
+#   {"question": "...", "session": "<session id>", "mode": "1" | "2" | "local" | "global"}
+# "session" and "mode" are optional. Questions without a session go to one session created
+# for the run; without a mode they use their session's mode (or --mode for the run's session).
+# Each question is answered with the same prompt as the interactive loop and saved to the
+# session's history unless --no-save. Results are written as JSONL in the order they finish:
+#   {"line": 3, "session_id": ..., "mode": ..., "question": ..., "answer": ..., "error": null,
+#    "latency_ms": 812.4, "saved": true}
+# Returns the number of questions that failed.
+def run_batch(args):
+    llm = LLMGateway(
+        client,
+        model=MODEL,
+        max_concurrency=args.workers,
+        queue_timeout=None,  # the pool already bounds concurrency; wait for a slot
+        max_retries=int(os.getenv("LLM_MAX_RETRIES", "3"))
+    )
+    limiter = RateLimiter(args.rate)
+    out = open(args.out, "w", encoding="utf-8") if args.out else sys.stdout
+    source = sys.stdin if args.batch == "-" else open(args.batch, encoding="utf-8")
+    write_lock = threading.Lock()
+    sessions = {}  # session id -> (mode, document text), loaded once per run
+    sessions_lock = threading.Lock()
+    run_session = []
+    latencies = []
+    failures = 0
+
+    def emit(result):
+        nonlocal failures
+        with write_lock:
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            out.flush()
+            if result["error"] is None:
+                latencies.append(result["latency_ms"])
+            else:
+                failures += 1
+
+    def session_context(session_id):
+        with sessions_lock:
+            if session_id is None:
+                if not run_session:
+                    description = args.description or f"Batch run {datetime.now():%Y-%m-%d %H:%M}"
+                    run_session.append(create_session(description, args.mode))
+                session_id = run_session[0]
+            if session_id not in sessions:
+                session = find_session(session_id)
+                if session is None:
+                    raise LookupError(f"Session {session_id} not found")
+                sessions[session_id] = (session.get("mode", "2"), load_doc_content(session_id)[0])
+            return session_id, sessions[session_id]
+
+    def process(line_no, item):
+        result = {"line": line_no, "session_id": item.get("session"), "mode": None,
+                  "question": item.get("question"), "answer": None, "error": None,
+                  "latency_ms": None, "saved": False}
+        started = time.perf_counter()
+        try:
+            session_id, (session_mode, doc_content) = session_context(item.get("session"))
+            mode = parse_mode(item["mode"]) if item.get("mode") is not None else session_mode
+            if mode is None:
+                raise ValueError(f"Unknown mode {item['mode']!r}; use 1/local or 2/global")
+            result.update(session_id=session_id, mode=mode_name_of(mode).lower())
+            limiter.wait()
+            started = time.perf_counter()
+            result["answer"] = answer_question(llm, mode, doc_content, item["question"])
+            if not args.no_save:
+                save_chat(session_id, mode, item["question"], result["answer"])
+                result["saved"] = True
+        except Exception as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+        result["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        emit(result)
+
+    # At most two questions per worker are read ahead, so any size of input runs in flat memory
+    queued = threading.BoundedSemaphore(args.workers * 2)
+    run_started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            for line_no, line in enumerate(source, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    item = json.loads(line)
+                    if not isinstance(item, dict) or not isinstance(item.get("question"), str) or not item["question"].strip():
+                        raise ValueError("each line needs a non-empty \"question\" string")
+                    item["question"] = item["question"].strip()
+                    if "session_id" in item and "session" not in item:
+                        item["session"] = item["session_id"]
+                except ValueError as e:
+                    emit({"line": line_no, "session_id": None, "mode": None, "question": None, "answer": None,
+                          "error": f"Invalid line: {e}", "latency_ms": None, "saved": False})
+                    continue
+                queued.acquire()
+                pool.submit(process, line_no, item).add_done_callback(lambda _: queued.release())
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if out is not sys.stdout:
+            out.close()
+
+    latencies.sort()
+    summary = {
+        "answered": len(latencies),
+        "failed": failures,
+        "seconds": round(time.perf_counter() - run_started, 2),
+        "p50_ms": latencies[len(latencies) // 2] if latencies else None,
+        "p95_ms": latencies[int(len(latencies) * 0.95)] if latencies else None,
+        "session_id": run_session[0] if run_session else None
+    }
+    print(json.dumps(summary), file=sys.stderr)
+    return failures
+
+
+parser = argparse.ArgumentParser(description="Ask questions about a chat session's documents")
+parser.add_argument("--batch", metavar="FILE", help="answer the questions in a JSONL file ('-' for stdin) and exit")
+parser.add_argument("--out", default=None, help="write batch results here (default: stdout)")
+parser.add_argument("--workers", type=int, default=4, help="questions answered at once in batch mode (default 4)")
+parser.add_argument("--rate", type=float, default=0, help="at most this many questions per second (default: no limit)")
+parser.add_argument("--mode", type=parse_mode, default="2", help="mode of the session created for a batch run (default 2)")
+parser.add_argument("--description", default=None, help="description of the session created for a batch run")
+parser.add_argument("--no-save", action="store_true", help="do not save batch answers to the chat history")
+args = parser.parse_args()
+
+if args.batch:
+    if args.mode is None:
+        parser.error("--mode must be 1/local or 2/global")
+    sys.exit(1 if run_batch(args) else 0)
 
 # Start or select session
 session_choice = input("Start a new session? (y/n): ").strip().lower()
 if session_choice == "y":
     # Create new session
-    session_id = str(uuid.uuid4())
     session_description = input("Enter a short description for this session: ").strip()
 
     # Ask for mode only for new sessions
@@ -33,98 +273,88 @@ if session_choice == "y":
     if mode not in ["1", "2"]:
         print("Invalid choice. Exiting.")
         exit()
-    mode_name = "Local" if mode == "1" else "Global"
+    mode_name = mode_name_of(mode)
 
-    session_collection.insert_one({
-        "_id": session_id,
-        "description": session_description,
-        "created_at": datetime.now(),
-        "mode": mode
-    })
+    session_id = create_session(session_description, mode)
     print(f"New session created with ID: {session_id}")
 
     # Ask to upload documents (only for new sessions)
     upload_docs = input("\nDo you want to upload documents? (y/n): ").strip().lower()
     if upload_docs == "y":
+        # Files are stored once per content hash and shared through a reference count
         def store_file_in_gridfs(filepath, filetype):
             filename = os.path.basename(filepath)
-            if fs.find_one({"filename": filename}):
-                print(f"File already exists in GridFS: {filename} – Skipping.")
-                return
             try:
+                digest = hashlib.sha256()
                 with open(filepath, "rb") as f:
-                    fs.put(f, filename=filename, filetype=filetype, uploaded_at=datetime.now())
+                    for block in iter(lambda: f.read(1024 * 1024), b""):
+                        digest.update(block)
+                sha256 = digest.hexdigest()
+
+                existing = db.fs.files.find_one_and_update({"sha256": sha256}, {"$inc": {"refcount": 1}})
+                if existing:
+                    print(f"Identical content already in GridFS: {filename} – Reusing it.")
+                    return existing["_id"]
+                with open(filepath, "rb") as f:
+                    file_id = fs.put(f, filename=filename, filetype=filetype, sha256=sha256,
+                                     refcount=1, uploaded_at=datetime.now())
                     print(f"Saved {filename} to GridFS.")
+                    return file_id
             except Exception as e:
                 print(f"Error saving {filename} to GridFS: {e}")
 
-        def store_document_in_db(filename, filetype, content):
+        # The file is stored, or another reference to it taken, only for a document that is
+        # inserted: a skipped one would hold a reference that nothing releases
+        def store_document_in_db(filepath, filetype, content):
+            filename = os.path.basename(filepath)
             if not content.strip():
                 print(f"File is empty: {filename}")
                 return
-            existing = doc_collection.find_one({"filename": filename, "filetype": filetype})
+            existing = doc_collection.find_one({"session_id": session_id, "filename": filename})
             if existing:
                 print(f"Document already exists in DB: {filename} ({filetype}) – Skipping.")
                 return
+            gridfs_id = store_file_in_gridfs(filepath, filetype)
             doc_collection.insert_one({
                 "session_id": session_id,
                 "filename": filename,
                 "filetype": filetype,
                 "content": content,
-                "uploaded_at": datetime.now()
+                "uploaded_at": datetime.now(),
+                "gridfs_id": gridfs_id
             })
             print(f"Stored in DB: {filename} ({filetype})")
 
-        def extract_text_from_pdf(pdf_path):
-            try:
-                doc = fitz.open(pdf_path)
-                return "\n".join([page.get_text() for page in doc])
-            except Exception as e:
-                print(f"Error reading PDF {pdf_path}: {e}")
-                return ""
-
-        def read_excel_to_text(path):
-            try:
-                df = pd.read_excel(path, engine="openpyxl")
-                return df.to_string(index=False)
-            except Exception as e:
-                print(f"Error reading Excel file {path}: {e}")
-                return ""
-
-        def extract_text_from_docx(docx_path):
+        # Parsers come from the extractor registry and are only imported for the types used
+        def read_document(path, filetype):
             try:
-                doc = Document(docx_path)
-                return "\n".join([para.text for para in doc.paragraphs if para.text.strip()])
+                return extract_text(filetype, path)
             except Exception as e:
-                print(f"Error reading DOCX file {docx_path}: {e}")
+                print(f"Error reading {path}: {e}")
                 return ""
 
         # Upload files
         if os.path.exists("doc.txt"):
-            store_file_in_gridfs("doc.txt", "text")
             with open("doc.txt", "r", encoding="utf-8") as file:
                 doc_text = file.read()
-                store_document_in_db("doc.txt", "text", doc_text)
+            store_document_in_db("doc.txt", "text", doc_text)
         else:
             print("doc.txt file not found.")
 
         if os.path.exists("Full.pdf"):
-            store_file_in_gridfs("Full.pdf", "pdf")
-            pdf_text = extract_text_from_pdf("Full.pdf")
+            pdf_text = read_document("Full.pdf", "pdf")
             store_document_in_db("Full.pdf", "pdf", pdf_text)
         else:
             print("Full.pdf file not found.")
 
         if os.path.exists("sample.xlsx"):
-            store_file_in_gridfs("sample.xlsx", "excel")
-            excel_text = read_excel_to_text("sample.xlsx")
+            excel_text = read_document("sample.xlsx", "xlsx")
             store_document_in_db("sample.xlsx", "excel", excel_text)
         else:
             print("sample.xlsx file not found.")
 
         if os.path.exists("title.docx"):
-            store_file_in_gridfs("title.docx", "docx")
-            docx_text = extract_text_from_docx("title.docx")
+            docx_text = read_document("title.docx", "docx")
             store_document_in_db("title.docx", "docx", docx_text)
         else:
             print("title.docx file not found.")
@@ -134,7 +364,7 @@ if session_choice == "y":
 else:
     # Existing session
     print("\nExisting sessions:")
-    existing_sessions = list(session_collection.find())
+    existing_sessions = list(session_collection.find({"deleted_at": {"$exists": False}}))
     if not existing_sessions:
         print("No existing sessions found. Please create a new one.")
         exit()
@@ -145,22 +375,18 @@ else:
         print(f"ID: {s['_id']} | {s['description']} | Created: {created_at_str} | Mode: {mode_str}")
 
     session_id = input("\nEnter existing session ID: ").strip()
-    existing = session_collection.find_one({"_id": session_id})
+    existing = find_session(session_id)
     if not existing:
         print("Session ID not found. Exiting.")
         exit()
 
     # Load mode from DB and skip document upload
     mode = existing.get("mode", "2")  # Default to Global
-    mode_name = "Local" if mode == "1" else "Global"
+    mode_name = mode_name_of(mode)
     print(f"Continuing in {mode_name} mode. Skipping document upload.")
 
 # Prepare local document content if needed
-doc_content = ""
-docs_found = False
-for doc in doc_collection.find({"session_id": session_id}):  # ← filter by session
-    docs_found = True
-    doc_content += f"[From {doc['filename']} ({doc['filetype']})]\n{doc['content']}\n\n"
+doc_content, docs_found = load_doc_content(session_id)
 
 if not docs_found and mode == "1":
     print("No documents found in the database. Local mode will not work.")
@@ -171,9 +397,8 @@ for record in chat_collection.find({"session_id": session_id}).sort("timestamp")
     print(f"\n👤 User: {record['question']}")
     print(f"🤖 Bot: {record['answer']}")
 
-from datetime import datetime
-from ai21 import AI21Client
-from ai21.models.chat import ChatMessage
+# One question at a time, so no concurrency
+llm = LLMGateway(client, model=MODEL, max_concurrency=1)
 
 while True:
     user_input = input(f"\nAsk a question (or type 'exit' to end from {mode_name}): ").strip()
@@ -184,8 +409,9 @@ while True:
             new_mode = input("Choose new mode - (1) Local documents or (2) Global knowledge? Enter 1 or 2: ").strip()
             if new_mode in ["1", "2"]:
                 mode = new_mode
-                mode_name = "Local" if mode == "1" else "Global"
+                mode_name = mode_name_of(mode)
                 session_collection.update_one({"_id": session_id}, {"$set": {"mode": mode}})
+                db["counters"].update_one({"_id": "sessions"}, {"$inc": {"version": 1}}, upsert=True)
                 print("Mode switched successfully.")
             else:
                 print("Invalid choice. Staying in current mode.")
@@ -194,52 +420,12 @@ while True:
             print("Session ended. Goodbye!")
             break
 
-    if mode == "1":  
-        system_message = (
-            "You are an assistant that must only answer using the following document. "
-            "Do not use any external knowledge.\n\n"
-            f"{doc_content}\n\n"
-            "Instructions:\n"
-            "- If the answer is found, respond with '(From local source)' followed by the answer.\n"
-            "- If the answer is not found in the document, respond with exactly: 'Not available in the document.'\n"
-            "- Do not guess or add any extra information beyond the document.\n"
-            "- Format the answer in bullet points if possible."
-        )
-    else:  
-        system_message = (
-            "You are an AI assistant that answers questions using general world knowledge. "
-            "Important: start your answer with '(From Global source)'.\n"
-            "Then, answer using concise bullet points only. Avoid long paragraphs or headings."
-        )
-
-    # Prepare chat messages
-    messages = [
-        ChatMessage(role="system", content=system_message),
-        ChatMessage(role="user", content=user_input),
-    ]
-
     try:
-        # Call AI21 chat completion API
-        chat_completions = client.chat.completions.create(
-            model="jamba-large-1.7",
-            messages=messages,
-            temperature=0.2,   
-            maxTokens=500     
-        )
-
-        # Extract the assistant's answer
-        answer = chat_completions.choices[0].message.content
+        answer = answer_question(llm, mode, doc_content, user_input)
         print("\nAnswer:\n", answer)
 
         # Save chat to MongoDB
-        chat_record = {
-            "session_id": session_id,
-            "mode": "local" if mode == "1" else "global",
-            "question": user_input,
-            "answer": answer,
-            "timestamp": datetime.now()
-        }
-        chat_collection.insert_one(chat_record)
+        save_chat(session_id, mode, user_input, answer)
         print("Chat saved successfully.")
 
     except Exception as e:
@@ -0,0 +1,214 @@
+import logging
+import threading
+import time
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+log = logging.getLogger(__name__)
+
+MODES = ("sync", "batched", "fire_and_forget")
+DUPLICATE_KEY = 11000
+
+
+# Handed back for each buffered record; batched callers wait on it
+class WriteTicket:
+    def __init__(self):
+        self._done = threading.Event()
+        self.error = None
+
+    def wait(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise TimeoutError("Chat history write did not complete in time")
+        if self.error is not None:
+            raise self.error
+
+    def _finish(self, error=None):
+        self.error = error
+        self._done.set()
+
+
+# Write-behind buffer for one collection. Records are inserted with insert_many by a
+# background thread once batch_size are waiting or the oldest has waited interval seconds.
+#   sync             insert_one before returning (no buffering)
+#   batched          the caller waits until its batch is written: fewer writes, same durability
+#   fire_and_forget  the caller returns at once; a crash can lose up to one interval of records
+# Pending records are visible to pending() until written, so a worker reads its own writes.
+# Each worker process has its own buffer.
+class WriteBehindBuffer:
+    # on_flush: called from the writer thread with each batch once it is written
+    def __init__(self, collection, mode="sync", batch_size=100, interval=0.2, wait_timeout=10.0, on_flush=None):
+        if mode not in MODES:
+            raise ValueError(f"Unknown write mode {mode!r}; use one of {', '.join(MODES)}")
+        self.collection = collection
+        self.mode = mode
+        self.batch_size = batch_size
+        self.interval = interval
+        self.wait_timeout = wait_timeout
+        self.on_flush = on_flush
+        self._pending = []
+        # Tickets of the batch being written, and those of it discarded meanwhile
+        self._in_flight = set()
+        self._discarded = set()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._closed = False
+        self.batches = 0
+        self.written = 0
+        self.failures = 0
+
+    # Returns a ticket that is already done in sync mode
+    def add(self, record):
+        ticket = WriteTicket()
+        if self.mode == "sync":
+            self.collection.insert_one(record)
+            ticket._finish()
+            return ticket
+
+        record.setdefault("_id", ObjectId())
+        # Mongo keeps milliseconds; trimming now keeps pending and stored copies in the same order
+        if "timestamp" in record:
+            ts = record["timestamp"]
+            record["timestamp"] = ts.replace(microsecond=ts.microsecond // 1000 * 1000)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Write-behind buffer is closed")
+            self._pending.append((time.monotonic(), record, ticket))
+            if self._thread is None:
+                # Started on first use, so it is created in the serving process, not before a fork
+                self._thread = threading.Thread(target=self._run, name="chat-write-behind", daemon=True)
+                self._thread.start()
+            # Wake the thread to start the interval for a new batch, or to write a full one
+            if len(self._pending) == 1 or len(self._pending) >= self.batch_size:
+                self._cond.notify()
+        return ticket
+
+    # add(), waiting for the write when the mode promises durability
+    def write(self, record):
+        ticket = self.add(record)
+        if self.mode == "batched":
+            ticket.wait(self.wait_timeout)
+        return ticket
+
+    # Records not yet written that match every key/value in match
+    def pending(self, **match):
+        with self._cond:
+            return [
+                dict(record) for _, record, ticket in self._pending
+                if ticket not in self._discarded and all(record.get(k) == v for k, v in match.items())
+            ]
+
+    # Drop records not yet written, e.g. for a session that is being deleted. Records in the
+    # batch being written can't be taken back; they are marked, and deleted again once written.
+    def discard(self, **match):
+        with self._cond:
+            kept = []
+            dropped = 0
+            for item in self._pending:
+                if item[2] in self._discarded or not all(item[1].get(k) == v for k, v in match.items()):
+                    kept.append(item)
+                    continue
+                dropped += 1
+                item[2]._finish()
+                if item[2] in self._in_flight:
+                    self._discarded.add(item[2])
+                    kept.append(item)
+            self._pending[:] = kept
+        return dropped
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    if len(self._pending) >= self.batch_size:
+                        break
+                    if self._pending:
+                        wait = self._pending[0][0] + self.interval - time.monotonic()
+                        if wait <= 0:
+                            break
+                        self._cond.wait(wait)
+                    else:
+                        self._cond.wait()
+                if self._closed and not self._pending:
+                    return
+            if not self.flush() and not self._closed:
+                # Mongo is unavailable; back off before trying the same records again
+                time.sleep(self.interval)
+
+    # Write what is pending now. Returns False when the batch failed and was kept for a retry.
+    def flush(self):
+        with self._cond:
+            batch = self._pending[:self.batch_size]
+            self._in_flight = {ticket for _, _, ticket in batch}
+        if not batch:
+            return True
+
+        retry = []
+        try:
+            self.collection.insert_many([record for _, record, _ in batch], ordered=False)
+        except BulkWriteError as e:
+            # Records written by an earlier attempt come back as duplicate keys: those are done
+            failed = {err["index"] for err in e.details.get("writeErrors", []) if err.get("code") != DUPLICATE_KEY}
+            retry = [item for i, item in enumerate(batch) if i in failed]
+        except Exception:
+            log.exception("Chat history batch of %d failed, will retry", len(batch))
+            retry = batch
+
+        done = [item for item in batch if item not in retry]
+        # on_flush runs while the records are still in pending(), so readers never see them
+        # gone from the buffer before the change is counted (app.py's history ETag)
+        with self._cond:
+            written = [record for _, record, ticket in done if ticket not in self._discarded]
+        if written and self.on_flush is not None:
+            try:
+                self.on_flush(written)
+            except Exception:
+                log.exception("Chat history flush callback failed")
+        with self._cond:
+            # The batch leaves the buffer by identity, as discard() may have removed records
+            # around it; failed ones go back to the front, in order, unless discarded
+            self._pending[:] = [item for item in self._pending if item[2] not in self._in_flight]
+            discarded = self._discarded
+            self._in_flight = set()
+            self._discarded = set()
+            retry = [item for item in retry if item[2] not in discarded]
+            self._pending[:0] = retry
+            self.batches += 1
+            self.written += len(done)
+            self.failures += 1 if retry else 0
+        unwanted = [record["_id"] for _, record, ticket in done if ticket in discarded]
+        if unwanted:
+            done = [item for item in done if item[2] not in discarded]
+            try:
+                self.collection.delete_many({"_id": {"$in": unwanted}})
+            except Exception:
+                log.exception("Could not remove %d discarded chat history records", len(unwanted))
+        for _, _, ticket in done:
+            ticket._finish()
+        return not retry
+
+    # Stop the thread and write everything still buffered (called at interpreter exit)
+    def close(self, timeout=10.0):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        deadline = time.monotonic() + timeout
+        while self._pending and time.monotonic() < deadline:
+            if not self.flush():
+                time.sleep(self.interval)
+        if self._pending:
+            log.error("%d chat history records could not be written before shutdown", len(self._pending))
+
+    def stats(self):
+        with self._cond:
+            return {
+                "mode": self.mode,
+                "pending": len(self._pending),
+                "batches": self.batches,
+                "written": self.written,
+                "failures": self.failures
+            }